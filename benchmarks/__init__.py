@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import io
+import json
+import sys
+
+
+def add_results_arguments(parser):
+    """
+    Adds the --output and --compare options, handled by `report_results`, to `parser`.
+    """
+    parser.add_argument('--output',
+                        help='A file to save the results to as JSON.')
+    parser.add_argument('--compare',
+                        help='The JSON results of an earlier run to compare these to.')
+
+
+def print_comparison(baseline, results, option_keys, get_compared, title=''):
+    """
+    Prints the results of this run next to those of the `baseline` run, warning if the runs used
+    different options.
+
+    Args:
+        baseline (dict): The results of the earlier run.
+        results (dict): The results of this run.
+        option_keys (iterable of str): The keys of `results` holding the options of the run.
+        get_compared (function): Returns a list of (label, value, bigger is better) tuples for
+                                 the values in a run's results that are compared.
+        title (str, optional): The heading of the column of labels.
+    """
+    for key in option_keys:
+        if baseline.get(key) != results[key]:
+            print('warning: the runs used different %s: %r and %r'
+                  % (key.replace('_', ' '), baseline.get(key), results[key]), file=sys.stderr)
+
+    baseline_values = dict((label, value) for label, value, _ in get_compared(baseline))
+
+    print('%-36s %14s %14s %9s' % (title, 'baseline', 'current', 'change'))
+    for label, after, bigger_is_better in get_compared(results):
+        before = baseline_values.get(label)
+        if before is None or after is None:
+            continue
+        change = (after - before) * 100.0 / before if before else 0.0
+        improved = change > 0 if bigger_is_better else change < 0
+        print('%-36s %14.1f %14.1f %+8.1f%%%s' % (label, before, after, change,
+                                                  ' (better)' if improved and change else ''))
+
+
+def report_results(options, results, print_results, option_keys, get_compared, title=''):
+    """
+    Prints `results`, or compares them to the run saved at --compare, and saves them to
+    --output if it is given. The other arguments are as for `print_comparison`, along with
+    `print_results`, the function that prints the results on their own.
+    """
+    if options.compare:
+        with io.open(options.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), results, option_keys, get_compared, title=title)
+    else:
+        print_results(results)
+
+    if options.output:
+        with io.open(options.output, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(results, indent=2))
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic template trees to benchmark against.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import io
+import os
+import random
+
+from os import path
+
+
+BASE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><title>{% block title %}Site{% endblock %}</title></head>
+<body>
+{% block header %}<header>{{ site.name|upper }}</header>{% endblock %}
+{% block content %}{% endblock %}
+{% block footer %}<footer>&copy; {{ site.year }}</footer>{% endblock %}
+</body>
+</html>
+"""
+
+LAYOUT_TEMPLATE = """{% extends 'layouts/base.jinja' %}
+{% block header %}
+    {{ super() }}
+    <nav>
+    {% for link in nav %}
+        <a href="{{ link.url }}" class="{% if loop.first %}first{% endif %}">{{ link.title }}</a>
+    {% endfor %}
+    </nav>
+{% endblock %}
+"""
+
+PARTIAL_TEMPLATE = """<div class="partial-{index}">
+    {{% if item %}}
+        <span>{{{{ item.name|title }}}}</span>
+        <em>{{{{ item.description|truncate(40) }}}}</em>
+    {{% else %}}
+        <span>{{{{ fallback|default('none') }}}}</span>
+    {{% endif %}}
+</div>
+"""
+
+PAGE_BLOCKS = [
+    """
+    <section>
+    {{% for item in items %}}
+        <article id="item-{{{{ loop.index }}}}">
+            <h2>{{{{ item.name|capitalize }}}}</h2>
+            {{% include 'partials/partial_{partial}.jinja' %}}
+            {{% if item.count > {number} %}}<b>{{{{ item.count * 2 }}}}</b>{{% endif %}}
+        </article>
+    {{% endfor %}}
+    </section>
+""",
+    """
+    {{% with total = items|length %}}
+        <p>{{{{ total }}}} items, page {number}</p>
+    {{% endwith %}}
+    {{% include 'partials/partial_{partial}.jinja' %}}
+""",
+    """
+    {{% set heading = 'Page {number}' %}}
+    <h1>{{{{ heading|upper }}}}</h1>
+    {{% for key, value in attrs.items() %}}
+        <dt>{{{{ key }}}}</dt><dd>{{{{ value|default('-') }}}}</dd>
+    {{% endfor %}}
+""",
+]
+
+
+def _write(template_root, template_name, source):
+    file_path = path.join(template_root, template_name)
+    if not path.isdir(path.dirname(file_path)):
+        os.makedirs(path.dirname(file_path))
+    with io.open(file_path, 'w', encoding='utf-8') as f:
+        f.write(source)
+
+
+def generate_corpus(template_root, templates=3000, partials=50, seed=0):
+    """
+    Writes a synthetic tree of `templates` templates to `template_root`. Pages extend a two level
+    layout chain and include a random selection of `partials` partials.
+
+    Returns:
+        list of str: The names of the generated templates.
+    """
+    rand = random.Random(seed)
+    names = ['layouts/base.jinja', 'layouts/layout.jinja']
+
+    _write(template_root, names[0], BASE_TEMPLATE)
+    _write(template_root, names[1], LAYOUT_TEMPLATE)
+
+    for i in range(partials):
+        name = 'partials/partial_%d.jinja' % i
+        _write(template_root, name, PARTIAL_TEMPLATE.format(index=i))
+        names.append(name)
+
+    for i in range(templates - len(names)):
+        body = ''.join(
+            rand.choice(PAGE_BLOCKS).format(partial=rand.randrange(partials),
+                                            number=rand.randrange(100))
+            for _ in range(rand.randint(1, 6))
+        )
+        source = (
+            "{% extends 'layouts/layout.jinja' %}\n"
+            "{% block title %}Page " + str(i) + "{% endblock %}\n"
+            "{% block content %}" + body + "{% endblock %}\n"
+        )
+        name = 'pages/page_%d.jinja' % i
+        _write(template_root, name, source)
+        names.append(name)
+
+    return names
+
+
+# The filters applied to the expressions in templates written by `generate_compile_corpus`.
+GENERATED_FILTERS = ('upper', 'lower', 'title', 'capitalize', 'trim', "default('-')",
+                     'truncate(30)')
+
+# The number of levels of partials written by `generate_compile_corpus`, each including
+# partials from the level below.
+PARTIAL_LEVELS = 2
+
+GENERATED_BASE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><title>{% block title %}Site{% endblock %}</title></head>
+<body>
+{% block header %}<header>{{ site.name }}</header>{% endblock %}
+{% block content %}{% endblock %}
+{% block footer %}<footer>{{ site.year }}</footer>{% endblock %}
+</body>
+</html>
+"""
+
+GENERATED_LAYOUT_TEMPLATE = """{{% extends 'layouts/layout_{parent}.jinja' %}}
+{{% block header %}}
+    {{{{ super() }}}}
+    <nav class="level-{level}">
+    {{% for link in nav %}}
+        <a href="{{{{ link.url }}}}">{title}</a>
+    {{% endfor %}}
+    </nav>
+{{% endblock %}}
+"""
+
+
+def _filtered(rand, expression, filter_density):
+    """
+    Returns an output of `expression` with `filter_density` filters applied on average.
+    """
+    count = int(filter_density)
+    if rand.random() < filter_density - count:
+        count += 1
+    for _ in range(count):
+        expression += '|' + rand.choice(GENERATED_FILTERS)
+    return '{{ %s }}' % expression
+
+
+def _generate_block(rand, name, depth, filter_density):
+    """
+    Returns template source outputting attributes of the variable `name`, with loops and
+    conditions nested `depth` deep.
+    """
+    source = '<p>%s %s</p>\n' % (_filtered(rand, name + '.title', filter_density),
+                                 _filtered(rand, 'site.name', filter_density))
+    if depth == 0:
+        return source
+
+    if rand.random() < 0.5:
+        loop_variable = 'item_%d' % depth
+        return '%s{%% for %s in %s.children %%}\n%s{%% endfor %%}\n' % (
+            source, loop_variable, name,
+            _generate_block(rand, loop_variable, depth - 1, filter_density)
+        )
+
+    return '%s{%% if %s.visible %%}\n%s{%% else %%}<em>%s</em>{%% endif %%}\n' % (
+        source, name, _generate_block(rand, name, depth - 1, filter_density),
+        _filtered(rand, name + '.summary', filter_density)
+    )
+
+
+def _generate_includes(rand, level, partials, fan_out):
+    return ''.join(
+        "{%% include 'partials/level_%d/partial_%d.jinja' %%}\n" % (level, rand.randrange(partials))
+        for _ in range(fan_out)
+    )
+
+
+def generate_compile_corpus(template_root, templates=500, depth=3, fan_out=2, extends_depth=2,
+                            filter_density=0.5, partials=20, seed=0):
+    """
+    Writes a synthetic tree of `templates` templates to `template_root` for benchmarking
+    compilation, shaped by the other arguments.
+
+    Args:
+        template_root (str): The directory to write the templates to.
+        templates (int, optional): The total number of templates to write. It must be more than
+                                   the number of layouts and partials, so there is at least one
+                                   page.
+        depth (int, optional): How deeply loops and conditions are nested in each template.
+        fan_out (int, optional): The number of partials included by each page, and by each
+                                 partial apart from those on the last level.
+        extends_depth (int, optional): The length of the chain of layouts each page extends, or
+                                       0 for pages not to extend a layout.
+        filter_density (float, optional): The average number of filters applied to each
+                                          expression.
+        partials (int, optional): The number of partials on each of the `PARTIAL_LEVELS` levels.
+        seed (int, optional): The seed for the random choices made, so that the same arguments
+                              always write the same templates.
+
+    Returns:
+        list of str: The names of the generated templates.
+
+    Raises:
+        ValueError: If `templates` leaves no room for any pages.
+    """
+    shared = extends_depth + PARTIAL_LEVELS * partials
+    if templates <= shared:
+        raise ValueError(
+            'A corpus with %d layouts and %d partials needs more than %d templates, not %d.' % (
+                extends_depth, PARTIAL_LEVELS * partials, shared, templates
+            )
+        )
+
+    rand = random.Random(seed)
+    names = []
+
+    for level in range(extends_depth):
+        name = 'layouts/layout_%d.jinja' % level
+        if level == 0:
+            source = GENERATED_BASE_TEMPLATE
+        else:
+            source = GENERATED_LAYOUT_TEMPLATE.format(
+                parent=level - 1, level=level,
+                title=_filtered(rand, 'link.title', filter_density)
+            )
+        _write(template_root, name, source)
+        names.append(name)
+
+    for level in range(PARTIAL_LEVELS):
+        for i in range(partials):
+            name = 'partials/level_%d/partial_%d.jinja' % (level, i)
+            source = '<div class="partial">\n%s</div>\n' % _generate_block(
+                rand, 'page', max(depth - 1, 0), filter_density
+            )
+            if level + 1 < PARTIAL_LEVELS:
+                source += _generate_includes(rand, level + 1, partials, fan_out)
+            _write(template_root, name, source)
+            names.append(name)
+
+    for i in range(templates - len(names)):
+        body = ''.join(_generate_block(rand, 'page', depth, filter_density)
+                       for _ in range(rand.randint(1, 3)))
+        body += _generate_includes(rand, 0, partials, fan_out)
+        if extends_depth:
+            source = (
+                "{% extends 'layouts/layout_" + str(extends_depth - 1) + ".jinja' %}\n"
+                "{% block title %}Page " + str(i) + "{% endblock %}\n"
+                "{% block content %}\n" + body + "{% endblock %}\n"
+            )
+        else:
+            source = body
+        name = 'pages/page_%d.jinja' % i
+        _write(template_root, name, source)
+        names.append(name)
+
+    return names
+
+
+TABLE_TEMPLATE = """<table class="results">
+<thead><tr><th>#</th><th>Name</th><th>Email</th><th>Score</th><th>Status</th></tr></thead>
+<tbody>
+{% for row in rows %}
+    <tr class="{% if loop.first %}first{% endif %}">
+        <td>{{ loop.index }}</td>
+        <td><a href="/users/{{ row.id }}">{{ row.name }}</a></td>
+        <td>{{ row.email }}</td>
+        <td>{{ row.score }} / {{ row.max_score }}</td>
+        <td>{% if row.active %}<b>active</b>{% else %}<i>inactive</i>{% endif %}</td>
+    </tr>
+{% endfor %}
+</tbody>
+</table>
+"""
+
+
+def generate_table_template(template_root):
+    """
+    Writes a template rendering a table, with several interpolations per row, to
+    `template_root`.
+
+    Returns:
+        str: The name of the template.
+    """
+    _write(template_root, 'table.jinja', TABLE_TEMPLATE)
+    return 'table.jinja'
+
+
+def generate_table_data(rows, seed=0):
+    """
+    Returns a context for the template written by `generate_table_template`.
+    """
+    rand = random.Random(seed)
+    return {
+        'rows': [
+            {
+                'id': i,
+                'name': 'User <%d>' % i,
+                'email': 'user%d@example.com' % i,
+                'score': rand.randrange(100),
+                'max_score': 100,
+                'active': rand.random() > 0.5,
+            }
+            for i in range(rows)
+        ]
+    }
+
+
+INCLUDE_TEMPLATE = """<ul class="results">
+{% for row in rows %}
+    {% include 'row.jinja' %}
+{% endfor %}
+</ul>
+"""
+
+INCLUDED_ROW_TEMPLATE = """<li class="{{ theme }}">
+    <a href="/users/{{ row.id }}">{{ row.name }}</a> {{ row.score }}
+</li>
+"""
+
+
+def generate_include_template(template_root):
+    """
+    Writes a template that includes another template for every row to `template_root`.
+
+    Returns:
+        list of str: The names of the template and the template it includes.
+    """
+    _write(template_root, 'include.jinja', INCLUDE_TEMPLATE)
+    _write(template_root, 'row.jinja', INCLUDED_ROW_TEMPLATE)
+    return ['include.jinja', 'row.jinja']
+
+
+def generate_include_data(rows, keys, seed=0):
+    """
+    Returns a context for the template written by `generate_include_template`, with `keys`
+    unrelated keys in addition to the rows.
+    """
+    data = generate_table_data(rows, seed=seed)
+    data['theme'] = 'light'
+    for i in range(keys):
+        data['key_%d' % i] = 'value %d' % i
+    return data
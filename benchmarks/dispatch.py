@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Measures compile throughput on the templates in the test suite. Parsed templates are shared
+between compiles so the timings are dominated by code generation, including dispatching each
+node, filter and test to its handler. The handler tables `JinjaToJS` dispatches through are
+compared to a baseline that looks each handler up with `getattr` on every visit, as `JinjaToJS`
+used to.
+
+Usage:
+    python -m benchmarks.dispatch --repeat 200 --runs 5
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import time
+
+from os import path
+
+from jinja_to_js import JinjaToJS, TemplateCache, option
+from jinja_to_js.batch import find_templates
+
+
+TEMPLATE_ROOT = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'tests', 'templates')
+
+
+class GetattrJinjaToJS(JinjaToJS):
+    """
+    Finds the handler for each node, filter and test by building its method name and calling
+    `getattr` on every visit, the way `JinjaToJS` did before it had handler tables.
+    """
+
+    def _process_node(self, node, **kwargs):
+        handler = getattr(type(self), '_process_' + node.__class__.__name__.lower(), None)
+        if not callable(handler):
+            raise Exception('Unknown node %s' % node)
+        self._call_node_handler(handler, node, **kwargs)
+
+    def _process_filter(self, node, **kwargs):
+        handler = getattr(self, '_process_filter_%s' % node.name, None)
+        if callable(handler):
+            handler(node, **kwargs)
+        else:
+            # custom filters, or an unsupported filter
+            self._call_filter_handler(node, **kwargs)
+
+    def _process_test(self, node, **kwargs):
+        with option(kwargs, use_python_bool_wrapper=False):
+            handler = getattr(self, '_process_test_%s' % node.name, None)
+            if not callable(handler):
+                raise Exception('Unsupported test: %s' % node.name)
+            handler(node, **kwargs)
+
+
+def get_compilable_templates(template_cache):
+    """
+    Returns the names of the test templates that compile successfully (some of them exist to
+    test errors).
+    """
+    template_names = []
+    for name in find_templates(TEMPLATE_ROOT):
+        try:
+            JinjaToJS(template_root=TEMPLATE_ROOT, template_name=name,
+                      template_cache=template_cache, custom_filters=['unicode_snowmen'])
+        except Exception:
+            continue
+        template_names.append(name)
+    return template_names
+
+
+def time_compiles(compiler_class, template_cache, template_names, repeat, runs):
+    """
+    Compiles `template_names` `repeat` times with `compiler_class` in each of `runs` runs.
+
+    Returns:
+        float: The number of seconds the fastest run took.
+    """
+    elapsed = None
+    for _ in range(runs):
+        start = time.time()
+        for _ in range(repeat):
+            for name in template_names:
+                compiler_class(template_root=TEMPLATE_ROOT, template_name=name,
+                               template_cache=template_cache, custom_filters=['unicode_snowmen'])
+        run_time = time.time() - start
+        elapsed = run_time if elapsed is None else min(elapsed, run_time)
+    return elapsed
+
+
+def get_output(compiler_class, template_cache, name):
+    return compiler_class(template_root=TEMPLATE_ROOT, template_name=name,
+                          template_cache=template_cache,
+                          custom_filters=['unicode_snowmen']).get_output()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='The number of times to compile each template per run.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='The number of runs, the fastest of which is reported.')
+    options = parser.parse_args()
+
+    template_cache = TemplateCache(TEMPLATE_ROOT)
+    template_names = get_compilable_templates(template_cache)
+
+    for name in template_names:
+        if get_output(GetattrJinjaToJS, template_cache, name) != \
+                get_output(JinjaToJS, template_cache, name):
+            raise AssertionError('The baseline compiles %s differently.' % name)
+
+    compiles = options.repeat * len(template_names)
+    print('%d compiles of %d templates per run, fastest of %d runs' % (
+        compiles, len(template_names), options.runs
+    ))
+    print('%-10s %10s %14s' % ('dispatch', 'seconds', 'templates/s'))
+
+    timings = []
+    for label, compiler_class in (('getattr', GetattrJinjaToJS), ('tables', JinjaToJS)):
+        elapsed = time_compiles(compiler_class, template_cache, template_names, options.repeat,
+                                options.runs)
+        timings.append(elapsed)
+        print('%-10s %10.2f %14.1f' % (label, elapsed, compiles / elapsed))
+
+    print('speedup: %.2fx' % (timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
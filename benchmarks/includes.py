@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Compares rendering a template that includes another template for every row in Node when the
+context is shared with included templates and when it is copied for each of them, as it was
+before contexts were shared.
+
+Usage:
+    python -m benchmarks.includes --rows 500 --keys 200 --iterations 200
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import shutil
+import tempfile
+
+from os import path
+
+from .corpus import generate_include_template, generate_include_data
+from .node import compile_modules, render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500,
+                        help='The number of rows, each of which is rendered by an include.')
+    parser.add_argument('--keys', type=int, default=200,
+                        help='The number of other keys in the context.')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='The number of times to render the template.')
+    options = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        template_root = path.join(temp_dir, 'templates')
+        template_names = generate_include_template(template_root)
+        data = generate_include_data(options.rows, options.keys)
+        module_paths = compile_modules(template_root, template_names, path.join(temp_dir, 'out'))
+
+        print('%-8s %12s %10s %18s' % ('context', 'renders/s', 'mean ms', 'allocated/render'))
+
+        for name, copy_context in (('copied', True), ('shared', False)):
+            result = render(module_paths[template_names[0]], data, options.iterations,
+                            copy_context=copy_context)
+            print('%-8s %12.1f %10.3f %18d' % (name, result['rendersPerSecond'], result['meanMs'],
+                                               result['allocatedPerRender']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
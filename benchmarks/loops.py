@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Compares how fast a large table renders in Node when its for loop is compiled to a function call
+per row and when it is compiled to a native `for` loop.
+
+Usage:
+    python -m benchmarks.loops --rows 10000 --iterations 100
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import shutil
+import tempfile
+
+from os import path
+
+from .corpus import generate_table_template, generate_table_data
+from .node import compile_modules, render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='The number of rows in the rendered table.')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='The number of times to render the template.')
+    options = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        template_root = path.join(temp_dir, 'templates')
+        template_name = generate_table_template(template_root)
+        data = generate_table_data(options.rows)
+
+        print('%-8s %12s %10s' % ('loops', 'renders/s', 'mean ms'))
+
+        for name, native_loops in (('each', False), ('native', True)):
+            module_paths = compile_modules(template_root, [template_name],
+                                           path.join(temp_dir, name),
+                                           native_loops=native_loops)
+            result = render(module_paths[template_name], data, options.iterations)
+            print('%-8s %12.1f %10.3f' % (name, result['rendersPerSecond'], result['meanMs']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
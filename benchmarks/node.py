@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for benchmarking the rendering of compiled templates with Node.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from os import path
+
+from jinja_to_js import JinjaToJS
+from jinja_to_js.batch import get_output_path, write_output
+
+from .render_worker import RenderWorker
+
+
+BENCHMARKS_DIR = path.dirname(path.abspath(__file__))
+RUNTIME_PATH = path.join(path.dirname(BENCHMARKS_DIR), 'jinja-to-js-runtime.js')
+
+# The size, in MB, of each half of Node's young generation, which needs to be big enough to hold
+# everything allocated by the renders render_worker.js measures allocation over.
+SEMI_SPACE_SIZE = 128
+
+# The most times a template is rendered before it is timed, so that it has been optimised.
+MAX_WARMUP = 100
+
+
+def compile_modules(template_root, template_names, out_dir, **kwargs):
+    """
+    Compiles `template_names` to CommonJS modules in `out_dir` that import the runtime from this
+    repository.
+
+    Returns:
+        dict: The path of the module written for each template.
+    """
+    kwargs.setdefault('runtime_path', RUNTIME_PATH)
+    module_paths = {}
+    for template_name in template_names:
+        output = JinjaToJS(template_root=template_root, template_name=template_name,
+                           js_module_format='commonjs', **kwargs).get_output()
+        module_paths[template_name] = get_output_path(out_dir, template_name)
+        write_output(module_paths[template_name], output)
+    return module_paths
+
+
+def render(module_path, data, iterations, copy_context=False):
+    """
+    Renders the compiled template at `module_path` `iterations` times with `data`, in a fresh
+    Node process, and returns the timings and memory use reported by render_worker.js. If
+    `copy_context` is True the context is copied for every template rendered, as it was before
+    contexts were shared.
+    """
+    node_args = ['--expose-gc', '--max-semi-space-size=%d' % SEMI_SPACE_SIZE]
+    with RenderWorker(node_args=node_args) as worker:
+        response = worker.render(module_path, data, iterations=iterations,
+                                 warmup=min(iterations, MAX_WARMUP), memory=True,
+                                 copy_context=copy_context)
+    return response['stats']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Compares how fast templates compiled with each output strategy render in Node, and how much heap
+their output uses.
+
+Usage:
+    python -m benchmarks.output_strategy --rows 2000 --iterations 200
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import shutil
+import tempfile
+
+from os import path
+
+from jinja_to_js import OUTPUT_STRATEGIES
+
+from .corpus import generate_table_template, generate_table_data
+from .node import compile_modules, render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='The number of rows in the rendered table.')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='The number of times to render the template.')
+    options = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        template_root = path.join(temp_dir, 'templates')
+        template_name = generate_table_template(template_root)
+        data = generate_table_data(options.rows)
+
+        print('%-18s %12s %10s %16s' % ('strategy', 'renders/s', 'mean ms', 'heap/render'))
+
+        for output_strategy in sorted(OUTPUT_STRATEGIES):
+            module_paths = compile_modules(template_root, [template_name],
+                                           path.join(temp_dir, output_strategy),
+                                           output_strategy=output_strategy)
+            result = render(module_paths[template_name], data, options.iterations)
+            print('%-18s %12.1f %10.3f %16d' % (output_strategy, result['rendersPerSecond'],
+                                                result['meanMs'], result['heapPerRender']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
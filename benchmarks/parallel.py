@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how compiling a template tree scales with the number of worker processes.
+
+Usage:
+    python -m benchmarks.parallel --templates 3000 --max-jobs 8
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from jinja_to_js.batch import compile_tree
+
+from .corpus import generate_corpus
+
+
+def get_job_counts(max_jobs):
+    jobs = 1
+    while jobs < max_jobs:
+        yield jobs
+        jobs *= 2
+    yield max_jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--templates', type=int, default=3000,
+                        help='The number of templates in the synthetic corpus.')
+    parser.add_argument('--max-jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='The largest number of worker processes to try.')
+    parser.add_argument('-m', '--js-module-format', default='commonjs',
+                        help='The JS module format to compile to.')
+    options = parser.parse_args()
+
+    template_root = tempfile.mkdtemp()
+    try:
+        generate_corpus(template_root, templates=options.templates)
+
+        baseline_time = None
+        baseline_results = None
+
+        print('%6s %10s %14s %9s' % ('jobs', 'seconds', 'templates/s', 'speedup'))
+
+        for jobs in get_job_counts(options.max_jobs):
+            start = time.time()
+            results = compile_tree(template_root, jobs=jobs,
+                                   js_module_format=options.js_module_format)
+            elapsed = time.time() - start
+
+            if baseline_results is None:
+                baseline_time = elapsed
+                baseline_results = results
+            elif results != baseline_results:
+                raise AssertionError('Output with %d jobs differs from serial output.' % jobs)
+
+            print('%6d %10.2f %14.1f %8.2fx' % (jobs, elapsed, len(results) / elapsed,
+                                                baseline_time / elapsed))
+    finally:
+        shutil.rmtree(template_root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how quickly templates compiled with each code generation option render in Node, using a
+single long-lived render worker.
+
+Results can be saved as JSON with --output, and compared to an earlier run with --compare.
+
+Usage:
+    python -m benchmarks.render_throughput --rows 500 --output before.json
+    python -m benchmarks.render_throughput --rows 500 --compare before.json
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import collections
+import platform
+import shutil
+import subprocess
+import tempfile
+
+from os import path
+
+from jinja_to_js.minify import collapse_whitespace
+
+from . import add_results_arguments, report_results
+from .corpus import (generate_include_data, generate_include_template, generate_table_data,
+                     generate_table_template)
+from .node import compile_modules
+from .render_worker import RenderWorker
+
+# The code generation options compared, by name.
+VARIANTS = collections.OrderedDict([
+    ('default', {}),
+    ('native_loops', {'native_loops': True}),
+    ('array', {'output_strategy': 'array'}),
+    ('template_literal', {'output_strategy': 'template-literal'}),
+    ('stream', {'output_mode': 'stream'}),
+    ('minify', {'minify': True}),
+    ('inline_includes', {'inline_includes': 100}),
+])
+
+
+def get_templates(template_root, rows):
+    """
+    Writes the templates to render to `template_root`.
+
+    Returns:
+        list of tuple: The name of each template to render, the names of all the templates it
+                       needs and the context to render it with.
+    """
+    table_name = generate_table_template(template_root)
+    include_names = generate_include_template(template_root)
+    return [
+        (table_name, [table_name], generate_table_data(rows)),
+        (include_names[0], include_names, generate_include_data(rows, 50)),
+    ]
+
+
+def run(variant_names, rows, iterations, warmup):
+    """
+    Renders each template compiled with each of `variant_names`.
+
+    Returns:
+        dict: The results, which can be saved as JSON.
+    """
+    temp_dir = tempfile.mkdtemp()
+    results = collections.OrderedDict()
+    try:
+        template_root = path.join(temp_dir, 'templates')
+        templates = get_templates(template_root, rows)
+
+        with RenderWorker() as worker:
+            for template_name, template_names, data in templates:
+                expected = None
+                for variant_name in variant_names:
+                    options = VARIANTS[variant_name]
+                    module_paths = compile_modules(template_root, template_names,
+                                                   path.join(temp_dir, variant_name), **options)
+                    response = worker.render(module_paths[template_name], data,
+                                             iterations=iterations, warmup=warmup,
+                                             stream=options.get('output_mode') == 'stream')
+
+                    # minified templates only differ in the whitespace they output
+                    output = collapse_whitespace(response['output'])[0]
+                    if expected is None:
+                        expected = output
+                    elif output != expected:
+                        raise AssertionError('%s renders %s differently.'
+                                             % (variant_name, template_name))
+
+                    results['%s %s' % (template_name, variant_name)] = response['stats']
+    finally:
+        shutil.rmtree(temp_dir)
+
+    return {
+        'options': {'rows': rows, 'iterations': iterations, 'warmup': warmup},
+        'environment': {
+            'node': subprocess.check_output(['node', '--version']).decode('ascii').strip(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+def print_results(results):
+    print('%-36s %12s %10s %10s' % ('', 'renders/s', 'mean ms', 'median ms'))
+    for name, stats in results['results'].items():
+        print('%-36s %12.1f %10.3f %10.3f' % (name, stats['rendersPerSecond'], stats['meanMs'],
+                                              stats['medianMs']))
+
+
+def get_compared(results):
+    return [(name, stats['rendersPerSecond'], True) for name, stats in results['results'].items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500,
+                        help='The number of rows rendered by each template.')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='The number of times to render each template.')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='The number of times to render each template before timing it.')
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS),
+                        help='The code generation options to compare.')
+    add_results_arguments(parser)
+    options = parser.parse_args()
+
+    results = run(options.variants, options.rows, options.iterations, options.warmup)
+    report_results(options, results, print_results, ('options',), get_compared,
+                   title='renders/s')
+
+
+if __name__ == '__main__':
+    main()
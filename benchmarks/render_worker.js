@@ -0,0 +1,219 @@
+// A long-lived process that renders compiled templates, so that rendering lots of templates (e.g.
+// in the tests) only pays for starting Node once, and that times how quickly they render and how
+// much memory they use.
+//
+// Usage:
+//     node [--expose-gc --max-semi-space-size=128] benchmarks/render_worker.js [--setup=<module>]
+//
+// Reads requests from stdin, one JSON object per line, and writes a JSON object to stdout for
+// each one, in the same order. A request has these keys:
+//
+//     module      The path of a compiled template module.
+//     export      Optional. For a bundle, the name of the template in it to render.
+//     context     The context to render the template with.
+//     iterations  Optional. The number of times to render the template, defaults to 1.
+//     warmup      Optional. The number of times to render the template before timing it.
+//     stream      Optional. True if the template was compiled with output_mode='stream'.
+//     memory      Optional. True to also measure how much each render allocates and how much
+//                 heap its output holds on to, see `measureMemory`.
+//     copyContext Optional. True to make each template copy its context, including when it is
+//                 included by another template, like versions of the runtime before contexts
+//                 were shared did.
+//
+// The response is either {"output": ..., "stats": ...}, with the output of the last render and
+// timings in milliseconds, or {"error": ...} with the stack of the error the template threw.
+// Templates compiled with async_mode=True are awaited.
+//
+// Memory is only measured accurately when Node is run with --expose-gc, and with a young
+// generation big enough to hold everything allocated by ALLOCATION_SAMPLE_SIZE renders, hence
+// --max-semi-space-size.
+//
+// The module given with --setup is loaded once, and can set up the runtime (e.g. add custom
+// filters). If it exports a `prepareContext` function it's called with the context of each
+// request and returns the context to render the template with.
+//
+// Compiled modules are loaded afresh for every request, so a template can be recompiled between
+// requests.
+
+var path = require('path');
+var readline = require('readline');
+
+var jinjaToJS = require('../jinja-to-js-runtime.js');
+
+// The number of rendered results kept alive at once when measuring heap use.
+var HEAP_SAMPLE_SIZE = 50;
+
+// The number of renders to measure allocation over.
+var ALLOCATION_SAMPLE_SIZE = 10;
+
+var setup = {};
+
+process.argv.slice(2).forEach(function (arg) {
+    if (arg.indexOf('--setup=') === 0) {
+        setup = require(path.resolve(arg.substring('--setup='.length)));
+    }
+});
+
+// the modules loaded before any requests are kept when modules are reloaded, so that the runtime
+// set up by the --setup module is the one the templates use
+var initialModules = Object.keys(require.cache);
+
+function loadTemplate(request) {
+    Object.keys(require.cache).forEach(function (key) {
+        if (initialModules.indexOf(key) === -1) {
+            delete require.cache[key];
+        }
+    });
+
+    var template = require(path.resolve(request.module));
+    return request['export'] === undefined ? template : template[request['export']];
+}
+
+function renderOnce(template, context, stream) {
+    if (!stream) {
+        return Promise.resolve(template(context));
+    }
+    var chunks = [];
+    return Promise.resolve(template(context, function (chunk) {
+        chunks.push(chunk);
+    })).then(function () {
+        return chunks.join('');
+    });
+}
+
+function milliseconds(start) {
+    var elapsed = process.hrtime(start);
+    return elapsed[0] * 1e3 + elapsed[1] / 1e6;
+}
+
+function getStats(timings) {
+    var sorted = timings.slice().sort(function (a, b) {
+        return a - b;
+    });
+    var total = timings.reduce(function (sum, timing) {
+        return sum + timing;
+    }, 0);
+    return {
+        iterations: timings.length,
+        totalMs: total,
+        meanMs: total / timings.length,
+        minMs: sorted[0],
+        medianMs: sorted[Math.floor(sorted.length / 2)],
+        maxMs: sorted[sorted.length - 1],
+        rendersPerSecond: timings.length * 1e3 / total
+    };
+}
+
+function gc() {
+    if (global.gc) {
+        global.gc();
+    }
+}
+
+// Measures how much rendering `template` allocates, and how much heap its output holds on to
+// (for string concatenation this includes all the intermediate strings making up the result).
+// The template is called synchronously, so it must not be compiled with async_mode=True or
+// output_mode='stream'.
+function measureMemory(template, context) {
+    var i;
+
+    // everything allocated by these renders is garbage, but it stays in the heap until the next
+    // garbage collection
+    gc();
+    var heapBeforeRenders = process.memoryUsage().heapUsed;
+    for (i = 0; i < ALLOCATION_SAMPLE_SIZE; i++) {
+        template(context);
+    }
+    var allocatedPerRender = (process.memoryUsage().heapUsed - heapBeforeRenders) /
+        ALLOCATION_SAMPLE_SIZE;
+
+    gc();
+    var heapBefore = process.memoryUsage().heapUsed;
+    var results = [];
+    for (i = 0; i < HEAP_SAMPLE_SIZE; i++) {
+        results.push(template(context));
+    }
+    gc();
+    var heapPerRender = (process.memoryUsage().heapUsed - heapBefore) / results.length;
+
+    return {
+        allocatedPerRender: Math.round(allocatedPerRender),
+        heapPerRender: Math.round(heapPerRender),
+        gcExposed: !!global.gc
+    };
+}
+
+function copyContexts() {
+    jinjaToJS.createContext = function (context, locals) {
+        return Object.assign({}, jinjaToJS.globals, context, locals);
+    };
+}
+
+function handle(request) {
+    var template = loadTemplate(request);
+    var context = setup.prepareContext ? setup.prepareContext(request.context) : request.context;
+    var iterations = request.iterations || 1;
+    var warmup = request.warmup || 0;
+    var timings = [];
+    var output;
+
+    function render(remaining, timed) {
+        if (!remaining) {
+            return Promise.resolve();
+        }
+        var start = process.hrtime();
+        return renderOnce(template, context, request.stream).then(function (result) {
+            if (timed) {
+                timings.push(milliseconds(start));
+                output = result;
+            }
+            return render(remaining - 1, timed);
+        });
+    }
+
+    return render(warmup, false).then(function () {
+        gc();
+        return render(iterations, true);
+    }).then(function () {
+        var stats = getStats(timings);
+        if (request.memory) {
+            Object.assign(stats, measureMemory(template, context));
+        }
+        return {output: output, stats: stats};
+    });
+}
+
+function handleWithRuntime(request) {
+    var createContext = jinjaToJS.createContext;
+    if (request.copyContext) {
+        copyContexts();
+    }
+
+    function restore(result) {
+        jinjaToJS.createContext = createContext;
+        return result;
+    }
+
+    return Promise.resolve(request).then(handle).then(restore, function (error) {
+        restore();
+        throw error;
+    });
+}
+
+function respond(response) {
+    process.stdout.write(JSON.stringify(response) + '\n');
+}
+
+// requests are handled one at a time, so that the timings of one aren't affected by another
+var queue = Promise.resolve();
+
+readline.createInterface({input: process.stdin}).on('line', function (line) {
+    if (!line.trim()) {
+        return;
+    }
+    queue = queue.then(function () {
+        return handleWithRuntime(JSON.parse(line));
+    }).then(respond, function (error) {
+        respond({error: error && error.stack ? error.stack : String(error)});
+    });
+});
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Renders compiled templates with Node, for the tests and the benchmarks. It doesn't import
+jinja_to_js, so the tests can use it without depending on the rest of the benchmarks.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import subprocess
+
+from os import path
+
+
+RENDER_WORKER_PATH = path.join(path.dirname(path.abspath(__file__)), 'render_worker.js')
+
+
+class RenderError(Exception):
+    """
+    Raised when a template rendered by a `RenderWorker` throws an error.
+    """
+
+
+class RenderWorker(object):
+    """
+    A Node process, running render_worker.js, that compiled templates can be rendered by one
+    after another without starting Node for each of them. See render_worker.js for the
+    details of the requests it handles.
+    """
+
+    def __init__(self, setup_path=None, json_encoder=None, node_args=()):
+        """
+        Args:
+            setup_path (str, optional): The path of a module for the worker to load before
+                                        rendering anything, e.g. to add custom filters.
+            json_encoder (type, optional): A `json.JSONEncoder` subclass to encode contexts with.
+            node_args (iterable of str, optional): Extra arguments to run Node with.
+        """
+        args = ['node'] + list(node_args) + [RENDER_WORKER_PATH]
+        if setup_path:
+            args.append('--setup=' + setup_path)
+        self.json_encoder = json_encoder
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def render(self, module_path, context, iterations=1, warmup=0, stream=False,
+               export=None, memory=False, copy_context=False):
+        """
+        Renders the compiled template at `module_path` with `context`.
+
+        Args:
+            module_path (str): The path of the compiled template module.
+            context (dict): The context to render the template with.
+            iterations (int, optional): The number of times to render the template.
+            warmup (int, optional): The number of times to render the template before timing it.
+            stream (bool, optional): True if the template was compiled with
+                                     `output_mode='stream'`.
+            export (str, optional): For a bundle, the name of the template in it to render.
+            memory (bool, optional): If True the memory used by each render is measured too,
+                                     which needs Node to be run with `--expose-gc`.
+            copy_context (bool, optional): If True the context is copied for every template
+                                           rendered, as it was before contexts were shared.
+
+        Returns:
+            dict: The output of the template, as 'output', and the timings of the renders, in
+                  milliseconds, along with any memory measurements, as 'stats'.
+        """
+        request = {
+            'module': module_path,
+            'context': context,
+            'iterations': iterations,
+            'warmup': warmup,
+            'stream': stream,
+            'memory': memory,
+            'copyContext': copy_context,
+        }
+        if export is not None:
+            request['export'] = export
+
+        line = json.dumps(request, cls=self.json_encoder) + '\n'
+        self.process.stdin.write(line.encode('utf-8'))
+        self.process.stdin.flush()
+
+        response = self.process.stdout.readline()
+        if not response:
+            raise RenderError('The render worker exited with %s.' % self.process.wait())
+
+        response = json.loads(response.decode('utf-8'))
+        if 'error' in response:
+            raise RenderError(response['error'])
+        return response
+
+    def close(self):
+        """
+        Stops the worker.
+        """
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
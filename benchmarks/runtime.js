@@ -0,0 +1,161 @@
+// Micro-benchmarks for the runtime functions called most often by compiled templates.
+//
+// Usage:
+//     node benchmarks/runtime.js [seconds per benchmark] [--filter=<substring>]
+//
+// Each benchmark calls a function with every value in a mix of inputs, covering each kind of
+// value templates commonly see, and `escape` is called with strings of different lengths with and
+// without characters to escape. 'type (toString regex)' times how `runtime.type` used to work,
+// for comparison.
+//
+// Prints a JSON object mapping the name of each benchmark to its results to stdout.
+
+var jinjaToJS = require('../jinja-to-js-runtime.js');
+
+var runtime = jinjaToJS.runtime;
+
+var OBJECT_TYPE_REGEX = /\[object (.*?)]/;
+
+function Point(x, y) {
+    this.x = x;
+    this.y = y;
+}
+
+// A mix of the values templates test, compare and output.
+var VALUES = [
+    'a string',
+    '',
+    42,
+    0,
+    NaN,
+    true,
+    false,
+    null,
+    undefined,
+    [1, 2, 3],
+    [],
+    {name: 'John', age: 40},
+    {},
+    new Point(1, 2),
+    new Date(0),
+    function () {}
+];
+
+var NESTED = {
+    title: 'Page',
+    items: [{id: 1, tags: ['a', 'b']}, {id: 2, tags: []}, {id: 3, tags: ['c']}],
+    meta: {author: {name: 'Paul'}, published: true}
+};
+
+var NESTED_COPY = JSON.parse(JSON.stringify(NESTED));
+
+// Strings to escape: short and long ones, either clean (nothing to escape, like most values) or
+// dirty (containing characters to escape).
+var ESCAPE_INPUTS = {
+    'short clean': 'John Smith',
+    'short dirty': 'Tom & Jerry',
+    'long clean': new Array(201).join('Plain text without anything to escape. '),
+    'long dirty': new Array(201).join('<a href="/search?q=tom&jerry">Tom\'s `page`</a> ')
+};
+
+var BENCHMARKS = {
+    'type': function () {
+        for (var i = 0; i < VALUES.length; i++) {
+            runtime.type(VALUES[i]);
+        }
+    },
+    'type (toString regex)': function () {
+        for (var i = 0; i < VALUES.length; i++) {
+            Object.prototype.toString.call(VALUES[i]).match(OBJECT_TYPE_REGEX);
+        }
+    },
+    'boolean': function () {
+        for (var i = 0; i < VALUES.length; i++) {
+            runtime.boolean(VALUES[i]);
+        }
+    },
+    'isEqual (primitives)': function () {
+        for (var i = 0; i < VALUES.length; i++) {
+            runtime.isEqual(VALUES[i], 42);
+        }
+    },
+    'isEqual (nested)': function () {
+        runtime.isEqual(NESTED, NESTED_COPY);
+    },
+    'escape (number)': function () {
+        runtime.escape(42);
+    },
+    'str': function () {
+        for (var i = 0; i < VALUES.length; i++) {
+            runtime.str(VALUES[i]);
+        }
+    }
+};
+
+Object.keys(ESCAPE_INPUTS).forEach(function (name) {
+    var input = ESCAPE_INPUTS[name];
+    BENCHMARKS['escape (' + name + ')'] = function () {
+        runtime.escape(input);
+    };
+});
+
+// The number of calls made between checking how long a benchmark has been running.
+var BATCH_SIZE = 1000;
+
+function seconds(start) {
+    var elapsed = process.hrtime(start);
+    return elapsed[0] + elapsed[1] / 1e9;
+}
+
+// Calls `fn` repeatedly for about `duration` seconds, returning the number of calls made and how
+// long they took.
+function time(fn, duration) {
+    var i;
+
+    // warm up so that the function has been optimised before it is timed
+    for (i = 0; i < BATCH_SIZE; i++) {
+        fn();
+    }
+
+    var iterations = 0;
+    var start = process.hrtime();
+    do {
+        for (i = 0; i < BATCH_SIZE; i++) {
+            fn();
+        }
+        iterations += BATCH_SIZE;
+    } while (seconds(start) < duration);
+
+    return {iterations: iterations, seconds: seconds(start)};
+}
+
+function main(args) {
+    var filter = '';
+    args = args.filter(function (arg) {
+        if (arg.indexOf('--filter=') === 0) {
+            filter = arg.slice('--filter='.length);
+            return false;
+        }
+        return true;
+    });
+
+    var duration = parseFloat(args[0] || '0.5');
+    var results = {};
+
+    Object.keys(BENCHMARKS).forEach(function (name) {
+        if (name.indexOf(filter) === -1) {
+            return;
+        }
+        var timing = time(BENCHMARKS[name], duration);
+        results[name] = {
+            iterations: timing.iterations,
+            seconds: timing.seconds,
+            callsPerSecond: timing.iterations / timing.seconds,
+            nsPerCall: timing.seconds * 1e9 / timing.iterations
+        };
+    });
+
+    process.stdout.write(JSON.stringify(results, null, 2) + '\n');
+}
+
+main(process.argv.slice(2));
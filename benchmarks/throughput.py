@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how quickly a synthetic template tree compiles, timing the construction of `JinjaToJS`
+and `get_output` for every template. Reports templates compiled per second, the peak memory
+allocated while compiling (measured separately, with tracemalloc) and the size of the output.
+
+Results can be saved as JSON with --output, and compared to an earlier run with --compare.
+
+Usage:
+    python -m benchmarks.throughput --templates 500 --output before.json
+    python -m benchmarks.throughput --templates 500 --compare before.json
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import platform
+import shutil
+import tempfile
+import timeit
+
+import jinja2
+
+from jinja_to_js import OUTPUT_STRATEGIES, JinjaToJS, TemplateCache
+
+from . import add_results_arguments, report_results
+from .corpus import generate_compile_corpus
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# The results compared by --compare, with how they are labelled and whether bigger is better.
+COMPARED_RESULTS = (
+    ('templates_per_second', 'templates/s', True),
+    ('peak_memory', 'peak memory (bytes)', False),
+    ('output_bytes', 'output (bytes)', False),
+)
+
+
+def compile_templates(template_root, template_names, **kwargs):
+    """
+    Compiles `template_names` the way `jinja_to_js.batch.compile_tree` does, sharing a single
+    `TemplateCache`.
+
+    Returns:
+        tuple: The number of seconds compiling took and the generated code for each template.
+    """
+    template_cache = TemplateCache(template_root)
+    start = timeit.default_timer()
+    outputs = [
+        JinjaToJS(template_root=template_root, template_name=name,
+                  template_cache=template_cache, **kwargs).get_output()
+        for name in template_names
+    ]
+    return timeit.default_timer() - start, outputs
+
+
+def measure_peak_memory(template_root, template_names, **kwargs):
+    """
+    Returns the peak number of bytes allocated while compiling `template_names`, or None if
+    tracemalloc isn't available.
+    """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        compile_templates(template_root, template_names, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(corpus_options, compile_options, repeat=5):
+    """
+    Generates a corpus with `corpus_options`, the arguments of `generate_compile_corpus`, and
+    compiles it `repeat` times with `compile_options`.
+
+    Returns:
+        dict: The results, which can be saved as JSON.
+    """
+    template_root = tempfile.mkdtemp()
+    try:
+        template_names = generate_compile_corpus(template_root, **corpus_options)
+
+        timings = []
+        outputs = None
+        for _ in range(repeat):
+            seconds, outputs = compile_templates(template_root, template_names,
+                                                 **compile_options)
+            timings.append(seconds)
+
+        peak_memory = measure_peak_memory(template_root, template_names, **compile_options)
+    finally:
+        shutil.rmtree(template_root)
+
+    best = min(timings)
+    return {
+        'corpus': corpus_options,
+        'compile_options': compile_options,
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'jinja2': jinja2.__version__,
+            'platform': platform.platform(),
+        },
+        'results': {
+            'templates': len(template_names),
+            'timings': timings,
+            'best_seconds': best,
+            'templates_per_second': len(template_names) / best,
+            'peak_memory': peak_memory,
+            'output_bytes': sum(len(output.encode('utf-8')) for output in outputs),
+        },
+    }
+
+
+def print_results(results):
+    for key, label, _ in COMPARED_RESULTS:
+        value = results['results'][key]
+        print('%-22s %14s' % (label, 'n/a' if value is None else '%.1f' % value))
+
+
+def get_compared(results):
+    return [(label, results['results'][key], bigger_is_better)
+            for key, label, bigger_is_better in COMPARED_RESULTS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--templates', type=int, default=500,
+                        help='The number of templates in the synthetic corpus.')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='How deeply loops and conditions are nested in each template.')
+    parser.add_argument('--fan-out', type=int, default=2,
+                        help='The number of partials included by each page and partial.')
+    parser.add_argument('--extends-depth', type=int, default=2,
+                        help='The length of the chain of layouts each page extends.')
+    parser.add_argument('--filter-density', type=float, default=0.5,
+                        help='The average number of filters applied to each expression.')
+    parser.add_argument('--partials', type=int, default=20,
+                        help='The number of partials on each level.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed for generating the corpus.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of times to compile the corpus, the best time is used.')
+    parser.add_argument('-m', '--js-module-format', default='commonjs',
+                        help='The JS module format to compile to.')
+    parser.add_argument('-s', '--output-strategy', choices=sorted(OUTPUT_STRATEGIES),
+                        default='concat',
+                        help='How the generated code builds up its output.')
+    parser.add_argument('-n', '--native-loops', action='store_true',
+                        help='Compile for loops to plain JavaScript for loops.')
+    add_results_arguments(parser)
+    options = parser.parse_args()
+
+    corpus_options = {
+        'templates': options.templates,
+        'depth': options.depth,
+        'fan_out': options.fan_out,
+        'extends_depth': options.extends_depth,
+        'filter_density': options.filter_density,
+        'partials': options.partials,
+        'seed': options.seed,
+    }
+    compile_options = {
+        'js_module_format': options.js_module_format,
+        'output_strategy': options.output_strategy,
+        'native_loops': options.native_loops,
+    }
+
+    results = run(corpus_options, compile_options, repeat=options.repeat)
+    report_results(options, results, print_results, ('corpus', 'compile_options'), get_compared)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,15 +11,41 @@
 
 }(this, function (exports) {
 
-    function escaper(match) {
-        return {
-            '&': '&amp;',
-            '<': '&lt;',
-            '>': '&gt;',
-            '"': '&#34;',
-            "'": '&#x27;',
-            '`': '&#x60;'
-        }[match];
+    // Returns `str` with the characters from `start` onwards escaped, building a new string only
+    // if there is anything to escape.
+    function escapeFrom(str, start) {
+        var result = '';
+        var last = 0;
+        var replacement;
+
+        for (var i = start; i < str.length; i++) {
+            switch (str.charCodeAt(i)) {
+                case 38: // &
+                    replacement = '&amp;';
+                    break;
+                case 60: // <
+                    replacement = '&lt;';
+                    break;
+                case 62: // >
+                    replacement = '&gt;';
+                    break;
+                case 34: // "
+                    replacement = '&#34;';
+                    break;
+                case 39: // '
+                    replacement = '&#x27;';
+                    break;
+                case 96: // `
+                    replacement = '&#x60;';
+                    break;
+                default:
+                    continue;
+            }
+            result += last === i ? replacement : str.slice(last, i) + replacement;
+            last = i + 1;
+        }
+
+        return last === 0 ? str : result + str.slice(last);
     }
 
     function objectAssignPolyfill(target, varArgs) { // .length of function is 2
@@ -53,12 +79,54 @@
         var objectAssign = Object.assign;
     }
 
-    var ESCAPE_TEST_REGEX = /(?:&|<|>|"|'|`)/;
-    var ESCAPE_REPLACE_REGEX = new RegExp(ESCAPE_TEST_REGEX.source, 'g');
+    var ESCAPE_REGEX = /[&<>"'`]/;
     var OBJECT_TYPE_REGEX = /\[object (.*?)]/;
+    var TO_STRING_TAG = typeof Symbol === 'function' ? Symbol.toStringTag : null;
+
+    // used to time the parts of templates compiled with instrument=True
+    var now = typeof performance !== 'undefined' && typeof performance.now === 'function' ?
+        function () { return performance.now(); } :
+        function () { return Date.now(); };
+
+    // Returns true if `o` is an object created by an object literal, `JSON.parse` or
+    // `Object.create(null)`, which `Object.prototype.toString` always describes as an 'Object'.
+    function isPlainObject(o) {
+        var proto = Object.getPrototypeOf(o);
+        return (proto === Object.prototype || proto === null) &&
+            !(TO_STRING_TAG && TO_STRING_TAG in o);
+    }
+
+    // Every context created by `createContext` inherits from this object, which in turn inherits
+    // from the globals.
+    var contextPrototype = null;
+
+    function getContextPrototype() {
+        // `exports.globals` may have been replaced since the prototype was created
+        if (!contextPrototype || Object.getPrototypeOf(contextPrototype) !== exports.globals) {
+            contextPrototype = Object.create(exports.globals);
+        }
+        return contextPrototype;
+    }
+
+    // Returns the context for a render of a template. When a template is rendered directly the
+    // data it is given is copied onto a new object inheriting from the globals, so the globals
+    // themselves are never copied. An included template is given the context of the template
+    // including it, which it shares, with any of the including template's variables in `locals`
+    // added to a thin child scope.
+    exports.createContext = function (context, locals) {
+        var proto = getContextPrototype();
+        var scope;
+
+        if (proto.isPrototypeOf(context)) {
+            if (!locals) {
+                return context;
+            }
+            scope = Object.create(context);
+        } else {
+            scope = objectAssign(Object.create(proto), context);
+        }
 
-    exports.createContext = function (context) {
-        return objectAssign({}, exports.globals, context);
+        return locals ? objectAssign(scope, locals) : scope;
     };
 
     exports.filters = {
@@ -202,9 +270,67 @@
     // You may override this to provide custom methods within the templates
     exports.globals = {};
 
+    // Templates compiled with instrument=True call this, if it's set, with the name of a
+    // template, a line in it, a label for what is on that line (e.g. 'block content') and the
+    // number of milliseconds spent rendering it.
+    exports.onProfile = null;
+
+    // Returns a function to set as `onProfile` that adds up the time spent rendering each
+    // instrumented part of a template. Its `results` property maps keys made of the template
+    // name, line and label to objects with `template`, `line`, `label`, `calls`, `totalMs` and
+    // `maxMs` properties.
+    exports.createProfiler = function () {
+        var results = {};
+
+        function onProfile(templateName, line, label, ms) {
+            var key = templateName + ':' + line + ' ' + label;
+            var result = results[key];
+            if (!result) {
+                result = results[key] = {
+                    template: templateName,
+                    line: line,
+                    label: label,
+                    calls: 0,
+                    totalMs: 0,
+                    maxMs: 0
+                };
+            }
+            result.calls++;
+            result.totalMs += ms;
+            if (ms > result.maxMs) {
+                result.maxMs = ms;
+            }
+        }
+
+        onProfile.results = results;
+        return onProfile;
+    };
+
     var runtime = exports.runtime = {
 
+        // Returns the class of `o` as given by `Object.prototype.toString`, e.g. 'Array'. The
+        // common kinds of value are handled without building the string and matching it.
         type: function (o) {
+            switch (typeof o) {
+                case 'string':
+                    return 'String';
+                case 'number':
+                    return 'Number';
+                case 'boolean':
+                    return 'Boolean';
+                case 'undefined':
+                    return 'Undefined';
+                case 'object':
+                    if (o === null) {
+                        return 'Null';
+                    }
+                    if (Array.isArray(o)) {
+                        return 'Array';
+                    }
+                    if (isPlainObject(o)) {
+                        return 'Object';
+                    }
+            }
             return Object.prototype.toString.call(o).match(OBJECT_TYPE_REGEX)[1];
         },
 
@@ -212,8 +338,8 @@
             if (!o) {
                 return false;
             }
-            if (o === true) {
-                return o;
+            if (o === true || typeof o !== 'object') {
+                return true;
             }
             if (Array.isArray(o)) {
                 return o.length > 0;
@@ -221,7 +347,7 @@
             if (runtime.type(o) === 'Object') {
                 return Object.keys(o).length > 0;
             }
-            return !!o;
+            return true;
         },
 
         each: function (obj, fn) {
@@ -238,8 +364,15 @@
             });
         },
 
+        keys: function (obj) {
+            try {
+                return Object.keys(obj);
+            } catch (e) {
+                return [];
+            }
+        },
+
         isEqual: function (objA, objB) {
-            var typeA;
             var keysA;
             var i;
 
@@ -247,15 +380,15 @@
                 return true;
             }
 
-            typeA = runtime.type(objA);
-
-            if (typeA !== runtime.type(objB)) {
+            // only arrays and objects can be equal without being identical
+            if (objA === null || objB === null ||
+                    typeof objA !== 'object' || typeof objB !== 'object') {
                 return false;
             }
 
-            if (typeA === 'Array') {
+            if (Array.isArray(objA)) {
 
-                if (objA.length !== objB.length) {
+                if (!Array.isArray(objB) || objA.length !== objB.length) {
                     return false;
                 }
 
@@ -268,7 +401,7 @@
                 return true;
             }
 
-            if (runtime.type(objA) === 'Object') {
+            if (runtime.type(objA) === 'Object' && runtime.type(objB) === 'Object') {
                 keysA = Object.keys(objA);
 
                 if (keysA.length !== Object.keys(objB).length) {
@@ -287,9 +420,51 @@
             return false;
         },
 
-        escape: function (str) {
-            str = str == null ? '' : '' + str;
-            return ESCAPE_TEST_REGEX.test(str) ? str.replace(ESCAPE_REPLACE_REGEX, escaper) : str;
+        // Returns the promise `p` of the output of a template included by an async template,
+        // which awaits it at the end of its own output. Rejections are only reported then, rather
+        // than as unhandled in the meantime.
+        defer: function (p) {
+            p.then(null, function () {});
+            return p;
+        },
+
+        // Called by templates compiled with instrument=True before rendering an instrumented
+        // part of a template. Only reads the time if there is an `onProfile` hook.
+        probeStart: function () {
+            return exports.onProfile ? now() : -1;
+        },
+
+        // Called by templates compiled with instrument=True after rendering an instrumented part
+        // of a template, with the value returned by `probeStart`.
+        probeEnd: function (templateName, line, label, start) {
+            if (start >= 0 && exports.onProfile) {
+                exports.onProfile(templateName, line, label, now() - start);
+            }
+        },
+
+        // Returns `o` or an empty string if `o` is null or undefined.
+        str: function (o) {
+            return o == null ? '' : o;
+        },
+
+        escape: function (value) {
+            var start;
+
+            if (typeof value !== 'string') {
+                if (typeof value === 'number' || typeof value === 'boolean') {
+                    // these never contain anything to escape
+                    return '' + value;
+                }
+                if (value == null) {
+                    return '';
+                }
+                value = '' + value;
+            }
+
+            // finding the first character to escape with a regex is much quicker than checking
+            // each character in turn, and most strings don't have one at all
+            start = value.search(ESCAPE_REGEX);
+            return start === -1 ? value : escapeFrom(value, start);
         }
 
     };
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import collections
 import contextlib
 import json
+import math
 import re
 import os
 
@@ -11,6 +13,11 @@ from os import path
 from jinja2 import Environment, FileSystemLoader, nodes
 import six
 
+from .ir import Append, Block, Call, Conditional, Emitter, FlushStream, Loop, optimize
+from .minify import collapse_whitespace, minify_code
+from .profile import FILTER, NODE, TEST, CompileStats
+from .sourcemap import MARKER_END, MARKER_START, inline_source_map, make_source_map, marker
+
 
 OPERANDS = {
     'eq': '===',
@@ -28,6 +35,42 @@ DICT_ITER_METHODS = (
     'keys'
 )
 
+# The characters escaped by the runtime's `escape` function and what they are replaced with.
+HTML_ESCAPES = (
+    ('&', '&amp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ('"', '&#34;'),
+    ("'", '&#x27;'),
+    ('`', '&#x60;')
+)
+
+# Integers with a larger magnitude than this can't be represented exactly by JavaScript numbers.
+MAX_SAFE_INTEGER = 2 ** 53 - 1
+
+# Nodes whose generated JavaScript always evaluates to a number or a boolean.
+NUMBER_OR_BOOLEAN_NODES = (
+    nodes.Sub,
+    nodes.Mul,
+    nodes.Div,
+    nodes.FloorDiv,
+    nodes.Mod,
+    nodes.Neg,
+    nodes.Compare,
+    nodes.Not,
+    nodes.Test
+)
+
+# Filters that always return a number, provided their arguments are numbers.
+NUMBER_FILTERS = (
+    'abs',
+    'int',
+    'length'
+)
+
+# Returned by `get_constant_value` for nodes that don't have a value at compile time.
+NOT_CONSTANT = object()
+
 STATE_DEFAULT = 0
 STATE_EXECUTING = 1
 STATE_INTERPOLATING = 2
@@ -45,6 +88,23 @@ LOOP_HELPERS = (
     LOOP_HELPER_LENGTH
 )
 
+# Names that can't be used for the JavaScript variables that template variables are held in,
+# either because they are reserved words or because the generated code relies on them.
+RESERVED_VAR_NAMES = frozenset((
+    'Array', 'Infinity', 'JSON', 'Math', 'NaN', 'Object', 'arguments', 'await', 'break', 'case',
+    'catch', 'class', 'const', 'context', 'continue', 'ctx', 'debugger', 'default', 'delete',
+    'do', 'else', 'enum', 'eval', 'export', 'extends', 'false', 'finally', 'for', 'function',
+    'if', 'implements', 'import', 'in', 'instanceof', 'interface', 'isNaN', 'jinjaToJS', 'let',
+    'locals', 'new', 'null', 'package', 'private', 'protected', 'public', 'return', 'static',
+    'super', 'switch', 'this', 'throw', 'true', 'try', 'typeof', 'undefined', 'var', 'void',
+    'while', 'with', 'yield'
+))
+
+# The prefixes of the names of the methods that handle nodes, filters and tests.
+NODE_HANDLER_PREFIX = '_process_'
+FILTER_HANDLER_PREFIX = '_process_filter_'
+TEST_HANDLER_PREFIX = '_process_test_'
+
 
 def amd_format(dependencies, template_function):
     result = 'define(['
@@ -77,18 +137,75 @@ JS_MODULE_FORMATS = {
 }
 
 
+def concat_expression(appends):
+    """
+    Returns a JavaScript expression concatenating a list of (is_static, value) tuples, see
+    `OutputStrategy`.
+    """
+    parts = [js_string(value) if is_static else value for is_static, value in appends]
+
+    # make sure the expression is a string concatenation even if the first thing being
+    # appended is a number
+    if not appends[0][0]:
+        parts.insert(0, '""')
+
+    return ' + '.join(parts)
+
+
+def concat_append(appends):
+    return '__result += ' + concat_expression(appends) + ';'
+
+
+def array_append(appends):
+    parts = [js_string(value) if is_static else value for is_static, value in appends]
+    return '__result.push(' + ','.join(parts) + ');'
+
+
+def template_literal_append(appends):
+    parts = [template_literal_text(value) if is_static else '${' + value + '}'
+             for is_static, value in appends]
+    return '__result += `' + ''.join(parts) + '`;'
+
+
+# How the result of a template is built up.
+#   append: A function returning the code to append a list of (is_static, value) tuples to
+#           the result. Static values are text and the rest are JavaScript expressions.
+#   initial_value: The code for the initial value of the `__result` variable.
+#   result: The code for the final output given the `__result` variable.
+OutputStrategy = collections.namedtuple('OutputStrategy', ('append', 'initial_value', 'result'))
+
+OUTPUT_STRATEGIES = {
+    'concat': OutputStrategy(concat_append, '""', '__result'),
+    'array': OutputStrategy(array_append, '[]', '__result.join("")'),
+    'template-literal': OutputStrategy(template_literal_append, '""', '__result'),
+}
+
+
+# In the 'string' output mode the template function returns its output. In the 'stream' mode it
+# is passed a `write(chunk)` function, as its second argument, that it calls with its output a
+# piece at a time.
+OUTPUT_MODE_STRING = 'string'
+OUTPUT_MODE_STREAM = 'stream'
+OUTPUT_MODES = (
+    OUTPUT_MODE_STRING,
+    OUTPUT_MODE_STREAM
+)
+
+# Declared at the start of minified templates, for the short forms of interpolations.
+MINIFIED_HELPERS = 'var __escape = __runtime.escape, __str = __runtime.str;'
+
 # This string has to double all the '{' and '}' due to Python's string formatting.
 # See - https://docs.python.org/2/library/string.html#formatstrings
 TEMPLATE_WRAPPER = """
-function {function_name}(ctx) {{
-    var __result = "";
+{function_type} {function_name}({parameters}) {{
+    var __result = {initial_value};
     var __tmp;
     var __runtime = jinjaToJS.runtime;
     var __filters = jinjaToJS.filters;
     var __globals = jinjaToJS.globals;
-    var context = jinjaToJS.createContext(ctx);
+    var context = jinjaToJS.createContext(ctx, locals);
     {template_code}
-    return __result;
+    {template_end}
 }}
 """
 
@@ -144,6 +261,19 @@ def is_method_call(node, method_name):
     return method == method_name
 
 
+def get_loop_targets(node):
+    """
+    Returns the nodes for the names assigned to by the for loop `node`. If there are two, as in
+    `{% for key, value in foo.items() %}`, they are returned value first, then key, which is the
+    order JavaScript iterations use.
+    """
+    if isinstance(node.target, nodes.Tuple):
+        if len(node.target.items) > 2:
+            raise Exception('De-structuring more than 2 items is not supported.')
+        return list(reversed(node.target.items))
+    return [node.target]
+
+
 def is_loop_helper(node):
     """
     Returns True is node is a loop helper e.g. {{ loop.index }} or {{ loop.first }}
@@ -151,6 +281,280 @@ def is_loop_helper(node):
     return hasattr(node, 'node') and isinstance(node.node, nodes.Name) and node.node.name == 'loop'
 
 
+def js_string(value):
+    """
+    Returns `value` as a JavaScript string literal.
+    """
+    # U+2028 and U+2029 are valid in JSON but not in older JavaScript string literals, and
+    # U+E000 and U+E001 would be mistaken for the markers used for source maps
+    return json.dumps(value, ensure_ascii=False).replace(
+        '\u2028', '\\u2028'
+    ).replace(
+        '\u2029', '\\u2029'
+    ).replace(
+        MARKER_START, '\\ue000'
+    ).replace(
+        MARKER_END, '\\ue001'
+    )
+
+
+def template_literal_text(value):
+    """
+    Returns `value` escaped so that it can be used as text inside a JavaScript template literal.
+    """
+    return value.replace(
+        '\\', '\\\\'
+    ).replace(
+        '`', '\\`'
+    ).replace(
+        '${', '\\${'
+    ).replace(
+        '\r', '\\r'
+    ).replace(
+        '\n', '\\n'
+    ).replace(
+        MARKER_START, '\\ue000'
+    ).replace(
+        MARKER_END, '\\ue001'
+    )
+
+
+def escape_html(value):
+    """
+    Escapes `value` in exactly the same way as the runtime's `escape` function.
+    """
+    for char, replacement in HTML_ESCAPES:
+        value = value.replace(char, replacement)
+    return value
+
+
+def is_number(value):
+    return isinstance(value, six.integer_types + (float,)) and not isinstance(value, bool)
+
+
+def to_js_string(value):
+    """
+    Returns what `"" + value` would evaluate to in JavaScript, with None standing in for `null`
+    as it does when interpolating, or None if that can't be reliably worked out at compile time.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, six.string_types):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.integer_types):
+        return str(value) if abs(value) <= MAX_SAFE_INTEGER else None
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) <= MAX_SAFE_INTEGER:
+            return str(int(value))
+        # Python and JavaScript both use the shortest representation that round-trips, but
+        # format exponents differently
+        value = repr(value)
+        return None if 'e' in value or 'n' in value else value
+    return None
+
+
+def _fold_add(left, right):
+    if (is_number(left) and is_number(right)) or (
+            isinstance(left, six.string_types) and isinstance(right, six.string_types)):
+        return left + right
+    return NOT_CONSTANT
+
+
+def _fold_div(left, right):
+    return float(left) / right if right else NOT_CONSTANT
+
+
+def _fold_floordiv(left, right):
+    return math.floor(float(left) / right) if right else NOT_CONSTANT
+
+
+def _fold_mod(left, right):
+    # JavaScript and Python disagree on the sign of the result when an operand is negative
+    return left % right if left >= 0 and right > 0 else NOT_CONSTANT
+
+
+# Functions that fold math nodes whose operands are both constant. Except for `Add`, they are
+# only called with numbers.
+MATH_FOLDERS = {
+    nodes.Add: _fold_add,
+    nodes.Sub: lambda left, right: left - right,
+    nodes.Mul: lambda left, right: left * right,
+    nodes.Div: _fold_div,
+    nodes.FloorDiv: _fold_floordiv,
+    nodes.Mod: _fold_mod,
+}
+
+COMPARISON_FOLDERS = {
+    'eq': lambda left, right: left == right,
+    'ne': lambda left, right: left != right,
+    'lt': lambda left, right: left < right,
+    'gt': lambda left, right: left > right,
+    'lteq': lambda left, right: left <= right,
+    'gteq': lambda left, right: left >= right,
+}
+
+
+def get_constant_value(node):
+    """
+    Returns the value `node` evaluates to in the generated JavaScript if it can be worked out at
+    compile time, otherwise `NOT_CONSTANT`. Only constants, negation and math or comparisons on
+    constants are folded, and only where JavaScript and Python agree on the result.
+    """
+    if isinstance(node, nodes.Const):
+        return node.value
+
+    if isinstance(node, nodes.Neg):
+        value = get_constant_value(node.node)
+        return -value if is_number(value) else NOT_CONSTANT
+
+    folder = MATH_FOLDERS.get(node.__class__)
+    if folder is not None:
+        left = get_constant_value(node.left)
+        right = get_constant_value(node.right)
+        if left is NOT_CONSTANT or right is NOT_CONSTANT:
+            return NOT_CONSTANT
+        if not isinstance(node, nodes.Add) and not (is_number(left) and is_number(right)):
+            return NOT_CONSTANT
+        value = folder(left, right)
+
+        # make sure the result is something JavaScript would have calculated exactly the same
+        if isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+            return NOT_CONSTANT
+        if isinstance(value, six.integer_types) and abs(value) > MAX_SAFE_INTEGER:
+            return NOT_CONSTANT
+        return value
+
+    if isinstance(node, nodes.Compare) and len(node.ops) == 1 and \
+            node.ops[0].op in COMPARISON_FOLDERS:
+        operand = node.ops[0]
+        left = get_constant_value(node.expr)
+        right = get_constant_value(operand.expr)
+        if left is NOT_CONSTANT or right is NOT_CONSTANT:
+            return NOT_CONSTANT
+        if is_number(left) and is_number(right):
+            return COMPARISON_FOLDERS[operand.op](left, right)
+        # strings are ordered differently by JavaScript and Python when they contain characters
+        # outside of the BMP, so only equality is folded
+        if isinstance(left, six.string_types) and isinstance(right, six.string_types) and \
+                operand.op in ('eq', 'ne'):
+            return COMPARISON_FOLDERS[operand.op](left, right)
+
+    return NOT_CONSTANT
+
+
+def create_environment(template_root):
+    """
+    Returns a Jinja `Environment` configured the way jinja-to-js expects, loading templates
+    from `template_root`.
+    """
+    return Environment(loader=FileSystemLoader(template_root),
+                       autoescape=True,
+                       extensions=['jinja2.ext.with_', 'jinja2.ext.autoescape'])
+
+
+class TemplateCache(object):
+    """
+    Loads and parses templates from a template root, holding on to the results so that a single
+    `Environment` and loader can be shared by many compiles and each template is only read and
+    parsed once.
+    """
+
+    def __init__(self, template_root, environment=None):
+        """
+        Args:
+            template_root (str): The path to where templates should be loaded from.
+            environment (jinja2.Environment, optional): The environment to load templates with.
+                                                        Defaults to one created by
+                                                        `create_environment`.
+        """
+        self.template_root = template_root
+        self.environment = environment or create_environment(template_root)
+        self._sources = {}
+        self._asts = {}
+
+    def get_source(self, template_name):
+        """
+        Returns a tuple of the source of `template_name` and the absolute path it was loaded from.
+
+        Raises:
+            jinja2.exceptions.TemplateNotFound
+        """
+        if template_name not in self._sources:
+            source, template_path, _ = self.environment.loader.get_source(
+                self.environment, template_name
+            )
+            self._sources[template_name] = (source, template_path)
+        return self._sources[template_name]
+
+    def parse(self, template_name):
+        """
+        Returns the AST of `template_name`. The same AST is returned every time so it must not be
+        modified.
+        """
+        if template_name not in self._asts:
+            source, _ = self.get_source(template_name)
+            self._asts[template_name] = self.environment.parse(source)
+        return self._asts[template_name]
+
+    def invalidate(self, template_name):
+        """
+        Forgets the cached source and AST of `template_name`, e.g. because it has been edited.
+        """
+        self._sources.pop(template_name, None)
+        self._asts.pop(template_name, None)
+
+
+def is_number_or_boolean(node, native_loop=False):
+    """
+    Returns True if the generated JavaScript for `node` always evaluates to a number or a
+    boolean, neither of which can be null or contain characters that need escaping.
+
+    Args:
+        node (nodes.Node): The node.
+        native_loop (bool, optional): True if `node` is inside a loop compiled by
+                                      `_process_for_native`. Loop helpers are only known to be
+                                      numbers or booleans there, as in loops compiled to
+                                      callbacks they come from the callback's arguments, e.g.
+                                      the key of the item when iterating over an object.
+    """
+    if isinstance(node, NUMBER_OR_BOOLEAN_NODES):
+        return True
+
+    if isinstance(node, nodes.Const):
+        return is_number(node.value) or isinstance(node.value, bool)
+
+    if is_loop_helper(node):
+        return native_loop and node.attr in LOOP_HELPERS
+
+    if isinstance(node, nodes.Filter):
+        if node.name not in NUMBER_FILTERS or node.kwargs or node.dyn_args or node.dyn_kwargs:
+            return False
+        return all(is_number_or_boolean(arg, native_loop) for arg in node.args)
+
+    # JavaScript's `+` only concatenates if one side is a string (or an object)
+    if isinstance(node, (nodes.Add, nodes.And, nodes.Or)):
+        return is_number_or_boolean(node.left, native_loop) and \
+            is_number_or_boolean(node.right, native_loop)
+
+    if isinstance(node, nodes.CondExpr):
+        return is_number_or_boolean(node.expr1, native_loop) and \
+            is_number_or_boolean(node.expr2, native_loop)
+
+    return False
+
+
+def get_js_function_name(template_name):
+    """
+    Returns the name of the JavaScript function a template is compiled to, e.g.
+    'templateIncludesName' for 'includes/name.jinja'.
+    """
+    return 'template' + ''.join(
+        x.title() for x in re.split(r'[^\w]|_', path.splitext(template_name)[0])
+    )
+
+
 def temp_var_names_generator():
     x = 0
     while True:
@@ -159,6 +563,16 @@ def temp_var_names_generator():
 
 
 class JinjaToJS(object):
+    """
+    Compiles a Jinja template into a JavaScript function.
+
+    Nodes, filters and tests are dispatched to handler methods through tables that are built once
+    per class. A node is handled by the method named `_process_<node class name in lower case>`,
+    a filter by `_process_filter_<filter name>` and a test by `_process_test_<test name>`, so a
+    subclass can support additional nodes, filters and tests (or change how existing ones are
+    compiled) just by defining methods with those names. Each handler is called with the node
+    being processed and the current keyword arguments.
+    """
 
     def __init__(self,
                  template_root,
@@ -169,7 +583,19 @@ class JinjaToJS(object):
                  include_ext='',
                  child_blocks=None,
                  dependencies=None,
-                 custom_filters=None):
+                 custom_filters=None,
+                 template_cache=None,
+                 output_strategy='concat',
+                 native_loops=False,
+                 output_mode=OUTPUT_MODE_STRING,
+                 async_mode=False,
+                 minify=False,
+                 bundle_functions=None,
+                 inline_includes=None,
+                 source_map=False,
+                 block_sources=None,
+                 profile=False,
+                 instrument=False):
         """
         Args:
             template_root (str): The path to where templates should be loaded from.
@@ -190,20 +616,99 @@ class JinjaToJS(object):
                                          '.template' then set this option to a string including
                                          the leading '.'
             child_blocks (dict, optional): Used internally when handling templates that extend
-                                           other templates.
+                                           other templates. Maps block names to the blocks with
+                                           that name defined by child templates.
             dependencies (list of tuple, optional): Used internally when handling templates that
                                                     extend other templates.
             custom_filters (list of str, optional): List of custom filters which should be allowed.
                                                     These may be filters supported by Jinja but not
                                                     supported by jinja-to-js. These filters MUST be
                                                     registered with the jinja-to-js JS runtime.
+            template_cache (TemplateCache, optional): The cache to load and parse templates with.
+                                                      Pass the same cache when compiling many
+                                                      templates from the same root so they share
+                                                      one `Environment` and parsed templates.
+            output_strategy (str, optional): How the generated code builds up its output. One of
+                                             'concat' (repeatedly append to a string), 'array'
+                                             (push onto an array and join it at the end) or
+                                             'template-literal' (like 'concat' but appending
+                                             template literals).
+            native_loops (bool, optional): If True for loops are compiled to plain JavaScript
+                                           `for` loops, rather than calling a function for each
+                                           item, which renders large loops much faster.
+            output_mode (str, optional): Either 'string', in which case the template function
+                                         returns its output, or 'stream', in which case the
+                                         template function takes a `write(chunk)` function as
+                                         its second argument and calls it with the output so
+                                         far at the start and end of each block, before each
+                                         include and at the end of the template.
+            async_mode (bool, optional): If True the template function is an `async` function
+                                         which awaits any promises it gets from the context, or
+                                         from calling functions, and the templates it includes.
+                                         Includes next to each other are rendered concurrently.
+                                         For loops are always native loops in this mode.
+            minify (bool, optional): If True the generated code is made smaller, by shortening
+                                     its identifiers and interpolations and removing whitespace,
+                                     and whitespace spanning lines in the template's HTML is
+                                     collapsed (see `minify.collapse_whitespace`).
+            bundle_functions (dict, optional): Used internally when compiling templates into a
+                                               bundle (see `bundle.compile_bundle`). Maps the
+                                               names of the templates in the bundle to the names
+                                               of their functions, which included templates are
+                                               called by directly.
+            inline_includes (int, optional): If given, included templates with at most this
+                                             many nodes are compiled into the including
+                                             template's code rather than being called. The
+                                             names of the inlined templates and their node
+                                             counts are recorded in `inlined_includes`.
+            source_map (bool or str, optional): If True a version 3 source map, mapping the
+                                                generated code to the lines of the templates
+                                                it was generated from, is made by `get_output`
+                                                and can be got with `get_source_map`. If
+                                                'inline' it is also appended to the output.
+            block_sources (dict, optional): Used internally when handling templates that extend
+                                            other templates. Maps the ids of the blocks in
+                                            `child_blocks` to the names of their templates.
+            profile (bool, optional): If True, statistics on the node types, filters and tests
+                                      processed while compiling the template, and the
+                                      templates it extends, are kept in `stats` (see
+                                      `profile.CompileStats`).
+            instrument (bool, optional): If True the generated code times how long each block,
+                                         include and for loop takes to render, and reports it
+                                         to the runtime's `onProfile` hook along with the
+                                         template and line it comes from. In the async mode,
+                                         instrumented includes are awaited where they are
+                                         included, rather than rendered concurrently.
         """
 
-        self.environment = Environment(loader=FileSystemLoader(template_root),
-                                       autoescape=True,
-                                       extensions=['jinja2.ext.with_', 'jinja2.ext.autoescape'])
-        self.output = six.StringIO()
-        self.stored_names = set()
+        self._node_handlers, self._filter_handlers, self._test_handlers = \
+            self._get_handler_tables()
+        self.template_cache = template_cache or TemplateCache(template_root)
+        self.environment = self.template_cache.environment
+
+        # When profiling, the statistics for this template.
+        self.profile = profile
+        self.stats = CompileStats() if profile else None
+
+        # The template's code, as an `ir.Block` that is turned into code by `_get_template_code`.
+        self.output = self._new_output()
+
+        # Text and expressions waiting to be appended to the result. Consecutive appends are
+        # combined into a single statement which is added to `output` by `_flush_appends`.
+        self._appends = []
+
+        # Whether the template, in the async mode, includes templates whose output is collected
+        # in the `__parts` array. See `_process_include_call`.
+        self._has_async_includes = False
+
+        # Maps the names of the template variables held in JavaScript variables, e.g. those
+        # defined by {% set %} or a for loop, to the names of the JavaScript variables.
+        self.stored_names = {}
+        # The names of the template variables defined in the current scope, see `_scope`.
+        self._scope_names = set()
+        # The names of the JavaScript variables in `stored_names` for the current scope and all
+        # the scopes enclosing it, including those holding variables that are being shadowed.
+        self._var_names = set()
         self.temp_var_names = temp_var_names_generator()
         self.state = STATE_DEFAULT
         self.child_blocks = child_blocks or {}
@@ -216,12 +721,50 @@ class JinjaToJS(object):
         self.template_root = template_root
         self.template_name = template_name
         self.custom_filters = custom_filters or []
+        self.output_strategy = output_strategy
+        self.async_mode = async_mode
+        # callbacks can't await anything so async functions need native loops
+        self.native_loops = native_loops or async_mode
+        self.output_mode = output_mode
+        self.minify = minify
+        self.bundle_functions = bundle_functions
+        self.inline_includes = inline_includes
+        self.source_map = source_map
+        self.block_sources = block_sources if block_sources is not None else {}
+        self.instrument = instrument
+
+        # Whether the template data being processed might be inside a `<pre>` or `<textarea>`
+        # element, whose whitespace isn't collapsed when minifying. See `_process_body`.
+        self._preformatted = False
+
+        # The names of all templates pulled in by this one via `{% include %}` or `{% extends %}`,
+        # in the order they were encountered. Templates referenced by parent templates are
+        # included too.
+        self.referenced_templates = []
+
+        # The names of the templates pulled in by this one, or its parent templates, via
+        # `{% include %}` only.
+        self.included_templates = []
+
+        # (template name, node count) tuples for the templates included by this one, or its parent
+        # templates, that were inlined.
+        self.inlined_includes = []
+
+        # The names of the included templates currently being inlined, innermost last.
+        self._inlining = []
+
+        # When making a source map, the names of the templates that the nodes being processed
+        # come from, if not this one, innermost last, and the line of the node being processed.
+        self._source_names = []
+        self._lineno = None
+        self._source_map = None
 
         # The name of the JavaScript function that will output this template. By using a named
         # function the template can call itself which is required to support recursive includes.
-        self.js_function_name = 'template' + ''.join(
-            x.title() for x in re.split(r'[^\w]|_', path.splitext(self.template_name)[0])
-        )
+        if self.bundle_functions is not None:
+            self.js_function_name = self.bundle_functions[self.template_name]
+        else:
+            self.js_function_name = get_js_function_name(self.template_name)
 
         self.context_name = 'context'
 
@@ -231,9 +774,7 @@ class JinjaToJS(object):
         if os.name == 'nt':
             self.template_name = self.template_name.replace(os.pathsep, '/')
 
-        template_string, template_path, _ = self.environment.loader.get_source(
-            self.environment, self.template_name
-        )
+        _, template_path = self.template_cache.get_source(self.template_name)
 
         # It is assumed that this will be the absolute path to the template. It is used to work out
         # related paths for inclues.
@@ -244,7 +785,15 @@ class JinjaToJS(object):
                 'The js_module_format option must be one of: %s' % JS_MODULE_FORMATS.keys()
             )
 
-        self.ast = self.environment.parse(template_string)
+        if self.output_strategy not in OUTPUT_STRATEGIES.keys():
+            raise ValueError(
+                'The output_strategy option must be one of: %s' % OUTPUT_STRATEGIES.keys()
+            )
+
+        if self.output_mode not in OUTPUT_MODES:
+            raise ValueError('The output_mode option must be one of: %s' % (OUTPUT_MODES,))
+
+        self.ast = self.template_cache.parse(self.template_name)
 
         try:
             for node in self.ast.body:
@@ -252,24 +801,98 @@ class JinjaToJS(object):
         except ExtendsException:
             pass
 
-    def get_output(self):
+    def get_output(self, markers=False):
         """
         Returns the generated JavaScript code.
 
+        Args:
+            markers (bool, optional): If True, the markers that the source map is made from are
+                                      left in the code, and no source map is made. This is for
+                                      code that is combined with other code before the source
+                                      map is made, e.g. by `compile_bundle`. Has no effect
+                                      without the `source_map` option.
+
         Returns:
             str
         """
+        output = self._get_marked_output()
+
+        if self.source_map and not markers:
+            output, self._source_map = make_source_map(
+                output, lambda name: self.template_cache.get_source(name)[0]
+            )
+            if self.source_map == 'inline':
+                output = inline_source_map(output, self._source_map)
+
+        return output
+
+    def _get_marked_output(self):
+        """
+        Returns the generated JavaScript code, including any markers for making a source map.
+        """
+        output_strategy = OUTPUT_STRATEGIES[self.output_strategy]
+
+        if self.output_mode == OUTPUT_MODE_STREAM:
+            # write whatever is left at the end
+            self._write_to_stream()
+            parameters = 'ctx, __write, locals'
+            template_end = ''
+        else:
+            parameters = 'ctx, locals'
+            template_end = 'return %s;' % output_strategy.result
+
+        template_code = self._get_template_code()
+
+        if self._has_async_includes:
+            template_code = 'var __parts = [];' + template_code
+            template_end = 'return (await Promise.all(__parts)).join("") + %s;' % (
+                output_strategy.result
+            )
+
+        if self.minify:
+            template_code = MINIFIED_HELPERS + template_code
+
         # generate the JS function string
         template_function = TEMPLATE_WRAPPER.format(
+            function_type='async function' if self.async_mode else 'function',
             function_name=self.js_function_name,
-            template_code=self.output.getvalue()
+            parameters=parameters,
+            initial_value=output_strategy.initial_value,
+            template_code=template_code,
+            template_end=template_end
         ).strip()
 
         # get the correct module format template
         module_format = JS_MODULE_FORMATS[self.js_module_format]
 
         # generate the module code
-        return module_format(self.dependencies, template_function)
+        output = module_format(self.dependencies, template_function)
+
+        if self.minify:
+            output = minify_code(output)
+
+        return output
+
+    def get_source_map(self):
+        """
+        Returns the source map for the output returned by `get_output`, if the template is being
+        compiled with the `source_map` option, as a dict.
+
+        Returns:
+            dict or None
+        """
+        return self._source_map
+
+    def _get_template_code(self):
+        """
+        Returns the JavaScript code generated for the body of the template function.
+        """
+        self._flush_appends()
+        output_strategy = OUTPUT_STRATEGIES[self.output_strategy]
+        emitter = Emitter(output_strategy.append,
+                          write=lambda parts: '__write(%s);' % concat_expression(parts),
+                          flush_stream=self._get_stream_write_code())
+        return emitter.emit(optimize(self.output, stream=self.output_mode == OUTPUT_MODE_STREAM))
 
     def _get_depencency_var_name(self, dependency):
         """
@@ -305,34 +928,103 @@ class JinjaToJS(object):
             self.dependencies.append((dependency, var_name))
         return var_name
 
+    def _add_referenced_template(self, template_name):
+        """
+        Records that `template_name` is included or extended by this template.
+
+        Args:
+            template_name (str): The name of the referenced template.
+        """
+        if template_name not in self.referenced_templates:
+            self.referenced_templates.append(template_name)
+
+    @classmethod
+    def _get_handler_tables(cls):
+        """
+        Returns the handler tables for this class, building them the first time this is called.
+
+        Returns:
+            tuple: Three dicts mapping node classes, filter names and test names to the unbound
+                   methods that handle them. Node classes are added to the first dict as they
+                   are encountered.
+        """
+
+        # look in `__dict__` rather than using `getattr` so that subclasses get their own tables
+        tables = cls.__dict__.get('_handler_tables')
+
+        if tables is None:
+            node_handlers = {}
+            filter_handlers = {}
+            test_handlers = {}
+
+            for name in dir(cls):
+                if name.startswith(FILTER_HANDLER_PREFIX):
+                    filter_handlers[name[len(FILTER_HANDLER_PREFIX):]] = getattr(cls, name)
+                elif name.startswith(TEST_HANDLER_PREFIX):
+                    test_handlers[name[len(TEST_HANDLER_PREFIX):]] = getattr(cls, name)
+
+            tables = (node_handlers, filter_handlers, test_handlers)
+            cls._handler_tables = tables
+
+        return tables
+
+    def _get_node_handler(self, node_class):
+        """
+        Returns the handler for nodes of type `node_class`, or None if there isn't one, and adds
+        it to the node handler table.
+        """
+        handler = getattr(type(self), NODE_HANDLER_PREFIX + node_class.__name__.lower(), None)
+        if not callable(handler):
+            handler = None
+        self._node_handlers[node_class] = handler
+        return handler
+
     def _process_node(self, node, **kwargs):
-        node_name = node.__class__.__name__.lower()
-        handler = getattr(self, '_process_' + node_name, None)
-        if callable(handler):
-            handler(node, **kwargs)
-        else:
+        try:
+            handler = self._node_handlers[node.__class__]
+        except KeyError:
+            handler = self._get_node_handler(node.__class__)
+
+        if handler is None:
             raise Exception('Unknown node %s' % node)
 
+        if self.stats is None:
+            self._call_node_handler(handler, node, **kwargs)
+            return
+
+        self.stats.start(NODE, node.__class__.__name__)
+        try:
+            self._call_node_handler(handler, node, **kwargs)
+        finally:
+            self.stats.stop()
+
+    def _call_node_handler(self, handler, node, **kwargs):
+        if not self.source_map:
+            handler(self, node, **kwargs)
+            return
+
+        lineno = self._lineno
+        self._lineno = getattr(node, 'lineno', None) or lineno
+
+        # code for nodes outside of an interpolation or execution is marked when one starts
+        if self.state != STATE_DEFAULT and self._lineno != lineno:
+            self._write_source_marker()
+
+        try:
+            handler(self, node, **kwargs)
+        finally:
+            self._lineno = lineno
+
     def _process_extends(self, node, **kwargs):
         """
         Processes an extends block e.g. `{% extends "some/template.jinja" %}`
         """
 
-        # find all the blocks in this template
+        # find all the blocks in this template and add them to the end of the chain of blocks
+        # with the same name defined by the templates extending this one
         for b in self.ast.find_all(nodes.Block):
-
-            # if not already in `child_blocks` then this is the first time a
-            # block with this name has been encountered.
-            if b.name not in self.child_blocks:
-                self.child_blocks[b.name] = b
-            else:
-
-                # otherwise we have seen this block before, so we need to find the last
-                # super_block and add the block from this template to the end.
-                block = self.child_blocks.get(b.name)
-                while hasattr(block, 'super_block'):
-                    block = block.super_block
-                block.super_block = b
+            self.child_blocks.setdefault(b.name, []).append(b)
+            self.block_sources[id(b)] = self._get_source_name()
 
         # load the parent template
         parent_template = JinjaToJS(template_root=self.template_root,
@@ -342,71 +1034,94 @@ class JinjaToJS(object):
                                     include_prefix=self.include_prefix,
                                     include_ext=self.include_ext,
                                     child_blocks=self.child_blocks,
-                                    dependencies=self.dependencies)
+                                    dependencies=self.dependencies,
+                                    custom_filters=self.custom_filters,
+                                    template_cache=self.template_cache,
+                                    output_strategy=self.output_strategy,
+                                    native_loops=self.native_loops,
+                                    output_mode=self.output_mode,
+                                    async_mode=self.async_mode,
+                                    minify=self.minify,
+                                    bundle_functions=self.bundle_functions,
+                                    inline_includes=self.inline_includes,
+                                    source_map=self.source_map,
+                                    block_sources=self.block_sources,
+                                    profile=self.profile,
+                                    instrument=self.instrument)
 
         # add the parent templates output to the current output
-        self.output.write(parent_template.output.getvalue())
+        self._flush_appends()
+        parent_template._flush_appends()
+        self.output.extend(parent_template.output)
+        self._has_async_includes = self._has_async_includes or parent_template._has_async_includes
+
+        if self.stats is not None:
+            # the time spent on the parent's nodes isn't the extends node's own time
+            self.stats.add_child_time(parent_template.stats.total_time)
+            self.stats.merge(parent_template.stats)
+
+        self._add_referenced_template(node.template.value)
+        for name in parent_template.referenced_templates:
+            self._add_referenced_template(name)
+        for name in parent_template.included_templates:
+            if name not in self.included_templates:
+                self.included_templates.append(name)
+        for inlined in parent_template.inlined_includes:
+            if inlined not in self.inlined_includes:
+                self.inlined_includes.append(inlined)
 
         # Raise an exception so we stop parsing this template
         raise ExtendsException
 
-    def _process_block(self, node, **kwargs):
+    def _process_block(self, node, super_blocks=None, **kwargs):
         """
         Processes a block e.g. `{% block my_block %}{% endblock %}`
         """
 
-        # check if this node already has a 'super_block' attribute
-        if not hasattr(node, 'super_block'):
-
-            # since it doesn't it must be the last block in the inheritance chain
-            node.super_block = None
-
-            # see if there has been a child block defined - if there is this
-            # will be the first block in the inheritance chain
-            child_block = self.child_blocks.get(node.name)
-
-            if child_block:
+        # the blocks with this name defined by child templates override this one, with the one
+        # furthest down the inheritance chain being output and the others available via super()
+        blocks = self.child_blocks.get(node.name, []) + [node]
+        self._write_to_stream()
+        with self._probe('block ' + node.name, blocks[0].lineno,
+                         self.block_sources.get(id(blocks[0]), self.template_name)):
+            self._process_block_chain(blocks, **kwargs)
+        self._write_to_stream()
 
-                # we have child nodes so we need to set `node` as the
-                # super of the last one in the chain
-                last_block = child_block
-                while hasattr(last_block, 'super_block'):
-                    last_block = child_block.super_block
-
-                # once we have found it, set this node as it's super block
-                last_block.super_block = node
-
-                # this is the node we want to process as it's the first in the inheritance chain
-                node = child_block
-
-        # process the block passing the it's super along, if this block
-        # calls super() it will be handled by `_process_call`
-        for n in node.body:
-            self._process_node(n, super_block=node.super_block, **kwargs)
+    def _process_block_chain(self, blocks, **kwargs):
+        """
+        Processes the first block in `blocks`, passing the rest along so that if it calls
+        super() it can be handled by `_process_call`.
+        """
+        self._source_names.append(self.block_sources.get(id(blocks[0]), self.template_name))
+        for n in blocks[0].body:
+            self._process_node(n, super_blocks=blocks[1:], **kwargs)
+        self._source_names.pop()
 
     def _process_output(self, node, **kwargs):
         """
         Processes an output node, which will contain things like `Name` and `TemplateData` nodes.
         """
         for n in node.nodes:
-            self._process_node(n, **kwargs)
+            if self.state == STATE_DEFAULT and \
+                    is_number_or_boolean(n, native_loop=bool(kwargs.get('loop_vars'))) and \
+                    get_constant_value(n) is NOT_CONSTANT:
+                # e.g. {{ loop.index }} or {{ items|length }} can be output as they are
+                with self._interpolation(safe=True, nullable=False):
+                    self._process_node(n, **kwargs)
+            else:
+                self._process_node(n, **kwargs)
 
     def _process_templatedata(self, node, **_):
         """
         Processes a `TemplateData` node, this is just a bit of as-is text
         to be written to the output.
         """
+        data = node.data
+        if self.minify:
+            data, self._preformatted = collapse_whitespace(data, self._preformatted)
+        self._append_static(data)
 
-        # escape double quotes
-        value = re.sub('"', r'\\"', node.data)
-
-        # escape new lines
-        value = re.sub('\n', r'\\n', value)
-
-        # append value to the result
-        self.output.write('__result += "' + value + '";')
-
-    def _process_name(self, node, **kwargs):
+    def _process_name(self, node, is_callee=False, **kwargs):
         """
         Processes a `Name` node. Some examples of `Name` nodes:
             {{ foo }} -> 'foo' is a Name
@@ -416,16 +1131,15 @@ class JinjaToJS(object):
         with self._interpolation():
             with self._python_bool_wrapper(**kwargs):
 
-                if node.name not in self.stored_names and node.ctx != 'store':
-                    self.output.write(self.context_name)
-                    self.output.write('.')
-
-                if node.ctx == 'store':
-                    self.stored_names.add(node.name)
-
-                self.output.write(node.name)
+                if node.name in self.stored_names:
+                    self.output.write(self.stored_names[node.name])
+                else:
+                    with self._awaited(is_callee):
+                        self.output.write(self.context_name)
+                        self.output.write('.')
+                        self.output.write(node.name)
 
-    def _process_getattr(self, node, **kwargs):
+    def _process_getattr(self, node, is_callee=False, **kwargs):
         """
         Processes a `GetAttr` node. e.g. {{ foo.bar }}
         """
@@ -435,17 +1149,18 @@ class JinjaToJS(object):
                 if is_loop_helper(node):
                     self._process_loop_helper(node, **new_kwargs)
                 else:
-                    self._process_node(node.node, **new_kwargs)
-                    self.output.write('.')
-                    self.output.write(node.attr)
+                    with self._awaited(is_callee):
+                        self._process_node(node.node, **new_kwargs)
+                        self.output.write('.')
+                        self.output.write(node.attr)
 
-    def _process_getitem(self, node, **kwargs):
+    def _process_getitem(self, node, is_callee=False, **kwargs):
         """
         Processes a `GetItem` node e.g. {{ foo["bar"] }}
         """
 
         with self._interpolation():
-            with self._python_bool_wrapper(**kwargs) as new_kwargs:
+            with self._python_bool_wrapper(**kwargs) as new_kwargs, self._awaited(is_callee):
                 self._process_node(node.node, **new_kwargs)
 
                 if isinstance(node.arg, nodes.Slice):
@@ -481,113 +1196,146 @@ class JinjaToJS(object):
             {% %}
         """
 
-        # since a for loop can introduce new names into the context
-        # we need to remember the ones that existed outside the loop
-        previous_stored_names = self.stored_names.copy()
+        with self._probe('for', node.lineno):
+            if self.native_loops:
+                self._process_for_native(node, **kwargs)
+            else:
+                self._process_for_callback(node, **kwargs)
 
-        with self._execution():
-            self.output.write('__runtime.each(')
+    def _process_for_callback(self, node, **kwargs):
+        """
+        Processes a for loop as a call to the runtime's `each` function, with a function that is
+        called for each item.
+        """
+        targets = get_loop_targets(node)
+        source_marker = self._get_source_marker()
 
-            if is_method_call(node.iter, dict.keys.__name__):
-                self.output.write('Object.keys(')
+        with self._scope():
+            with self._captured() as head, self._execution():
+                self.output.write('__runtime.each(')
 
-            self._process_node(node.iter, **kwargs)
+                if is_method_call(node.iter, dict.keys.__name__):
+                    self.output.write('Object.keys(')
 
-            if is_method_call(node.iter, dict.keys.__name__):
-                self.output.write(')')
+                self._process_node(node.iter, **kwargs)
 
-            self.output.write(',')
-            self.output.write('function')
-            self.output.write('(')
+                if is_method_call(node.iter, dict.keys.__name__):
+                    self.output.write(')')
 
-            # javascript iterations put the value first, then the key
-            if isinstance(node.target, nodes.Tuple):
-                if len(node.target.items) > 2:
-                    raise Exception('De-structuring more than 2 items is not supported.')
+                self.output.write(',')
+                self.output.write('function')
+                self.output.write('(')
+                self.output.write(','.join(self._declare_variable(t.name) for t in targets))
+                self.output.write(')')
+                self.output.write('{')
 
-                for i, item in enumerate(reversed(node.target.items)):
-                    self._process_node(item, **kwargs)
-                    if i < len(node.target.items) - 1:
-                        self.output.write(',')
-            else:
-                self._process_node(node.target, **kwargs)
+                if node.test:
+                    self.output.write('if (!(')
+                    self._process_node(node.test, **kwargs)
+                    self.output.write(')) { return; }')
 
-            self.output.write(')')
-            self.output.write('{')
+            body = self._process_body(node.body, **kwargs)
 
-            if node.test:
-                self.output.write('if (!(')
-                self._process_node(node.test, **kwargs)
-                self.output.write(')) { return; }')
+        self.output.add(Loop(head, body, '});', source_marker))
 
-        assigns = node.target.items if isinstance(node.target, nodes.Tuple) else [node.target]
+    def _process_for_native(self, node, **kwargs):
+        """
+        Processes a for loop as a JavaScript `for` loop over the indexes of an array, or of an
+        array of the keys of an object. The loop helpers are worked out from the index and the
+        length, both of which are held in local variables.
+        """
 
-        with self._scoped_variables(assigns, **kwargs):
-            for n in node.body:
-                self._process_node(n, **kwargs)
+        targets = get_loop_targets(node)
+        source_marker = self._get_source_marker()
 
-        with self._execution():
-            self.output.write('}')
-            self.output.write(')')
-            self.output.write(';')
+        iter_var, keys_var, length_var, index_var = [next(self.temp_var_names) for _ in range(4)]
+        loop_vars = (index_var, length_var)
 
-        # restore the stored names
-        self.stored_names = previous_stored_names
+        is_keys_call = is_method_call(node.iter, dict.keys.__name__)
+        is_object_call = is_method_call(node.iter, DICT_ITER_METHODS) and not is_keys_call
+        is_array = is_keys_call or isinstance(node.iter, (nodes.List, nodes.Tuple))
 
-    def _process_if(self, node, execute_end=None, **kwargs):
-        """
-        Processes an if block e.g. `{% if foo %} do something {% endif %}`
-        """
+        with self._scope():
+            with self._captured() as head, self._execution():
+                self.output.write('var %s = ' % iter_var)
+                if is_keys_call:
+                    self.output.write('__runtime.keys(')
+                self._process_node(node.iter, **kwargs)
+                if is_keys_call:
+                    self.output.write(')')
+                self.output.write(';')
 
-        with self._execution():
-            self.output.write('if')
-            self.output.write('(')
+                if is_array:
+                    # e.g. foo.keys() or [1, 2, 3]
+                    self.output.write('var %s = %s.length;' % (length_var, iter_var))
+                    key_code = index_var
+                    value_code = '%s[%s]' % (iter_var, index_var)
+                elif is_object_call:
+                    # e.g. foo.items() or foo.values(), so iterating over an object
+                    self.output.write('var %s = __runtime.keys(%s);' % (keys_var, iter_var))
+                    self.output.write('var %s = %s.length;' % (length_var, keys_var))
+                    key_code = '%s[%s]' % (keys_var, index_var)
+                    value_code = '%s[%s]' % (iter_var, key_code)
+                else:
+                    # could be either an array or an object, so only get the keys of an object
+                    self.output.write(
+                        'var %s = Array.isArray(%s) ? null : __runtime.keys(%s);' % (
+                            keys_var, iter_var, iter_var
+                        )
+                    )
+                    self.output.write('var %s = (%s || %s).length;' % (
+                        length_var, keys_var, iter_var
+                    ))
+                    key_code = '(%s ? %s[%s] : %s)' % (keys_var, keys_var, index_var, index_var)
+                    value_code = '%s[%s]' % (iter_var, key_code)
 
-            with option(kwargs, use_python_bool_wrapper=True):
-                self._process_node(node.test, **kwargs)
+                self.output.write('for (var %s = 0; %s < %s; %s++) {' % (
+                    index_var, index_var, length_var, index_var
+                ))
 
-            self.output.write(')')
-            self.output.write('{')
+                for target, code in zip(targets, (value_code, key_code)):
+                    self.output.write('var %s = %s;' % (self._declare_variable(target.name), code))
 
-        # We accept an `execute_end` function as a keyword argument as this function is
-        # recursive in the case of something like if-elif-elif-else. In these cases this
-        # invocation of this function may have to close execution opened by a previous
-        # invocation of this function.
-        if execute_end:
-            execute_end()
+                if node.test:
+                    self.output.write('if (!(')
+                    with option(kwargs, loop_vars=loop_vars):
+                        self._process_node(node.test, **kwargs)
+                    self.output.write(')) { continue; }')
 
-        # body
-        for n in node.body:
-            self._process_node(n, **kwargs)
+            with option(kwargs, loop_vars=loop_vars):
+                body = self._process_body(node.body, **kwargs)
 
-        if not node.else_ and not node.elif_:
-            # no else - just close the if
-            with self._execution():
-                self.output.write('}')
+        self.output.add(Loop(head, body, '}', source_marker))
 
-        else:
-            # either an else or an elif
-            with self._execution() as execute_end:
-                self.output.write('}')
-                self.output.write(' else ')
+    def _process_if(self, node, branches=None, **kwargs):
+        """
+        Processes an if block e.g. `{% if foo %} do something {% endif %}`
+        """
+        source_marker = self._get_source_marker()
 
-                # check for elif
-                for n in node.elif_:
-                    self._process_node(n, execute_end=execute_end, **kwargs)
+        with self._captured() as test, self._execution():
+            with option(kwargs, use_python_bool_wrapper=True):
+                self._process_node(node.test, **kwargs)
 
-                if node.elif_ and node.else_:
-                    self.output.write(' else ')
+        body = self._process_body(node.body, **kwargs)
 
-                # open up the body
-                self.output.write('{')
+        # We accept a list of `branches` as a keyword argument as the elifs of an if are
+        # processed by this function too, and only add their test, body and source marker to the
+        # if's.
+        if branches is not None:
+            branches.append((test, body, source_marker))
+            return
 
-            # process the body of the else
-            for n in node.else_:
-                self._process_node(n, **kwargs)
+        branches = [(test, body, source_marker)]
+        for n in node.elif_:
+            self._process_node(n, branches=branches, **kwargs)
 
-            # close the body
-            with self._execution():
-                self.output.write('}')
+        else_body = self._process_body(node.else_, **kwargs) if node.else_ else None
+
+        self.output.add(Conditional(
+            [(test, body) for test, body, _ in branches], else_body,
+            [source_marker for _, _, source_marker in branches]
+        ))
 
     def _process_condexpr(self, node, **kwargs):
         with self._interpolation():
@@ -626,22 +1374,22 @@ class JinjaToJS(object):
                 self.output.write(',')
         self.output.write(']')
 
-    def _process_call(self, node, super_block=None, **kwargs):
+    def _process_call(self, node, super_blocks=None, **kwargs):
         if is_method_call(node, DICT_ITER_METHODS):
             # special case for dict methods
             self._process_node(node.node.node, **kwargs)
 
         elif is_method_call(node, 'super'):
             # special case for the super() method which is available inside blocks
-            if not super_block:
+            if not super_blocks:
                 raise Exception('super() called outside of a block with a parent.')
-            self._process_node(super_block, **kwargs)
+            self._process_block_chain(super_blocks, **kwargs)
 
         else:
             # just a normal function call on a context variable
             with self._interpolation():
-                with self._python_bool_wrapper(**kwargs) as new_kwargs:
-                    self._process_node(node.node, **new_kwargs)
+                with self._python_bool_wrapper(**kwargs) as new_kwargs, self._awaited():
+                    self._process_node(node.node, is_callee=True, **new_kwargs)
                     self.output.write('(')
                     self._process_args(node, **new_kwargs)
                     self.output.write(')')
@@ -651,9 +1399,20 @@ class JinjaToJS(object):
                         self.output.write('')
 
     def _process_filter(self, node, **kwargs):
-        method_name = getattr(self, '_process_filter_%s' % node.name, None)
-        if callable(method_name):
-            method_name(node, **kwargs)
+        if self.stats is None:
+            self._call_filter_handler(node, **kwargs)
+            return
+
+        self.stats.start(FILTER, node.name)
+        try:
+            self._call_filter_handler(node, **kwargs)
+        finally:
+            self.stats.stop()
+
+    def _call_filter_handler(self, node, **kwargs):
+        handler = self._filter_handlers.get(node.name)
+        if handler is not None:
+            handler(self, node, **kwargs)
         elif node.name in self.custom_filters:
             with self._interpolation(safe=True):
                 with self._python_bool_wrapper(**kwargs) as new_kwargs:
@@ -667,6 +1426,13 @@ class JinjaToJS(object):
             raise Exception('Unsupported filter: %s' % node.name)
 
     def _process_filter_safe(self, node, **kwargs):
+        if self.state == STATE_DEFAULT:
+            value = to_js_string(get_constant_value(node.node))
+            if value is not None:
+                # e.g. {{ "<br>"|safe }}
+                self._append_static(value)
+                return
+
         with self._interpolation(safe=True):
             with self._python_bool_wrapper(**kwargs) as new_kwargs:
                 self._process_node(node.node, **new_kwargs)
@@ -790,48 +1556,55 @@ class JinjaToJS(object):
                 self.output.write(')')
 
     def _process_assign(self, node, **kwargs):
-        with self._execution():
-            self.output.write('var ')
-            self._process_node(node.target, **kwargs)
-            self.output.write(' = ')
-            self._process_node(node.node, **kwargs)
-            self.output.write(';')
+        """
+        Processes a set e.g. `{% set name = 'John' %}`
+        """
+        self._process_assigns([(node.target, node.node)], **kwargs)
 
     def _process_with(self, node, **kwargs):
+        """
+        Processes a with block e.g. `{% with name = 'John' %}{{ name }}{% endwith %}`
+        """
 
-        # keep a copy of the stored names before the scope
-        previous_stored_names = self.stored_names.copy()
-
-        # assigns in the with tag
-        # e.g. {% with var = "something %}
-        assigns_in_tag = [nodes.Assign(t, v) for t, v in zip(node.targets, node.values)]
+        with self._scope():
+            self._process_assigns(zip(node.targets, node.values), **kwargs)
 
-        # assigns in the with body
-        # e.g. {% set name = 'John' %}
-        assigns_in_body = [x for x in node.body if isinstance(x, nodes.Assign)]
+            for n in node.body:
+                self._process_node(n, **kwargs)
 
-        # remove assigns from the body
-        node.body = [x for x in node.body if not isinstance(x, nodes.Assign)]
+    def _process_assigns(self, assigns, **kwargs):
+        """
+        Declares a JavaScript variable in the current scope for each (target, value) pair in
+        `assigns`. The values are all worked out before any of the variables are declared, so
+        they only see variables from outside the current statement.
+        """
 
-        # get a list of all the assigns in this with block
-        # both on the tag, and within the body of the block
-        all_assigns = assigns_in_tag + assigns_in_body
+        assigns = list(assigns)
+        var_names = []
 
         with self._execution():
-            self.output.write('(function () {')
+            for target, value in assigns:
+                if not isinstance(target, nodes.Name):
+                    raise Exception('Assigning to more than one name is not supported.')
 
-        with self._scoped_variables(all_assigns, **kwargs):
-            for node in node.body:
-                self._process_node(node, **kwargs)
+                if target.name in self._scope_names:
+                    var_name = self.stored_names[target.name]
+                else:
+                    var_name = self._get_variable_name(target.name, var_names)
 
-        with self._execution():
-            self.output.write('})();')
+                self.output.write('var %s = ' % var_name)
+                self._process_node(value, **kwargs)
+                self.output.write(';')
+                var_names.append(var_name)
 
-        # restore previous stored names
-        self.stored_names = previous_stored_names
+        for (target, _), var_name in zip(assigns, var_names):
+            self._set_variable(target.name, var_name)
 
     def _process_compare(self, node, **kwargs):
 
+        if self._process_constant_value(node, **kwargs):
+            return
+
         if len(node.ops) > 1:
             raise Exception('Multiple operands are not supported.')
 
@@ -869,14 +1642,37 @@ class JinjaToJS(object):
         self._process_node(node.expr, **kwargs)
 
     def _process_const(self, node, **_):
+        if self.state == STATE_DEFAULT:
+            # the whole interpolation is a constant, e.g. {{ "foo" }}, so escape it now
+            value = to_js_string(node.value)
+            if value is not None:
+                self._append_static(escape_html(value))
+                return
+
         with self._interpolation():
             self.output.write(json.dumps(node.value))
 
+    def _process_constant_value(self, node, **kwargs):
+        """
+        Processes `node` as a `Const` if its value is known at compile time.
+
+        Returns:
+            bool: True if `node` was processed.
+        """
+        value = get_constant_value(node)
+        if value is NOT_CONSTANT:
+            return False
+        self._process_const(nodes.Const(value), **kwargs)
+        return True
+
     def _process_nonetype(self, node, **_):
         with self._interpolation():
             self.output.write('null')
 
     def _process_neg(self, node, **kwargs):
+        if self._process_constant_value(node, **kwargs):
+            return
+
         with self._interpolation():
             self.output.write('-')
             self._process_node(node.node, **kwargs)
@@ -890,12 +1686,22 @@ class JinjaToJS(object):
         self.output.write(']')
 
     def _process_test(self, node, **kwargs):
+        if self.stats is None:
+            self._call_test_handler(node, **kwargs)
+            return
+
+        self.stats.start(TEST, node.name)
+        try:
+            self._call_test_handler(node, **kwargs)
+        finally:
+            self.stats.stop()
+
+    def _call_test_handler(self, node, **kwargs):
         with option(kwargs, use_python_bool_wrapper=False):
-            method_name = getattr(self, '_process_test_%s' % node.name, None)
-            if callable(method_name):
-                method_name(node, **kwargs)
-            else:
+            handler = self._test_handlers.get(node.name)
+            if handler is None:
                 raise Exception('Unsupported test: %s' % node.name)
+            handler(self, node, **kwargs)
 
     def _process_test_defined(self, node, **kwargs):
         self.output.write('(typeof ')
@@ -957,45 +1763,150 @@ class JinjaToJS(object):
         self.output.write('))')
 
     def _process_include(self, node, **kwargs):
-        with self._interpolation(safe=True):
-            include_path = node.template.value
+        with self._probe('include ' + node.template.value, node.lineno):
+            self._process_include_call(node, **kwargs)
 
-            if include_path == self.template_name:
-                # template is including itself
-                include_var_name = self.js_function_name
-            else:
-                if self.include_prefix:
-                    include_path = self.include_prefix + node.template.value
-                elif self.js_module_format in ('es6', 'commonjs',) and self.template_name:
-                    _, absolute_include_path, _ = self.environment.loader.get_source(
-                        self.environment, node.template.value
-                    )
-                    include_path = os.path.relpath(
-                        absolute_include_path, os.path.dirname(self.template_path)
-                    )
-                    if not include_path.startswith('.'):
-                        include_path = './' + include_path
+    def _process_include_call(self, node, **kwargs):
+        inline = self._get_inline_include(node.template.value)
+        if inline is not None:
+            self._inline_include(node.template.value, *inline, **kwargs)
+            return
 
-                # Jinja2 doesn't accept Windows filepaths (but does output them!)
-                if os.name == 'nt':
-                    include_path = include_path.replace(os.pathsep, '/')
+        include_function = self._get_include_function(node)
+        include_args = self._get_include_args()
+        include_call = include_function + include_args
 
-                include_path = path.splitext(include_path)[0] + self.include_ext
-                include_var_name = self._get_depencency_var_name(include_path)
+        if self.output_mode == OUTPUT_MODE_STREAM:
+            # the included template writes to the same function as this one, so everything
+            # before the include has to be written first
+            self._write_to_stream()
+            with self._execution():
+                self.output.add(Call(include_function, include_args, awaited=self.async_mode))
+        elif self.async_mode:
+            # the included template starts rendering here, and the promise of its output is
+            # added to `__parts` after the output so far. All of them are awaited together at
+            # the end of the template, see `_get_marked_output`, so every include is rendered
+            # concurrently. When instrumented it is awaited here, so that it can be timed.
+            output_strategy = OUTPUT_STRATEGIES[self.output_strategy]
+            self._has_async_includes = True
+            with self._execution():
+                self.output.write('__parts.push(%s, %s); __result = %s;' % (
+                    output_strategy.result,
+                    ('await %s' if self.instrument else '__runtime.defer(%s)') % include_call,
+                    output_strategy.initial_value
+                ))
+        else:
+            with self._interpolation(safe=True):
+                self.output.write(include_call)
+
+    def _get_inline_include(self, include_path):
+        """
+        Returns the AST of the template `include_path` and the number of nodes in it if including
+        it should inline it, otherwise None. Templates that include themselves, directly or through
+        the templates being inlined, are never inlined.
+        """
+        if self.inline_includes is None or include_path == self.template_name or \
+                include_path in self._inlining:
+            return None
 
-                if not include_var_name:
-                    include_var_name = self._add_dependency(include_path)
+        ast = self.template_cache.parse(include_path)
 
-            if self.js_module_format is None:
-                self.output.write('jinjaToJS.include("')
-                self.output.write(include_path)
-                self.output.write('");')
-            else:
-                self.output.write(include_var_name)
+        # blocks would be looked up in the chain of blocks of the including template
+        if ast.find(nodes.Extends) is not None or ast.find(nodes.Block) is not None:
+            return None
 
-            self.output.write('(')
-            self.output.write(self.context_name)
-            self.output.write(')')
+        node_count = sum(1 for _ in ast.find_all(nodes.Node))
+        if node_count > self.inline_includes:
+            return None
+
+        return ast, node_count
+
+    def _inline_include(self, include_path, ast, node_count, super_blocks=None, **kwargs):
+        """
+        Compiles the template `include_path`, whose AST is `ast`, into this template's code in
+        place of an include of it. Any variables it sets don't outlive it, just as when it is
+        called. The rest of `kwargs` (e.g. the variables of an enclosing native loop) are passed
+        on to its nodes, but not the blocks of the including template.
+        """
+        self._add_referenced_template(include_path)
+
+        inlined = (include_path, node_count)
+        if inlined not in self.inlined_includes:
+            self.inlined_includes.append(inlined)
+
+        # everything before the include is written first, just as when it is called
+        self._write_to_stream()
+
+        self._inlining.append(include_path)
+        self._source_names.append(include_path)
+        with self._scope():
+            for node in ast.body:
+                self._process_node(node, **kwargs)
+        self._source_names.pop()
+        self._inlining.pop()
+
+    def _get_include_function(self, node):
+        """
+        Returns the JavaScript expression for the function of the template included by the
+        `Include` node `node`.
+        """
+        include_path = node.template.value
+        self._add_referenced_template(include_path)
+        if include_path not in self.included_templates:
+            self.included_templates.append(include_path)
+
+        if self.bundle_functions is not None:
+            # the included template is compiled into the same bundle
+            return self.bundle_functions[include_path]
+
+        if include_path == self.template_name:
+            # template is including itself
+            include_var_name = self.js_function_name
+        else:
+            if self.include_prefix:
+                include_path = self.include_prefix + node.template.value
+            elif self.js_module_format in ('es6', 'commonjs',) and self.template_name:
+                _, absolute_include_path = self.template_cache.get_source(
+                    node.template.value
+                )
+                include_path = os.path.relpath(
+                    absolute_include_path, os.path.dirname(self.template_path)
+                )
+                if not include_path.startswith('.'):
+                    include_path = './' + include_path
+
+            # Jinja2 doesn't accept Windows filepaths (but does output them!)
+            if os.name == 'nt':
+                include_path = include_path.replace(os.pathsep, '/')
+
+            include_path = path.splitext(include_path)[0] + self.include_ext
+            include_var_name = self._get_depencency_var_name(include_path)
+
+            if not include_var_name:
+                include_var_name = self._add_dependency(include_path)
+
+        if self.js_module_format is None:
+            return 'jinjaToJS.include("%s")' % include_path
+
+        return include_var_name
+
+    def _get_include_args(self):
+        """
+        Returns the arguments for calling an included template, including the parentheses.
+        """
+        args = [self.context_name]
+
+        if self.output_mode == OUTPUT_MODE_STREAM:
+            args.append('__write')
+
+        # pass on the template variables held in JavaScript variables so that the included
+        # template can see them too
+        if self.stored_names:
+            args.append('{%s}' % ','.join(
+                '%s:%s' % (name, self.stored_names[name]) for name in sorted(self.stored_names)
+            ))
+
+        return '(%s)' % ','.join(args)
 
     def _process_add(self, node, **kwargs):
         self._process_math(node, math_operator=' + ', **kwargs)
@@ -1021,6 +1932,9 @@ class JinjaToJS(object):
         If `function` is provided the expression is wrapped in a call to that function.
         """
 
+        if self._process_constant_value(node, **kwargs):
+            return
+
         with self._interpolation():
             if function:
                 self.output.write(function)
@@ -1033,11 +1947,26 @@ class JinjaToJS(object):
             if function:
                 self.output.write(')')
 
-    def _process_loop_helper(self, node, **kwargs):
+    def _process_loop_helper(self, node, loop_vars=None, **kwargs):
         """
         Processes a loop helper e.g. {{ loop.first }} or {{ loop.index }}
         """
 
+        if loop_vars:
+            # inside a native loop, see `_process_for_native`
+            index_var, length_var = loop_vars
+            if node.attr == LOOP_HELPER_INDEX:
+                self.output.write('(%s + 1)' % index_var)
+            elif node.attr == LOOP_HELPER_INDEX_0:
+                self.output.write(index_var)
+            elif node.attr == LOOP_HELPER_FIRST:
+                self.output.write('(%s === 0)' % index_var)
+            elif node.attr == LOOP_HELPER_LAST:
+                self.output.write('(%s === %s - 1)' % (index_var, length_var))
+            elif node.attr == LOOP_HELPER_LENGTH:
+                self.output.write(length_var)
+            return
+
         if node.attr == LOOP_HELPER_INDEX:
             self.output.write('(arguments[1] + 1)')
         elif node.attr == LOOP_HELPER_INDEX_0:
@@ -1058,6 +1987,165 @@ class JinjaToJS(object):
             if i < len(node.args) - 1:
                 self.output.write(',')
 
+    def _append_static(self, value):
+        """
+        Appends the text `value` to the result.
+        """
+        if self.stats is not None:
+            self.stats.add_bytes(len(value))
+        if self._appends and self._appends[-1][0]:
+            self._appends[-1] = (True, self._appends[-1][1] + value)
+        else:
+            self._appends.append((True, value))
+
+    def _append_expression(self, code):
+        """
+        Appends the result of the JavaScript expression `code` to the result.
+        """
+        self._appends.append((False, code))
+
+    def _flush_appends(self):
+        """
+        Adds any pending appends to the output as a single statement.
+        """
+        if not self._appends:
+            return
+
+        self.output.add(Append(self._appends))
+        self._appends = []
+
+    def _new_output(self):
+        """
+        Returns a new, empty `ir.Block` for generated code, which counts the code written to it
+        when profiling.
+        """
+        return Block(stats=self.stats)
+
+    @contextlib.contextmanager
+    def _captured(self):
+        """
+        Context manager for adding the code generated inside the context to a new `ir.Block`,
+        which is yielded, rather than to the output. Any pending appends are added to the output
+        first, and those made inside the context to the new block.
+        """
+        self._flush_appends()
+        output = self.output
+        self.output = block = self._new_output()
+        try:
+            yield block
+            self._flush_appends()
+        finally:
+            self.output = output
+
+    def _process_body(self, body, **kwargs):
+        """
+        Processes the nodes in `body`, e.g. the body of an if block or a loop.
+
+        Returns:
+            ir.Block: The code generated for them.
+        """
+        preformatted = self._preformatted
+
+        with self._captured() as block:
+            for n in body:
+                self._process_node(n, **kwargs)
+
+        # the body may or may not be output, so if it opens or closes a `<pre>` or `<textarea>`
+        # the whitespace after it is left alone, as it might be inside one
+        self._preformatted = preformatted or self._preformatted
+
+        return block
+
+    def _get_stream_write_code(self):
+        """
+        Returns the code for writing the output so far to the `write` function passed to a
+        template compiled in the 'stream' output mode.
+        """
+        output_strategy = OUTPUT_STRATEGIES[self.output_strategy]
+        return 'if (__result.length) { __write(%s); __result = %s; }' % (
+            output_strategy.result, output_strategy.initial_value
+        )
+
+    def _write_to_stream(self):
+        """
+        In the 'stream' output mode, adds the code for writing the output so far to the `write`
+        function. Does nothing in other output modes.
+        """
+        if self.output_mode != OUTPUT_MODE_STREAM:
+            return
+
+        # whether there is anything to write, and so whether this is needed at all, is worked
+        # out by `ir.optimize`
+        self._flush_appends()
+        self.output.add(FlushStream(self._get_source_marker()))
+
+    @contextlib.contextmanager
+    def _probe(self, label, lineno, template_name=None):
+        """
+        Context manager for timing how long the code written inside the context takes to
+        render, if compiling with `instrument=True`. The time is reported to the runtime's
+        `onProfile` hook along with `label` and the template and line it comes from.
+
+        Args:
+            label (str): What is being timed, e.g. 'block content'.
+            lineno (int): The line the code comes from.
+            template_name (str, optional): The template the code comes from, if not the one
+                                           the node being processed comes from.
+        """
+        if not self.instrument:
+            yield
+            return
+
+        var_name = next(self.temp_var_names)
+        with self._execution():
+            self.output.write('var %s = __runtime.probeStart();' % var_name)
+
+        yield
+
+        with self._execution():
+            self.output.write('__runtime.probeEnd(%s, %d, %s, %s);' % (
+                js_string(template_name or self._get_source_name()), lineno, js_string(label),
+                var_name
+            ))
+
+    @contextlib.contextmanager
+    def _awaited(self, is_callee=False):
+        """
+        Context manager for awaiting the result of the JavaScript expression written inside the
+        context if it is a promise, in the async mode. Functions being called are not awaited as
+        calling the result of awaiting a method would lose its `this`.
+        """
+
+        if not self.async_mode or is_callee:
+            yield
+            return
+
+        self.output.write('((__tmp = ')
+        yield
+        self.output.write(') && typeof __tmp.then === "function" ? await __tmp : __tmp)')
+
+    def _get_source_name(self):
+        """
+        Returns the name of the template that the node being processed comes from.
+        """
+        return self._source_names[-1] if self._source_names else self.template_name
+
+    def _get_source_marker(self):
+        """
+        When making a source map, returns the marker for the line of the node being processed,
+        otherwise an empty string.
+        """
+        if self.source_map and self._lineno is not None:
+            return marker(self._get_source_name(), self._lineno)
+        return ''
+
+    def _write_source_marker(self):
+        """
+        When making a source map, marks the code written next as being generated from the line
+        of the node being processed.
+        """
+        self.output.write(self._get_source_marker())
+
     @contextlib.contextmanager
     def _execution(self):
         """
@@ -1068,7 +2156,9 @@ class JinjaToJS(object):
 
         if self.state == STATE_DEFAULT:
             did_start_executing = True
+            self._flush_appends()
             self.state = STATE_EXECUTING
+            self._write_source_marker()
 
         def close():
             if did_start_executing and self.state == STATE_EXECUTING:
@@ -1078,67 +2168,109 @@ class JinjaToJS(object):
         close()
 
     @contextlib.contextmanager
-    def _interpolation(self, safe=False):
+    def _interpolation(self, safe=False, nullable=True):
+        """
+        Context manager for outputting the result of a JavaScript expression. The expression
+        written to the output inside the context is captured and appended to the result.
+
+        Args:
+            safe (bool, optional): If True the result is not HTML escaped.
+            nullable (bool, optional): If False the result is known never to be null or
+                                       undefined, so it isn't checked for them.
+        """
 
         did_start_interpolating = False
 
         if self.state == STATE_DEFAULT:
             did_start_interpolating = True
-            self.output.write('__result += "" + ')
-            if safe is not True:
-                self.output.write('__runtime.escape')
-            self.output.write('((__tmp = (')
+            output = self.output
+            self.output = self._new_output()
             self.state = STATE_INTERPOLATING
+            self._write_source_marker()
 
         def close():
             if did_start_interpolating and self.state == STATE_INTERPOLATING:
-                self.output.write(')) == null ? "" : __tmp);')
+                captured = self.output.getvalue()
+                code = '(' + captured + ')'
+                if self.minify:
+                    # the runtime's escape function handles null and undefined itself
+                    if safe is not True:
+                        code = '__escape' + code
+                    elif nullable:
+                        code = '__str' + code
+                else:
+                    if nullable:
+                        code = '((__tmp = ' + code + ') == null ? "" : __tmp)'
+                    if safe is not True:
+                        code = '__runtime.escape' + code
+                self.output = output
+                if self.stats is not None:
+                    # the captured code was counted as it was written
+                    self.stats.add_bytes(len(code) - len(captured))
+                self._append_expression(code)
                 self.state = STATE_DEFAULT
 
         yield close
         close()
 
     @contextlib.contextmanager
-    def _scoped_variables(self, nodes_list, **kwargs):
+    def _scope(self):
         """
-        Context manager for creating scoped variables defined by the nodes in `nodes_list`.
-        These variables will be added to the context, and when the context manager exits the
-        context object will be restored to it's previous state.
+        Context manager for a scope, e.g. the body of a for loop or with block. Template variables
+        declared inside the scope shadow any with the same names outside it until the context
+        manager exits.
         """
 
-        tmp_vars = []
-        for node in nodes_list:
-
-            is_assign_node = isinstance(node, nodes.Assign)
-            name = node.target.name if is_assign_node else node.name
+        stored_names = self.stored_names.copy()
+        scope_names = self._scope_names
+        var_names = self._var_names.copy()
+        self._scope_names = set()
 
-            # create a temp variable name
-            tmp_var = next(self.temp_var_names)
+        yield
 
-            # save previous context value
-            with self._execution():
+        self.stored_names = stored_names
+        self._scope_names = scope_names
+        self._var_names = var_names
 
-                # save the current value of this name
-                self.output.write('var %s = %s.%s;' % (tmp_var, self.context_name, name))
+    def _get_variable_name(self, name, pending_var_names=()):
+        """
+        Returns the name to give a new JavaScript variable holding the template variable `name`.
+        Template variables are held in JavaScript variables with the same name unless that name
+        is reserved or is already being used for a variable that is in scope.
 
-                # add new value to context
-                self.output.write('%s.%s = ' % (self.context_name, name))
+        Args:
+            name (str): The name of the template variable.
+            pending_var_names (list of str, optional): Names that are about to be used.
+        """
 
-                if is_assign_node:
-                    self._process_node(node.node, **kwargs)
-                else:
-                    self.output.write(node.name)
+        var_names_in_use = self._var_names.union(pending_var_names)
+        var_names_in_use.add(self.js_function_name)
 
-                self.output.write(';')
+        var_name = name
+        suffix = 0
+        while var_name in var_names_in_use or var_name in RESERVED_VAR_NAMES:
+            suffix += 1
+            var_name = '%s$%d' % (name, suffix)
 
-            tmp_vars.append((tmp_var, name))
+        return var_name
 
-        yield
+    def _set_variable(self, name, var_name):
+        """
+        Records that the template variable `name` is held in the JavaScript variable `var_name`
+        for the rest of the current scope.
+        """
+        self.stored_names[name] = var_name
+        self._scope_names.add(name)
+        self._var_names.add(var_name)
 
-        # restore context
-        for tmp_var, name in tmp_vars:
-            with self._execution():
-                self.output.write('%s.%s = %s;' % (self.context_name, name, tmp_var))
+    def _declare_variable(self, name):
+        """
+        Declares the template variable `name` in the current scope and returns the name of the
+        JavaScript variable to hold it in.
+        """
+        var_name = self._get_variable_name(name)
+        self._set_variable(name, var_name)
+        return var_name
 
     @contextlib.contextmanager
     def _python_bool_wrapper(self, **kwargs):
@@ -1,10 +1,19 @@
 from __future__ import absolute_import, unicode_literals
 
+import io
 import sys
 
 import argparse
 
-from . import JinjaToJS
+from os import path
+
+from . import JinjaToJS, OUTPUT_MODES, OUTPUT_STRATEGIES
+from .batch import compile_tree, find_templates, get_source_map_file_option
+from .bundle import compile_bundle
+from .cache import CompileCache, DEFAULT_MAX_SIZE
+from .profile import CompileStats
+from .sourcemap import split_inline_source_map
+from .watch import Watcher
 
 
 DESCRIPTION = """
@@ -16,6 +25,9 @@ Three different JavaScript modules formats are supported:
   Global: the output will be a named function.
   AMD: the output will be an AMD module
   ES6: the output will be an ES6 module with a default export.
+
+Many templates can be compiled at once by passing --all (or a glob pattern instead
+of a template name) along with --out-dir.
 """
 
 
@@ -30,8 +42,9 @@ def get_arg_parser():
     )
 
     parser.add_argument(
-        "template_name",
-        help="Specifies the input file (relative to the template root)."
+        "template_name", nargs='?',
+        help="Specifies the input file (relative to the template root). This may also be a glob "
+             "pattern, in which case all matching templates are compiled into --out-dir."
     )
 
     parser.add_argument(
@@ -75,20 +88,333 @@ def get_arg_parser():
         dest="custom_filters"
     )
 
+    parser.add_argument(
+        "-s", "--output-strategy", choices=sorted(OUTPUT_STRATEGIES),
+        help="Specifies how the generated code builds up its output.",
+        default='concat',
+        dest="output_strategy"
+    )
+
+    parser.add_argument(
+        "--output-mode", choices=OUTPUT_MODES,
+        help="Specifies whether the generated function returns its output ('string') or "
+             "writes it to a function passed as its second argument ('stream').",
+        default='string',
+        dest="output_mode"
+    )
+
+    parser.add_argument(
+        "-n", "--native-loops", action='store_true',
+        help="Compile for loops to plain JavaScript for loops instead of calling a function "
+             "for each iteration.",
+        dest="native_loops"
+    )
+
+    parser.add_argument(
+        "--async", action='store_true',
+        help="Compile to an async function that awaits any promises in the context and the "
+             "templates it includes.",
+        dest="async_mode"
+    )
+
+    parser.add_argument(
+        "--minify", action='store_true',
+        help="Make the generated code smaller and collapse whitespace spanning lines in the "
+             "template's HTML.",
+        dest="minify"
+    )
+
+    parser.add_argument(
+        "--report-minified", action='store_true',
+        help="With --minify, print the number of bytes saved for each template to stderr. The "
+             "templates are compiled a second time without --minify to work this out.",
+        dest="report_minified"
+    )
+
+    parser.add_argument(
+        "-a", "--all", action='store_true',
+        help="Compile all templates in the template root matching --pattern into --out-dir.",
+        dest="all"
+    )
+
+    parser.add_argument(
+        "--pattern", nargs='?',
+        help="Specifies the glob pattern used to find templates when using --all.",
+        default='*.jinja',
+        dest="pattern"
+    )
+
+    parser.add_argument(
+        "--inline-includes", type=int, metavar="NODES",
+        help="Compile included templates with at most this many nodes into the including "
+             "template's code instead of calling them. When compiling a single template without "
+             "--cache-dir the inlined templates are printed to stderr.",
+        dest="inline_includes"
+    )
+
+    parser.add_argument(
+        "--source-map", choices=('inline', 'file'),
+        help="Generate a source map mapping the generated code to template lines, either "
+             "appended to the output or written to a file named after the output with '.map' "
+             "added.",
+        dest="source_map"
+    )
+
+    parser.add_argument(
+        "--profile", action='store_true',
+        help="Print the time spent on, and the amount of code generated for, each node type, "
+             "filter and test to stderr, along with the slowest templates when compiling many "
+             "templates. --cache-dir is ignored.",
+        dest="profile"
+    )
+
+    parser.add_argument(
+        "--instrument", action='store_true',
+        help="Time how long each block, include and for loop takes to render, reporting it to "
+             "the runtime's onProfile hook.",
+        dest="instrument"
+    )
+
+    parser.add_argument(
+        "-b", "--bundle", action='store_true',
+        help="Compile the template, or all the templates matching --pattern or a glob, and "
+             "every template they include into a single file written to --outfile.",
+        dest="bundle"
+    )
+
+    parser.add_argument(
+        "-d", "--out-dir", nargs='?',
+        help="Specifies the directory to write compiled templates to when compiling many "
+             "templates at once.",
+        dest="out_dir"
+    )
+
+    parser.add_argument(
+        "-j", "--jobs", type=int,
+        help="Specifies the number of processes to use when compiling many templates. "
+             "Use 0 for one per CPU.",
+        default=1,
+        dest="jobs"
+    )
+
+    parser.add_argument(
+        "-w", "--watch", action='store_true',
+        help="After compiling many templates keep watching the template root, recompiling "
+             "templates (and the templates that include or extend them) when they change.",
+        dest="watch"
+    )
+
+    parser.add_argument(
+        "--cache-dir", nargs='?',
+        help="Specifies a directory in which to cache compiled templates.",
+        dest="cache_dir"
+    )
+
+    parser.add_argument(
+        "--cache-size", type=int,
+        help="Specifies the maximum size of the cache in bytes.",
+        default=DEFAULT_MAX_SIZE,
+        dest="cache_size"
+    )
+
     return parser
 
 
+# Options that are handled by the command line tool rather than being passed to JinjaToJS.
+CLI_OPTIONS = ('outfile', 'cache_dir', 'cache_size', 'all', 'pattern', 'out_dir', 'jobs',
+               'watch', 'bundle', 'report_minified')
+
+GLOB_CHARS = ('*', '?', '[')
+
+# The maximum number of rows in each table printed by --profile.
+PROFILE_REPORT_LIMIT = 20
+
+
 def get_init_kwargs(options):
     kwargs = {}
     for key, value in vars(options).items():
-        if key != 'outfile':
+        if key not in CLI_OPTIONS:
             kwargs[key] = value
     return kwargs
 
 
+def get_tree_pattern(options):
+    """
+    Returns the glob pattern of templates to compile if the command line asks for many
+    templates to be compiled at once, otherwise None.
+    """
+    if options.all:
+        return options.pattern
+    if options.template_name and any(c in options.template_name for c in GLOB_CHARS):
+        return options.template_name
+    return None
+
+
+def report_rebuild(result):
+    """
+    Prints a summary of a rebuild done in watch mode.
+    """
+    if result['changed']:
+        sys.stderr.write('Changed: %s\n' % ', '.join(result['changed']))
+    for template_name, error in sorted(result['errors'].items()):
+        sys.stderr.write('Error compiling %s: %s\n' % (template_name, error))
+    sys.stderr.write('Rebuilt %d template(s) in %.1fms\n' % (
+        len(result['rebuilt']), result['seconds'] * 1000
+    ))
+
+
+def report_minified(results, unminified_results):
+    """
+    Prints the number of bytes saved by minifying each template. Both arguments are lists of
+    (template name, generated code) pairs.
+    """
+    for (template_name, output), (_, unminified) in zip(results, unminified_results):
+        sys.stderr.write('%s: %d bytes, %d bytes saved by minifying\n' % (
+            template_name, len(output), len(unminified) - len(output)
+        ))
+
+
+def write_outfile(options, output, source_map_file):
+    """
+    Writes `output` to --outfile, moving a source map appended to it to a file of its own if
+    `source_map_file` is True.
+    """
+    if source_map_file:
+        map_path = options.outfile.name + '.map'
+        output, source_map = split_inline_source_map(output, path.basename(map_path))
+        with io.open(map_path, 'w', encoding='utf-8') as f:
+            f.write(source_map)
+    options.outfile.write(output)
+
+
+def report_inlined(template_name, inlined_includes):
+    """
+    Prints the templates that were inlined into `template_name`.
+    """
+    for included_name, node_count in inlined_includes:
+        sys.stderr.write('Inlined %s (%d nodes) into %s\n' % (
+            included_name, node_count, template_name
+        ))
+
+
+def report_profile(stats):
+    """
+    Prints the combined compile statistics for the templates in `stats`, a dict mapping
+    template names to their `CompileStats`, followed by the slowest templates if there are many.
+    """
+    total = CompileStats()
+    for template_stats in stats.values():
+        total.merge(template_stats)
+
+    sys.stderr.write('Profile of compiling %d template(s), %.1fms in total:\n\n%s\n' % (
+        len(stats), total.total_time * 1000, total.format_report(PROFILE_REPORT_LIMIT)
+    ))
+
+    if len(stats) > 1:
+        slowest = sorted(stats.items(), key=lambda item: (-item[1].total_time, item[0]))
+        sys.stderr.write('\n%-48s %10s %10s\n' % ('slowest templates', 'ms', 'bytes'))
+        for template_name, template_stats in slowest[:PROFILE_REPORT_LIMIT]:
+            sys.stderr.write('%-48s %10.2f %10d\n' % (
+                template_name, template_stats.total_time * 1000, template_stats.total_bytes
+            ))
+
+
+def watch(options, pattern, kwargs):
+    del kwargs['template_name']
+    watcher = Watcher(out_dir=options.out_dir, pattern=pattern, **kwargs)
+    report_rebuild(watcher.build())
+    try:
+        watcher.run(report=report_rebuild)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
 def main():
     parser = get_arg_parser()
-    options = parser.parse_args()
-    compiler = JinjaToJS(**get_init_kwargs(options))
-    options.outfile.write(compiler.get_output())
+    # the template name is an optional positional, so it is only picked up after an option such
+    # as --watch if the positionals and options are parsed separately (Python 3.7+)
+    options = getattr(parser, 'parse_intermixed_args', parser.parse_args)()
+    kwargs = get_init_kwargs(options)
+    pattern = get_tree_pattern(options)
+
+    cache = None
+    if options.cache_dir:
+        cache = CompileCache(options.cache_dir, max_size=options.cache_size)
+
+    if options.source_map == 'file' and options.outfile is sys.stdout and \
+            (pattern is None or options.bundle):
+        parser.error('--output is required for --source-map file.')
+
+    if options.report_minified and not options.minify:
+        parser.error('--report-minified can only be used with --minify.')
+
+    if options.profile:
+        # cached output has no statistics
+        cache = None
+        if options.bundle or options.watch:
+            parser.error('--profile can not be used with --bundle or --watch.')
+
+    if options.bundle:
+        if options.watch:
+            parser.error('--watch can not be used with --bundle.')
+        if pattern is not None:
+            template_names = find_templates(options.template_root, pattern)
+        elif options.template_name:
+            template_names = [options.template_name]
+        else:
+            parser.error('a template name is required unless --all is given.')
+        del kwargs['template_name']
+        source_map_file = get_source_map_file_option(kwargs)
+        write_outfile(options, compile_bundle(template_names=template_names, **kwargs),
+                      source_map_file)
+        return 0
+
+    if pattern is not None:
+        if not options.out_dir:
+            parser.error('--out-dir is required when compiling many templates.')
+        if options.watch:
+            # rebuilds need the dependencies of each template, which are only known when it is
+            # compiled in this process rather than in a worker or read from the cache
+            if options.jobs != 1 or options.cache_dir:
+                parser.error('--jobs and --cache-dir can not be used with --watch.')
+            return watch(options, pattern, kwargs)
+        del kwargs['template_name']
+        stats = {} if kwargs.pop('profile') else None
+        results = compile_tree(pattern=pattern, out_dir=options.out_dir, cache=cache,
+                               jobs=options.jobs, stats=stats, **kwargs)
+        if stats is not None:
+            report_profile(stats)
+        if options.report_minified:
+            kwargs['minify'] = False
+            report_minified(results, compile_tree(pattern=pattern, cache=cache,
+                                                  jobs=options.jobs, **kwargs))
+        return 0
+
+    if not options.template_name:
+        parser.error('a template name is required unless --all is given.')
+
+    if options.watch:
+        parser.error('--watch can only be used when compiling many templates.')
+
+    source_map_file = get_source_map_file_option(kwargs)
+
+    if cache is not None:
+        output = cache.get_output(**kwargs)
+    else:
+        compiler = JinjaToJS(**kwargs)
+        output = compiler.get_output()
+        if options.inline_includes is not None:
+            report_inlined(options.template_name, compiler.inlined_includes)
+        if options.profile:
+            report_profile({options.template_name: compiler.stats})
+
+    write_outfile(options, output, source_map_file)
+
+    if options.report_minified:
+        kwargs['minify'] = False
+        kwargs['profile'] = False
+        report_minified([(options.template_name, output)], [
+            (options.template_name, JinjaToJS(**kwargs).get_output())
+        ])
     return 0
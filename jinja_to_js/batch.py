@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import fnmatch
+import io
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+from . import JinjaToJS, TemplateCache
+from .cache import CompileCache
+from .sourcemap import split_inline_source_map
+
+# When compiling in parallel each worker is handed this many batches of templates, which keeps
+# the workers evenly loaded without paying inter-process overhead for every single template.
+CHUNKS_PER_JOB = 4
+
+# Per-process state for worker processes, so that each worker keeps a warm `TemplateCache` (and
+# `CompileCache`) across all the templates it compiles.
+_worker_template_caches = {}
+_worker_compile_caches = {}
+
+
+def find_templates(template_root, pattern='*.jinja'):
+    """
+    Returns the names (relative to `template_root`) of all templates matching `pattern`, sorted.
+    As with `fnmatch`, a '*' in `pattern` also matches '/' so '*.jinja' matches templates in
+    sub-directories too.
+    """
+    template_names = []
+    for dir_path, _, file_names in os.walk(template_root):
+        for file_name in file_names:
+            template_name = path.relpath(path.join(dir_path, file_name), template_root)
+            template_name = template_name.replace(os.sep, '/')
+            if fnmatch.fnmatch(template_name, pattern):
+                template_names.append(template_name)
+    return sorted(template_names)
+
+
+def get_output_path(out_dir, template_name, out_ext='.js'):
+    """
+    Returns the path the compiled version of `template_name` should be written to.
+    """
+    return path.join(out_dir, path.splitext(template_name)[0] + out_ext)
+
+
+def write_output(output_path, output, source_map_file=False):
+    """
+    Writes `output` to `output_path`. If `source_map_file` is True a source map appended to
+    `output` is moved to a file of its own next to it, named after it with '.map' added.
+    """
+    if source_map_file:
+        map_path = output_path + '.map'
+        output, source_map = split_inline_source_map(output, path.basename(map_path))
+        if source_map is not None:
+            write_output(map_path, source_map)
+
+    output_dir = path.dirname(output_path)
+    if output_dir and not path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with io.open(output_path, 'w', encoding='utf-8') as f:
+        f.write(output)
+
+
+def get_source_map_file_option(kwargs):
+    """
+    Returns whether the `JinjaToJS` options `kwargs` ask for source maps to be written to files,
+    with `source_map='file'`. If they do the option is changed to 'inline', so that the source
+    maps are passed around with the output (e.g. by worker processes and caches) until they're
+    written by `write_output`.
+    """
+    if kwargs.get('source_map') == 'file':
+        kwargs['source_map'] = 'inline'
+        return True
+    return False
+
+
+def _compile(template_root, template_name, template_cache, cache, kwargs):
+    """
+    Returns the generated code for `template_name` and, if it was compiled with
+    `profile=True`, its compile statistics.
+    """
+    if cache is not None:
+        return cache.get_output(template_root, template_name,
+                                template_cache=template_cache, **kwargs), None
+    compiler = JinjaToJS(template_root=template_root,
+                         template_name=template_name,
+                         template_cache=template_cache,
+                         **kwargs)
+    return compiler.get_output(), compiler.stats
+
+
+def _compile_chunk(template_root, template_names, kwargs, cache_options):
+    """
+    Compiles `template_names` inside a worker process.
+
+    Returns:
+        tuple: A list of (template name, generated code, compile statistics) tuples and, if a
+               cache is being used, a tuple of the number of hits, misses and evictions it had.
+    """
+    if template_root not in _worker_template_caches:
+        _worker_template_caches[template_root] = TemplateCache(template_root)
+    template_cache = _worker_template_caches[template_root]
+
+    cache = None
+    counts = None
+    if cache_options is not None:
+        if cache_options not in _worker_compile_caches:
+            cache_dir, max_size = cache_options
+            _worker_compile_caches[cache_options] = CompileCache(cache_dir, max_size=max_size)
+        cache = _worker_compile_caches[cache_options]
+        initial_counts = (cache.hits, cache.misses, cache.evictions)
+
+    results = [
+        (name,) + _compile(template_root, name, template_cache, cache, kwargs)
+        for name in template_names
+    ]
+
+    if cache is not None:
+        counts = (cache.hits - initial_counts[0],
+                  cache.misses - initial_counts[1],
+                  cache.evictions - initial_counts[2])
+
+    return results, counts
+
+
+def _compile_parallel(template_root, template_names, jobs, cache, kwargs):
+    """
+    Compiles `template_names` across a pool of `jobs` processes, returning a list of
+    (template name, generated code, compile statistics) tuples in the same order as
+    `template_names`.
+    """
+    chunk_size = max(1, len(template_names) // (jobs * CHUNKS_PER_JOB))
+    chunks = [template_names[i:i + chunk_size]
+              for i in range(0, len(template_names), chunk_size)]
+    cache_options = None if cache is None else (cache.cache_dir, cache.max_size)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_compile_chunk, template_root, chunk, kwargs, cache_options)
+                   for chunk in chunks]
+        for future in futures:
+            chunk_results, counts = future.result()
+            results.extend(chunk_results)
+            if counts is not None:
+                cache.hits += counts[0]
+                cache.misses += counts[1]
+                cache.evictions += counts[2]
+
+    if cache is not None:
+        # the workers have been adding and evicting entries behind this cache's back
+        cache.refresh()
+
+    return results
+
+
+def compile_tree(template_root, pattern='*.jinja', out_dir=None, out_ext='.js', cache=None,
+                 jobs=1, stats=None, **kwargs):
+    """
+    Compiles every template in `template_root` matching `pattern`. All the templates compiled in
+    a process share a single `Environment` and `TemplateCache`, so templates that are used by many
+    others (e.g. a base layout) are only loaded once per process.
+
+    If `jobs` is greater than 1 the templates are compiled in parallel by a pool of worker
+    processes, each of which keeps its own `TemplateCache`. The output is identical to compiling
+    the templates one at a time.
+
+    Args:
+        template_root (str): The path to where templates should be loaded from.
+        pattern (str, optional): A glob pattern, relative to `template_root`, of the templates to
+                                 compile.
+        out_dir (str, optional): If given the output for each template is written to this
+                                 directory, mirroring the layout of `template_root`.
+        out_ext (str, optional): The extension to give files written to `out_dir`.
+        cache (jinja_to_js.cache.CompileCache, optional): A cache to read and store output in.
+        jobs (int, optional): The number of processes to compile with. If 0 or None one process
+                              per CPU is used.
+        stats (dict, optional): If given, the templates are compiled with `profile=True` and the
+                                `profile.CompileStats` for each template is added to it, keyed
+                                by the template's name. `cache` isn't used, as it doesn't keep
+                                statistics.
+        **kwargs: Any other options accepted by `JinjaToJS`. `source_map` may also be 'file',
+                  in which case each template's source map is written to a file next to it.
+
+    Returns:
+        list of tuple: A (template name, generated code) pair for each compiled template.
+    """
+    template_names = find_templates(template_root, pattern)
+    source_map_file = get_source_map_file_option(kwargs)
+
+    if stats is not None:
+        kwargs['profile'] = True
+        cache = None
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs > 1 and len(template_names) > 1:
+        compiled = _compile_parallel(template_root, template_names, jobs, cache, kwargs)
+    else:
+        template_cache = TemplateCache(template_root)
+        compiled = [
+            (name,) + _compile(template_root, name, template_cache, cache, kwargs)
+            for name in template_names
+        ]
+
+    results = [(name, output) for name, output, _ in compiled]
+    if stats is not None:
+        stats.update((name, template_stats) for name, _, template_stats in compiled)
+
+    if out_dir is not None:
+        for template_name, output in results:
+            write_output(get_output_path(out_dir, template_name, out_ext), output,
+                         source_map_file=source_map_file)
+
+    return results
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import collections
+
+from . import JS_MODULE_FORMATS, JinjaToJS, TemplateCache, get_js_function_name, js_string
+from .minify import minify_code
+from .sourcemap import inline_source_map, make_source_map
+
+# The code for a bundle, before it is wrapped in the module format. It evaluates to an object
+# mapping template names to template functions.
+# This string has to double all the '{' and '}' due to Python's string formatting.
+BUNDLE_WRAPPER = """(function () {{
+{functions}
+return {{{table}}};
+}})()"""
+
+
+class BundleFunctionNames(dict):
+    """
+    Maps the names of the templates compiled into a bundle to the names of their functions,
+    choosing a unique name for each template the first time it is looked up. The names start
+    with a '$', so they can't clash with the JavaScript variables holding template variables.
+    """
+
+    def __missing__(self, template_name):
+        base_name = '$' + get_js_function_name(template_name)
+        function_name = base_name
+        taken = set(self.values())
+        suffix = 1
+        while function_name in taken:
+            suffix += 1
+            function_name = '%s%d' % (base_name, suffix)
+        self[template_name] = function_name
+        return function_name
+
+
+def compile_bundle(template_root, template_names, js_module_format=None,
+                   runtime_path='jinja-to-js', template_cache=None, **kwargs):
+    """
+    Compiles `template_names`, along with every template they include (directly or indirectly),
+    into a single file. The file imports the runtime once and its value (e.g. `module.exports`
+    for the 'commonjs' module format) is an object mapping the name of each template to its
+    function. Included templates are compiled once however many templates include them, and
+    are called directly rather than being imported.
+
+    Args:
+        template_root (str): The path to where templates should be loaded from.
+        template_names (list of str): The names of the templates to compile.
+        js_module_format (str, optional): The module format of the bundle. If it isn't given the
+                                          bundle is just an expression evaluating to the object
+                                          of template functions, and expects the runtime to be
+                                          available in scope as `jinjaToJS`.
+        runtime_path (str, optional): The path the runtime is imported from.
+        template_cache (TemplateCache, optional): The cache to load and parse templates with.
+        **kwargs: Any other options accepted by `JinjaToJS`. If `source_map` is given the source
+                  map for the whole bundle is appended to it.
+
+    Returns:
+        str: The JavaScript code for the bundle.
+    """
+    if js_module_format not in JS_MODULE_FORMATS.keys():
+        raise ValueError(
+            'The js_module_format option must be one of: %s' % JS_MODULE_FORMATS.keys()
+        )
+
+    template_cache = template_cache or TemplateCache(template_root)
+    function_names = BundleFunctionNames()
+    functions = collections.OrderedDict()
+    pending = list(template_names)
+
+    while pending:
+        template_name = pending.pop(0)
+        if template_name in functions:
+            continue
+        compiler = JinjaToJS(template_root=template_root,
+                             template_name=template_name,
+                             template_cache=template_cache,
+                             bundle_functions=function_names,
+                             **kwargs)
+        functions[template_name] = compiler.get_output(markers=True)
+        pending.extend(compiler.included_templates)
+
+    bundle = BUNDLE_WRAPPER.format(
+        functions='\n'.join(functions.values()),
+        table=','.join(
+            '%s:%s' % (js_string(name), function_names[name]) for name in functions
+        )
+    )
+
+    output = JS_MODULE_FORMATS[js_module_format]([(runtime_path, 'jinjaToJS')], bundle)
+
+    if kwargs.get('minify'):
+        output = minify_code(output)
+
+    if kwargs.get('source_map'):
+        output, source_map = make_source_map(
+            output, lambda name: template_cache.get_source(name)[0]
+        )
+        output = inline_source_map(output, source_map)
+
+    return output
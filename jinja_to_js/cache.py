@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import inspect
+import io
+import json
+import os
+import tempfile
+
+from os import path
+
+from jinja2 import meta
+
+from . import JinjaToJS, TemplateCache
+
+
+# 64MB
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+ENTRY_EXT = '.js'
+MANIFEST_EXT = '.json'
+
+
+def _hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        # separate the parts so that ('ab', 'c') and ('a', 'bc') hash differently
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _compiler_fingerprint():
+    """
+    Returns a hash of the compiler's own source so that upgrading jinja-to-js invalidates any
+    output cached by a previous version.
+    """
+    package_dir = path.dirname(path.abspath(__file__))
+    parts = []
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith('.py'):
+            with io.open(path.join(package_dir, name), encoding='utf-8') as f:
+                parts.append(f.read())
+    return _hash(*parts)
+
+
+COMPILER_FINGERPRINT = _compiler_fingerprint()
+
+
+def _get_default_options():
+    """
+    Returns a dict mapping the names of the options accepted by `JinjaToJS` to their defaults.
+    """
+    try:
+        parameters = inspect.signature(JinjaToJS.__init__).parameters.values()
+    except AttributeError:  # Python 2
+        spec = inspect.getargspec(JinjaToJS.__init__)
+        return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    return dict((p.name, p.default) for p in parameters if p.default is not p.empty)
+
+
+DEFAULT_OPTIONS = _get_default_options()
+
+
+def _write_atomic(file_path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(file_path))
+    with io.open(fd, 'w', encoding='utf-8') as f:
+        f.write(data)
+    getattr(os, 'replace', os.rename)(tmp_path, file_path)
+
+
+class CompileCache(object):
+    """
+    A persistent, size-bounded, on-disk cache of compiled templates.
+
+    Entries are keyed by a hash of the compile options, the source of the template and the source
+    of every template it transitively includes or extends, so editing any of those causes a
+    recompile. Alongside each entry is a manifest listing the templates that were included or
+    extended, from which the key is worked out. When the total size of the entries and manifests
+    grows past `max_size` the least recently used files are evicted.
+
+    Usage:
+        cache = CompileCache('.jinja-to-js-cache')
+        output = cache.get_output(template_root, 'names.jinja', js_module_format='es6')
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        """
+        Args:
+            cache_dir (str): The directory to store cached output in. It is created if it does
+                             not exist.
+            max_size (int, optional): The maximum number of bytes of compiled output and
+                                      manifests to keep.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = None
+
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_output(self, template_root, template_name, **kwargs):
+        """
+        Returns the generated JavaScript code for `template_name`, compiling it only if there is
+        no up-to-date cached copy.
+
+        Args:
+            template_root (str): The path to where templates should be loaded from.
+            template_name (str): The name of the template to compile (relative to `template_root`).
+            **kwargs: Any other options accepted by `JinjaToJS`. If `template_cache` is given it
+                      is also used to read the sources the cache is keyed on.
+
+        Returns:
+            str
+        """
+        template_cache = kwargs.pop('template_cache', None) or TemplateCache(template_root)
+        options_key = self._options_key(template_root, kwargs)
+        manifest_path = self._path(_hash(options_key, template_name) + MANIFEST_EXT)
+
+        manifest = self._read_manifest(manifest_path)
+        if manifest is not None:
+            entry_key = self._entry_key(template_cache, options_key, template_name,
+                                        manifest['dependencies'])
+            entry_path = entry_key and self._path(entry_key + ENTRY_EXT)
+            if entry_path and path.exists(entry_path):
+                self.hits += 1
+                self._touch(entry_path)
+                self._touch(manifest_path)
+                with io.open(entry_path, encoding='utf-8') as f:
+                    return f.read()
+
+        self.misses += 1
+
+        compiler = JinjaToJS(template_root=template_root, template_name=template_name,
+                             template_cache=template_cache, **kwargs)
+        output = compiler.get_output()
+        dependencies = self._find_dependencies(template_cache, template_name,
+                                               compiler.referenced_templates)
+
+        entry_key = self._entry_key(template_cache, options_key, template_name, dependencies)
+        entry_path = self._path(entry_key + ENTRY_EXT)
+        self._store(entry_path, output)
+        self._store(manifest_path, json.dumps({'dependencies': dependencies}))
+        self._evict(keep=(entry_path, manifest_path))
+
+        return output
+
+    def stats(self):
+        """
+        Returns a dict of the hit, miss and eviction counts along with the number of cached
+        entries and the total size of the entries and manifests.
+        """
+        files = self._get_files()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len([file_path for file_path in files if file_path.endswith(ENTRY_EXT)]),
+            'size': sum(size for _, size in files.values()),
+        }
+
+    def refresh(self):
+        """
+        Forgets what is known about the entries in the cache directory, so that it is re-read the
+        next time it is needed. Use this if other processes have written to the same directory.
+        """
+        self._files = None
+
+    def _path(self, file_name):
+        return path.join(self.cache_dir, file_name)
+
+    def _options_key(self, template_root, options):
+        # options left at their defaults are dropped, so that passing a default explicitly shares
+        # the cache entries of not passing it at all
+        options = dict(
+            (key, value) for key, value in options.items()
+            if key not in DEFAULT_OPTIONS or value != DEFAULT_OPTIONS[key]
+        )
+        if options.get('custom_filters') is not None:
+            options['custom_filters'] = sorted(options['custom_filters'])
+        options['template_root'] = path.abspath(template_root)
+        return json.dumps(options, sort_keys=True)
+
+    def _entry_key(self, template_cache, options_key, template_name, dependencies):
+        """
+        Returns the key for the current sources of `template_name` and `dependencies`, or None
+        if any of them can no longer be loaded.
+        """
+        parts = [COMPILER_FINGERPRINT, options_key]
+        for name in [template_name] + list(dependencies):
+            try:
+                source, _ = template_cache.get_source(name)
+            except Exception:
+                return None
+            parts.append(name)
+            parts.append(source)
+        return _hash(*parts)
+
+    def _find_dependencies(self, template_cache, template_name, referenced_templates):
+        """
+        Returns the names of all templates transitively included or extended by `template_name`.
+        """
+        dependencies = []
+        pending = list(referenced_templates)
+
+        while pending:
+            name = pending.pop(0)
+            if name is None or name == template_name or name in dependencies:
+                continue
+            dependencies.append(name)
+            pending.extend(meta.find_referenced_templates(template_cache.parse(name)))
+
+        return dependencies
+
+    def _read_manifest(self, manifest_path):
+        try:
+            with io.open(manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _get_files(self):
+        """
+        Returns a dict mapping the path of each cached entry and manifest to a tuple of its
+        last-used time and size. It is read from disk once and then kept up to date as files are
+        added or removed.
+        """
+        if self._files is None:
+            self._files = {}
+            for name in os.listdir(self.cache_dir):
+                if name.endswith((ENTRY_EXT, MANIFEST_EXT)):
+                    stat = os.stat(self._path(name))
+                    self._files[self._path(name)] = (stat.st_mtime, stat.st_size)
+        return self._files
+
+    def _touch(self, file_path):
+        """
+        Marks the entry or manifest at `file_path` as just used.
+        """
+        os.utime(file_path, None)
+        if self._files is not None:
+            stat = os.stat(file_path)
+            self._files[file_path] = (stat.st_mtime, stat.st_size)
+
+    def _store(self, file_path, data):
+        _write_atomic(file_path, data)
+        stat = os.stat(file_path)
+        self._get_files()[file_path] = (stat.st_mtime, stat.st_size)
+
+    def _evict(self, keep=()):
+        """
+        Removes the least recently used entries and manifests until the cache is no bigger than
+        `max_size`. The files at the paths in `keep` are never removed.
+        """
+        files = self._get_files()
+        total_size = sum(size for _, size in files.values())
+
+        for file_path, (_, size) in sorted(files.items(), key=lambda x: x[1][0]):
+            if total_size <= self.max_size:
+                break
+            if file_path in keep:
+                continue
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            del files[file_path]
+            total_size -= size
+            if file_path.endswith(ENTRY_EXT):
+                self.evictions += 1
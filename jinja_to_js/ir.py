@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+The intermediate representation of a template's code, built by `JinjaToJS` before any code is
+emitted.
+
+A template's code is a `Block` of statements. JavaScript that the compiler writes as it is, e.g.
+expressions and variable declarations, is held in `Code` nodes, while the parts of the program
+that passes need to see are held in their own nodes: appends to the result, writes to the stream,
+loops, conditionals and calls. `optimize` rewrites a block and `Emitter` turns it into code.
+
+This is only a partial IR: it models statements, not expressions. Expressions, loop heads and
+if tests are kept as opaque strings of code, so passes can merge appends and work out where the
+result needs writing to the stream, but can't look inside or rewrite an expression.
+"""
+from __future__ import absolute_import, unicode_literals
+
+
+class Code(object):
+    """
+    JavaScript code that is emitted as it is.
+
+    Attributes:
+        parts (list of str): The pieces of code, in the order they were written.
+    """
+
+    def __init__(self, parts=None):
+        self.parts = parts if parts is not None else []
+
+    def emit(self, emitter, chunks):
+        chunks.extend(self.parts)
+
+
+class Append(object):
+    """
+    Appends text and the results of JavaScript expressions to the result.
+
+    Attributes:
+        parts (list of tuple): (is_static, value) tuples. Static values are text and the rest are
+                               JavaScript expressions.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def emit(self, emitter, chunks):
+        chunks.append(emitter.append(self.parts))
+
+
+class Write(object):
+    """
+    In the 'stream' output mode, writes text and the results of JavaScript expressions straight
+    to the `write` function, rather than appending them to the result first. Only made by
+    `optimize`, from an `Append` followed by a `FlushStream`.
+
+    Attributes:
+        parts (list of tuple): (is_static, value) tuples, as for `Append`.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def emit(self, emitter, chunks):
+        chunks.append(emitter.write(self.parts))
+
+
+class FlushStream(object):
+    """
+    In the 'stream' output mode, writes the result so far to the `write` function.
+
+    Attributes:
+        prefix (str): Code emitted before the code writing the result, e.g. a source map marker.
+                      It is dropped along with the `FlushStream` if there is nothing to write.
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
+    def emit(self, emitter, chunks):
+        chunks.append(self.prefix)
+        chunks.append(emitter.flush_stream)
+
+
+class Call(object):
+    """
+    A statement calling a function, e.g. an included template writing to the same stream.
+
+    Attributes:
+        callee (str): The JavaScript expression for the function.
+        args (str): The arguments, including the parentheses.
+        awaited (bool): Whether the result is awaited.
+    """
+
+    def __init__(self, callee, args, awaited=False):
+        self.callee = callee
+        self.args = args
+        self.awaited = awaited
+
+    def emit(self, emitter, chunks):
+        if self.awaited:
+            chunks.append('await ')
+        chunks.extend((self.callee, self.args, ';'))
+
+
+class Loop(object):
+    """
+    A loop, e.g. a JavaScript `for` loop or a call to the runtime's `each` function.
+
+    Attributes:
+        head (Block): The code opening the loop, up to and including the `{` of its body.
+        body (Block): The statements run for each item.
+        end (str): The code closing the loop.
+        marker (str): Code emitted before `end`, e.g. a source map marker.
+    """
+
+    def __init__(self, head, body, end, marker=''):
+        self.head = head
+        self.body = body
+        self.end = end
+        self.marker = marker
+
+    def blocks(self):
+        return [self.head, self.body]
+
+    def replace_blocks(self, blocks):
+        return Loop(blocks[0], blocks[1], self.end, self.marker)
+
+    def emit(self, emitter, chunks):
+        self.head.emit(emitter, chunks)
+        self.body.emit(emitter, chunks)
+        chunks.append(self.marker)
+        chunks.append(self.end)
+
+
+class Conditional(object):
+    """
+    An if statement, with any number of else ifs and an optional else.
+
+    Attributes:
+        branches (list of tuple): A (test, body) tuple of blocks for the if and each else if.
+        else_body (Block): The body of the else, or None if there isn't one.
+        markers (list of str): Code emitted before the `}` closing each branch, e.g. a source map
+                               marker. The else is closed with the first branch's.
+    """
+
+    def __init__(self, branches, else_body=None, markers=None):
+        self.branches = branches
+        self.else_body = else_body
+        self.markers = markers if markers is not None else [''] * len(branches)
+
+    def blocks(self):
+        blocks = [block for branch in self.branches for block in branch]
+        if self.else_body is not None:
+            blocks.append(self.else_body)
+        return blocks
+
+    def replace_blocks(self, blocks):
+        count = len(self.branches) * 2
+        branches = list(zip(blocks[0:count:2], blocks[1:count:2]))
+        else_body = blocks[count] if self.else_body is not None else None
+        return Conditional(branches, else_body, self.markers)
+
+    def emit(self, emitter, chunks):
+        for i, ((test, body), marker) in enumerate(zip(self.branches, self.markers)):
+            chunks.append('if(' if i == 0 else ' else if(')
+            test.emit(emitter, chunks)
+            chunks.append('){')
+            body.emit(emitter, chunks)
+            chunks.extend((marker, '}'))
+        if self.else_body is not None:
+            chunks.append(' else {')
+            self.else_body.emit(emitter, chunks)
+            chunks.extend((self.markers[0], '}'))
+
+
+class Block(object):
+    """
+    A sequence of nodes. Code can be written to it like a file, so it can be used wherever the
+    code generated for a node is collected.
+
+    Attributes:
+        nodes (list): The nodes in the block.
+        stats (profile.CompileStats): When profiling, the statistics to add the length of the code
+                                      written to the block to.
+    """
+
+    def __init__(self, nodes=None, stats=None):
+        self.nodes = nodes if nodes is not None else []
+        self.stats = stats
+
+        # the `Code` node at the end of `nodes` that code written to the block is added to, if any
+        self._code = None
+
+    def write(self, code):
+        """
+        Adds the JavaScript `code` to the end of the block.
+        """
+        if not code:
+            return
+        if self.stats is not None:
+            self.stats.add_bytes(len(code))
+        if self._code is None:
+            self._code = Code()
+            self.nodes.append(self._code)
+        self._code.parts.append(code)
+
+    def add(self, node):
+        """
+        Adds the node `node` to the end of the block.
+        """
+        self.nodes.append(node)
+        self._code = None
+
+    def extend(self, block):
+        """
+        Adds the nodes in the block `block` to the end of this block.
+        """
+        self.nodes.extend(block.nodes)
+        self._code = None
+
+    def getvalue(self):
+        """
+        Returns the code in the block, which must only contain `Code` nodes, e.g. an expression.
+        """
+        return ''.join(part for node in self.nodes for part in node.parts)
+
+    def emit(self, emitter, chunks):
+        for node in self.nodes:
+            node.emit(emitter, chunks)
+
+
+class Emitter(object):
+    """
+    Turns IR into JavaScript code.
+
+    Attributes:
+        append (function): Returns the code for an `Append` given its parts.
+        write (function): Returns the code for a `Write` given its parts.
+        flush_stream (str): The code for a `FlushStream`.
+    """
+
+    def __init__(self, append, write=None, flush_stream=''):
+        self.append = append
+        self.write = write
+        self.flush_stream = flush_stream
+
+    def emit(self, block):
+        """
+        Returns the code for the block `block`.
+
+        Returns:
+            str
+        """
+        chunks = []
+        block.emit(self, chunks)
+        return ''.join(chunks)
+
+
+def merge_parts(parts, other):
+    """
+    Returns the (is_static, value) tuples `parts` followed by `other`, joining the text of the
+    static values where they meet.
+    """
+    if parts and other and parts[-1][0] and other[0][0]:
+        return parts[:-1] + [(True, parts[-1][1] + other[0][1])] + other[1:]
+    return parts + other
+
+
+def optimize(block, stream=False, at_start=True):
+    """
+    Returns a copy of `block` with these optimisations applied to it, and to the blocks inside
+    it:
+
+    - consecutive appends are merged into one.
+    - in the 'stream' output mode, flushes with nothing to write are dropped, and appends that
+      are immediately flushed are written to the stream directly instead.
+
+    Args:
+        block (Block): The block to optimise.
+        stream (bool, optional): True if the template is compiled in the 'stream' output mode.
+        at_start (bool, optional): True if `block` is the whole of the template's code, rather
+                                   than being nested inside another statement.
+
+    Returns:
+        Block
+    """
+    nodes = []
+
+    # whether nothing but appends has been output since the result was last written to the
+    # stream, or since the start of the template
+    flushed = at_start
+
+    for node in block.nodes:
+        if isinstance(node, Append):
+            if nodes and isinstance(nodes[-1], Append):
+                nodes[-1] = Append(merge_parts(nodes[-1].parts, node.parts))
+            else:
+                nodes.append(Append(list(node.parts)))
+            continue
+
+        if stream and isinstance(node, FlushStream):
+            if flushed:
+                if nodes and isinstance(nodes[-1], Append):
+                    nodes[-1] = Write(nodes[-1].parts)
+                continue
+            flushed = True
+        elif isinstance(node, (Loop, Conditional)):
+            node = node.replace_blocks([optimize(b, stream, False) for b in node.blocks()])
+            flushed = False
+        elif not isinstance(node, Write):
+            flushed = False
+
+        nodes.append(node)
+
+    return Block(nodes)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for compiling templates with `minify=True`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import re
+
+from .sourcemap import MARKER_END, MARKER_START
+
+# Whitespace spanning lines. It is replaced with a single line break rather than removed, as
+# whitespace between inline elements is rendered, or a space, so that any inline scripts don't
+# change meaning.
+LINE_WHITESPACE_REGEX = re.compile(r'\s*\n\s*')
+
+# The start of a tag whose contents are output with their whitespace as-is.
+PREFORMATTED_TAG_REGEX = re.compile(r'<(/?)(?:pre|textarea)\b', re.IGNORECASE)
+
+IDENTIFIER_REGEX = re.compile(r'[A-Za-z_$][\w$]*')
+IDENTIFIER_CHARS = re.compile(r'[\w$]')
+TEMP_VAR_NAME_REGEX = re.compile(r'__\$(\d+)$')
+
+# The identifiers used in generated code and the shorter ones they are replaced with. None of them
+# can clash with the variables holding template variables, as Jinja names can't contain a '$'.
+SHORT_NAMES = {
+    '__result': '$r',
+    '__tmp': '$t',
+    '__runtime': '$R',
+    '__filters': '$f',
+    '__globals': '$g',
+    '__write': '$w',
+    '__parts': '$p',
+    '__escape': '$e',
+    '__str': '$s',
+    'context': '$c',
+    'ctx': '$x',
+    'locals': '$l',
+}
+
+
+def _collapse(text):
+    return LINE_WHITESPACE_REGEX.sub('\n', text)
+
+
+def collapse_whitespace(text, preformatted=False):
+    """
+    Returns `text`, a piece of a template's HTML, with any whitespace spanning lines replaced with
+    a single line break. Whitespace inside `<pre>` and `<textarea>` elements is left alone.
+
+    Args:
+        text (str): The text to collapse.
+        preformatted (bool, optional): True if `text` starts inside a `<pre>` or `<textarea>`.
+
+    Returns:
+        tuple: The collapsed text and whether it ends inside a `<pre>` or `<textarea>`.
+    """
+    parts = []
+    position = 0
+
+    for match in PREFORMATTED_TAG_REGEX.finditer(text):
+        is_closing = bool(match.group(1))
+        if is_closing != preformatted:
+            continue
+        if preformatted:
+            parts.append(text[position:match.start()])
+            position = match.start()
+        else:
+            parts.append(_collapse(text[position:match.end()]))
+            position = match.end()
+        preformatted = not preformatted
+
+    rest = text[position:]
+    parts.append(rest if preformatted else _collapse(rest))
+    return ''.join(parts), preformatted
+
+
+def _string_end(code, start):
+    """
+    Returns the index after the end of the string literal starting at `start`.
+    """
+    quote = code[start]
+    i = start + 1
+    while code[i] != quote:
+        i += 2 if code[i] == '\\' else 1
+    return i + 1
+
+
+def _template_literal_end(code, start):
+    """
+    Returns the index after the end of the template literal text starting at `start`, which is
+    either after the closing '`' or after the '${' starting a substitution.
+    """
+    i = start
+    while True:
+        if code[i] == '\\':
+            i += 2
+        elif code[i] == '`':
+            return i + 1
+        elif code.startswith('${', i):
+            return i + 2
+        else:
+            i += 1
+
+
+def _short_name(name):
+    if name in SHORT_NAMES:
+        return SHORT_NAMES[name]
+    match = TEMP_VAR_NAME_REGEX.match(name)
+    if match:
+        return '$' + match.group(1)
+    return name
+
+
+def _skip_markers(code, start):
+    # source map markers are copied as they are but are otherwise ignored
+    while code.startswith(MARKER_START, start):
+        start = code.index(MARKER_END, start) + 1
+    return start
+
+
+def _next_char(code, start):
+    i = start
+    while True:
+        i = _skip_markers(code, i)
+        if i < len(code) and code[i].isspace():
+            i += 1
+        else:
+            return code[i] if i < len(code) else ''
+
+
+def minify_code(code):
+    """
+    Returns the generated JavaScript `code` with its internal identifiers shortened and any
+    whitespace that isn't needed removed. String and template literals are left as they are.
+    """
+    out = []
+    # the depth of braces inside each template literal substitution being minified
+    substitutions = []
+    last = ''
+    i = 0
+
+    while i < len(code):
+        c = code[i]
+
+        if c.isspace():
+            j = i
+            while j < len(code) and code[j].isspace():
+                j += 1
+            following = _next_char(code, j)
+            if (IDENTIFIER_CHARS.match(last) and IDENTIFIER_CHARS.match(following)) or \
+                    (last and last == following and last in '+-'):
+                out.append(' ')
+            i = j
+            continue
+
+        if c == MARKER_START:
+            end = _skip_markers(code, i)
+            out.append(code[i:end])
+            i = end
+            continue
+
+        if c in '"\'':
+            end = _string_end(code, i)
+        elif c == '`':
+            end = _template_literal_end(code, i + 1)
+            if code[end - 1] == '{':
+                substitutions.append(0)
+        elif c == '}' and substitutions and substitutions[-1] == 0:
+            substitutions.pop()
+            end = _template_literal_end(code, i + 1)
+            if code[end - 1] == '{':
+                substitutions.append(0)
+        else:
+            match = IDENTIFIER_REGEX.match(code, i)
+            if match:
+                name = match.group()
+                i = match.end()
+                # leave property names alone, both after a '.' and as object literal keys
+                is_key = last and last in '{,' and _next_char(code, i) == ':'
+                if last != '.' and not is_key:
+                    name = _short_name(name)
+                out.append(name)
+                last = name[-1]
+                continue
+
+            if substitutions:
+                if c == '{':
+                    substitutions[-1] += 1
+                elif c == '}':
+                    substitutions[-1] -= 1
+            end = i + 1
+
+        out.append(code[i:end])
+        last = code[end - 1]
+        i = end
+
+    return ''.join(out)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for profiling compilation, see the `profile` option of `JinjaToJS`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import timeit
+
+import six
+
+# The kinds of things compile statistics are kept for.
+NODE = 'node'
+FILTER = 'filter'
+TEST = 'test'
+KINDS = (NODE, FILTER, TEST)
+
+
+class StatsEntry(object):
+    """
+    The statistics for one node type, filter or test.
+
+    Attributes:
+        visits (int): The number of times it was processed.
+        time (float): The seconds spent processing it, including processing the nodes inside it.
+                      Time spent processing it inside itself (e.g. a loop in a loop) is only
+                      counted once.
+        own_time (float): The seconds spent processing it, not including the nodes, filters and
+                          tests inside it.
+        bytes (int): The number of characters of generated code it wrote, not including the code
+                     written by the nodes, filters and tests inside it.
+    """
+
+    def __init__(self, visits=0, time=0.0, own_time=0.0, bytes=0):
+        self.visits = visits
+        self.time = time
+        self.own_time = own_time
+        self.bytes = bytes
+
+    def as_dict(self):
+        return {'visits': self.visits, 'time': self.time, 'own_time': self.own_time,
+                'bytes': self.bytes}
+
+
+class CompileStats(object):
+    """
+    Counts how many times each node type, filter and test is processed while compiling, how long
+    they take and how much code they generate.
+    """
+
+    def __init__(self):
+        # maps (kind, name) tuples to their `StatsEntry`
+        self.entries = {}
+
+        # a [key, start time, time spent in children] list for each thing being processed,
+        # innermost last
+        self._stack = []
+
+        # the number of times each key appears in `_stack`
+        self._active = {}
+
+    def start(self, kind, name):
+        """
+        Records that processing a `kind` called `name` (e.g. a 'node' called 'For') has started.
+        Every call must be followed by a call to `stop`, after processing anything inside it.
+        """
+        key = (kind, name)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = StatsEntry()
+        entry.visits += 1
+        self._active[key] = self._active.get(key, 0) + 1
+        self._stack.append([key, timeit.default_timer(), 0.0])
+
+    def stop(self):
+        """
+        Records that processing the thing passed to the last unmatched call to `start` has
+        finished.
+        """
+        key, start, child_time = self._stack.pop()
+        elapsed = timeit.default_timer() - start
+        entry = self.entries[key]
+        entry.own_time += elapsed - child_time
+        self._active[key] -= 1
+        if not self._active[key]:
+            entry.time += elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def add_child_time(self, seconds):
+        """
+        Adds `seconds` spent processing things counted elsewhere, e.g. by the statistics merged
+        by `merge`, to the time spent in the children of whatever is being processed, if
+        anything, so that it isn't counted as its own time too.
+        """
+        if self._stack:
+            self._stack[-1][2] += seconds
+
+    def add_bytes(self, count):
+        """
+        Adds `count` characters of generated code to whatever is being processed, if anything.
+        """
+        if self._stack:
+            self.entries[self._stack[-1][0]].bytes += count
+
+    def merge(self, other):
+        """
+        Adds the statistics in the `CompileStats` `other` to these.
+        """
+        for key, other_entry in six.iteritems(other.entries):
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = StatsEntry()
+            entry.visits += other_entry.visits
+            entry.time += other_entry.time
+            entry.own_time += other_entry.own_time
+            entry.bytes += other_entry.bytes
+
+    @property
+    def total_time(self):
+        """
+        The total number of seconds spent processing nodes.
+        """
+        return sum(entry.own_time for entry in six.itervalues(self.entries))
+
+    @property
+    def total_bytes(self):
+        """
+        The total number of characters of generated code written while processing nodes. Code
+        written outside of any node, e.g. for the text at the very end of a template, isn't
+        counted.
+        """
+        return sum(entry.bytes for entry in six.itervalues(self.entries))
+
+    def get(self, kind, name):
+        """
+        Returns the `StatsEntry` for the `kind` called `name`, or None if it wasn't processed.
+        """
+        return self.entries.get((kind, name))
+
+    def as_dict(self):
+        """
+        Returns the statistics as a dict, mapping each kind to a dict mapping names to the
+        statistics for them as a dict.
+        """
+        stats = dict((kind, {}) for kind in KINDS)
+        for (kind, name), entry in six.iteritems(self.entries):
+            stats[kind][name] = entry.as_dict()
+        return stats
+
+    def format_report(self, limit=None):
+        """
+        Returns a report of the statistics as a table for each kind, each sorted by own time
+        with the slowest first.
+
+        Args:
+            limit (int, optional): The maximum number of rows in each table.
+
+        Returns:
+            str
+        """
+        lines = []
+        for kind in KINDS:
+            entries = sorted(((name, entry) for (entry_kind, name), entry
+                              in six.iteritems(self.entries) if entry_kind == kind),
+                             key=lambda item: (-item[1].own_time, item[0]))
+            if not entries:
+                continue
+            if lines:
+                lines.append('')
+            lines.append('%-24s %8s %10s %10s %10s' % (
+                kind, 'visits', 'time ms', 'own ms', 'bytes'
+            ))
+            for name, entry in entries[:limit]:
+                lines.append('%-24s %8d %10.2f %10.2f %10d' % (
+                    name, entry.visits, entry.time * 1000, entry.own_time * 1000, entry.bytes
+                ))
+        return '\n'.join(lines)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for compiling templates with source maps, see the `source_map` option of `JinjaToJS`.
+
+While a template is compiled, markers naming the template and line that the code after them was
+generated from are written into the code. They are removed by `extract_mappings` once the code
+is complete, which is the only point at which its final layout is known.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import json
+import re
+
+import six
+
+# Characters from Unicode's private use area, which `js_string` always escapes, so that they can't
+# come from a template's text.
+MARKER_START = '\ue000'
+MARKER_END = '\ue001'
+MARKER_REGEX = re.compile(MARKER_START + r'([^' + MARKER_END + r']*):(\d+)' + MARKER_END)
+
+INLINE_SOURCE_MAP_PREFIX = '\n//# sourceMappingURL=data:application/json;charset=utf-8;base64,'
+INLINE_SOURCE_MAP_REGEX = re.compile(re.escape(INLINE_SOURCE_MAP_PREFIX) + r'([A-Za-z0-9+/=]*)$')
+
+BASE64_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+VLQ_SHIFT = 5
+VLQ_CONTINUATION_BIT = 1 << VLQ_SHIFT
+VLQ_MASK = VLQ_CONTINUATION_BIT - 1
+
+
+def marker(template_name, lineno):
+    """
+    Returns the marker for code generated from line `lineno` of the template `template_name`.
+    """
+    return '%s%s:%d%s' % (MARKER_START, template_name, lineno, MARKER_END)
+
+
+def encode_vlq(value):
+    """
+    Returns `value` encoded as a base 64 VLQ, as used by source map mappings.
+    """
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & VLQ_MASK
+        value >>= VLQ_SHIFT
+        if value:
+            digit |= VLQ_CONTINUATION_BIT
+        encoded += BASE64_CHARS[digit]
+        if not value:
+            return encoded
+
+
+def decode_vlqs(segment):
+    """
+    Returns the list of numbers encoded as base 64 VLQs in `segment`.
+    """
+    values = []
+    value = shift = 0
+    for char in segment:
+        digit = BASE64_CHARS.index(char)
+        value += (digit & VLQ_MASK) << shift
+        if digit & VLQ_CONTINUATION_BIT:
+            shift += VLQ_SHIFT
+        else:
+            values.append(-(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return values
+
+
+def _utf16_length(text):
+    # source map columns, like JavaScript string indexes, count UTF-16 code units
+    return len(text.encode('utf-16-le')) // 2
+
+
+def extract_mappings(code):
+    """
+    Removes the markers from `code`.
+
+    Returns:
+        tuple: The code without the markers and a list of (generated line, generated column,
+               template name, template line) tuples, with the generated lines and columns
+               counting from 0 and template lines counting from 1.
+    """
+    parts = []
+    mappings = []
+    position = 0
+    line = 0
+    line_start = ''
+
+    for match in MARKER_REGEX.finditer(code):
+        chunk = code[position:match.start()]
+        parts.append(chunk)
+        if '\n' in chunk:
+            line += chunk.count('\n')
+            line_start = chunk[chunk.rindex('\n') + 1:]
+        else:
+            line_start += chunk
+        mapping = (line, _utf16_length(line_start), match.group(1), int(match.group(2)))
+        # later markers at the same place are for nodes inside the earlier ones
+        if mappings and mappings[-1][:2] == mapping[:2]:
+            mappings[-1] = mapping
+        else:
+            mappings.append(mapping)
+        position = match.end()
+
+    parts.append(code[position:])
+    return ''.join(parts), mappings
+
+
+def build_source_map(mappings, file_name=None, sources_content=None):
+    """
+    Returns a version 3 source map, as a dict, for `mappings` as returned by `extract_mappings`.
+
+    Args:
+        mappings (list of tuple): The mappings from generated code to template lines.
+        file_name (str, optional): The name of the generated file.
+        sources_content (dict, optional): Maps template names to their source, which is
+                                          embedded in the source map.
+    """
+    sources = []
+    for _, _, template_name, _ in mappings:
+        if template_name not in sources:
+            sources.append(template_name)
+
+    lines = []
+    previous_column = previous_source = previous_source_line = 0
+    for line, column, template_name, template_line in mappings:
+        while len(lines) <= line:
+            lines.append([])
+            previous_column = 0
+        source = sources.index(template_name)
+        lines[line].append(''.join(encode_vlq(value) for value in (
+            column - previous_column,
+            source - previous_source,
+            template_line - 1 - previous_source_line,
+        )))
+        previous_column = column
+        previous_source = source
+        previous_source_line = template_line - 1
+
+    source_map = {'version': 3, 'sources': sources, 'names': []}
+    if file_name:
+        source_map['file'] = file_name
+    if sources_content is not None:
+        source_map['sourcesContent'] = [sources_content.get(name) for name in sources]
+    source_map['mappings'] = ';'.join(','.join(segments) for segments in lines)
+    return source_map
+
+
+def make_source_map(code, get_source):
+    """
+    Removes the markers from `code` and makes a source map for it.
+
+    Args:
+        code (str): Generated code including markers.
+        get_source (callable): Returns the source of a template, given its name, to embed in the
+                               source map.
+
+    Returns:
+        tuple: The code without the markers and the source map as a dict.
+    """
+    code, mappings = extract_mappings(code)
+    sources_content = dict((name, get_source(name)) for _, _, name, _ in mappings)
+    return code, build_source_map(mappings, sources_content=sources_content)
+
+
+def decode_mappings(mappings):
+    """
+    Decodes the `mappings` of a source map.
+
+    Returns:
+        list of tuple: A (generated line, generated column, source index, source line) tuple
+                       for each segment, all counting from 0.
+    """
+    decoded = []
+    source = source_line = 0
+    for line, segments in enumerate(mappings.split(';')):
+        column = 0
+        for segment in segments.split(','):
+            if not segment:
+                continue
+            values = decode_vlqs(segment)
+            column += values[0]
+            source += values[1]
+            source_line += values[2]
+            decoded.append((line, column, source, source_line))
+    return decoded
+
+
+def inline_source_map(code, source_map):
+    """
+    Returns `code` with `source_map` appended to it as a data URL.
+    """
+    data = base64.b64encode(json.dumps(source_map).encode('utf-8'))
+    return code + INLINE_SOURCE_MAP_PREFIX + data.decode('ascii')
+
+
+def split_inline_source_map(code, map_file_name):
+    """
+    Replaces a source map appended to `code` by `inline_source_map` with a link to the file
+    `map_file_name`.
+
+    Returns:
+        tuple: The new code and the source map, as JSON, or None if `code` doesn't have one.
+    """
+    match = INLINE_SOURCE_MAP_REGEX.search(code)
+    if match is None:
+        return code, None
+    source_map = base64.b64decode(match.group(1)).decode('utf-8')
+    code = code[:match.start()] + '\n//# sourceMappingURL=' + map_file_name
+    return code, six.text_type(source_map)
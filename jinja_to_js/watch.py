@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import fnmatch
+import os
+import time
+
+from os import path
+
+from . import JinjaToJS, TemplateCache
+from .batch import get_output_path, get_source_map_file_option, write_output
+
+
+class DependencyGraph(object):
+    """
+    Records which templates include or extend which others, and answers which templates need
+    recompiling when one changes.
+    """
+
+    def __init__(self):
+        # template name -> set of the templates it references
+        self.dependencies = {}
+        # template name -> set of the templates that reference it
+        self.dependents = {}
+
+    def set_dependencies(self, template_name, referenced_templates):
+        """
+        Replaces the recorded dependencies of `template_name` with `referenced_templates`.
+        """
+        self.remove(template_name)
+        self.dependencies[template_name] = set(referenced_templates)
+        for name in referenced_templates:
+            self.dependents.setdefault(name, set()).add(template_name)
+
+    def remove(self, template_name):
+        """
+        Forgets the dependencies of `template_name`. Templates that depend on it are kept.
+        """
+        for name in self.dependencies.pop(template_name, ()):
+            self.dependents[name].discard(template_name)
+
+    def get_affected(self, template_names):
+        """
+        Returns a set of `template_names` and every template that transitively depends on them.
+        """
+        affected = set()
+        pending = list(template_names)
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending.extend(self.dependents.get(name, ()))
+        return affected
+
+
+class Watcher(object):
+    """
+    Compiles a tree of templates and then, each time `poll` is called, recompiles only the
+    templates that have changed along with the templates that include or extend them.
+
+    Usage:
+        watcher = Watcher('./src/templates', './build/templates', js_module_format='es6')
+        watcher.build()
+        watcher.run()
+    """
+
+    def __init__(self, template_root, out_dir, pattern='*.jinja', out_ext='.js', **kwargs):
+        """
+        Args:
+            template_root (str): The path to where templates should be loaded from.
+            out_dir (str): The directory to write compiled templates to.
+            pattern (str, optional): A glob pattern, relative to `template_root`, of the templates
+                                     to compile.
+            out_ext (str, optional): The extension to give files written to `out_dir`.
+            **kwargs: Any other options accepted by `JinjaToJS`.
+        """
+        self.template_root = template_root
+        self.out_dir = out_dir
+        self.pattern = pattern
+        self.out_ext = out_ext
+        self.options = kwargs
+        self.source_map_file = get_source_map_file_option(self.options)
+        self.graph = DependencyGraph()
+        self.template_cache = TemplateCache(template_root)
+        self.template_names = set()
+        # templates that failed to compile last time, their dependencies are unknown so they are
+        # retried after every change
+        self.failed = set()
+        self._stats = {}
+
+    def build(self):
+        """
+        Compiles every template matching `pattern`.
+
+        Returns:
+            dict: See `poll`.
+        """
+        self._stats = self._scan()
+        self.template_names = self._match(self._stats)
+        return self._rebuild(set(), self.template_names)
+
+    def poll(self):
+        """
+        Checks the template root for added, edited or removed files and recompiles whatever they
+        affect. The compiled output of removed templates is deleted.
+
+        Returns:
+            dict or None: None if nothing changed, otherwise a dict with the names of the
+                          `changed` files, the templates that were `rebuilt`, any `errors` keyed
+                          by template name, and the number of `seconds` the rebuild took.
+        """
+        stats = self._scan()
+        changed = set(
+            name for name in set(stats) | set(self._stats)
+            if stats.get(name) != self._stats.get(name)
+        )
+        self._stats = stats
+
+        if not changed:
+            return None
+
+        for name in changed:
+            self.template_cache.invalidate(name)
+
+        template_names = self._match(stats)
+        for name in self.template_names - template_names:
+            self.graph.remove(name)
+            self._remove_output(name)
+        self.template_names = template_names
+
+        affected = (self.graph.get_affected(changed) | self.failed) & template_names
+        return self._rebuild(changed, affected)
+
+    def run(self, interval=0.5, report=None):
+        """
+        Polls for changes every `interval` seconds until interrupted, calling `report` with the
+        result of each rebuild.
+        """
+        while True:
+            result = self.poll()
+            if result is not None and report is not None:
+                report(result)
+            time.sleep(interval)
+
+    def _rebuild(self, changed, template_names):
+        start = time.time()
+        errors = {}
+
+        for template_name in sorted(template_names):
+            try:
+                compiler = JinjaToJS(template_root=self.template_root,
+                                     template_name=template_name,
+                                     template_cache=self.template_cache,
+                                     **self.options)
+                output = compiler.get_output()
+            except Exception as e:
+                errors[template_name] = e
+                continue
+
+            self.graph.set_dependencies(template_name, compiler.referenced_templates)
+            write_output(get_output_path(self.out_dir, template_name, self.out_ext), output,
+                         source_map_file=self.source_map_file)
+
+        self.failed = (self.failed - set(template_names)) | set(errors)
+
+        return {
+            'changed': sorted(changed),
+            'rebuilt': sorted(set(template_names) - set(errors)),
+            'errors': errors,
+            'seconds': time.time() - start,
+        }
+
+    def _remove_output(self, template_name):
+        """
+        Deletes the compiled output of `template_name`, and its source map file if it has one,
+        so that it can't be imported after the template is gone.
+        """
+        output_path = get_output_path(self.out_dir, template_name, self.out_ext)
+        for file_path in (output_path, output_path + '.map'):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def _match(self, template_names):
+        return set(name for name in template_names if fnmatch.fnmatch(name, self.pattern))
+
+    def _scan(self):
+        """
+        Returns a dict mapping the name of every file in the template root to its modification
+        time and size.
+        """
+        stats = {}
+        for dir_path, _, file_names in os.walk(self.template_root):
+            for file_name in file_names:
+                file_path = path.join(dir_path, file_name)
+                template_name = path.relpath(file_path, self.template_root).replace(os.sep, '/')
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                stats[template_name] = (stat.st_mtime, stat.st_size)
+        return stats
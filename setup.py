@@ -14,7 +14,8 @@ setup(
     zip_safe=False,
     install_requires=[
         'jinja2',
-        'six'
+        'six',
+        'futures; python_version < "3.2"'
     ],
     entry_points={
         'console_scripts': [
@@ -0,0 +1,41 @@
+// Sets up the runtime for rendering the templates used by the tests, see the --setup option of
+// benchmarks/render_worker.js.
+
+var jinjaToJS = require('../jinja-to-js-runtime.js');
+
+// add custom filter
+jinjaToJS.filters.unicode_snowmen = function (value) {
+    return value.split('').map(function () {
+        return '☃';
+    }).join('');
+};
+
+// add custom global
+jinjaToJS.globals.convert_to_uppercase = function (val) {
+    return val.toUpperCase();
+};
+
+function promiseOf(value) {
+    return new Promise(function (resolve) {
+        setTimeout(function () {
+            resolve(value);
+        }, 0);
+    });
+}
+
+exports.prepareContext = function (data) {
+    // the keys listed in __promised_keys__ are given to the template as promises resolving to
+    // their values, for templates compiled with async_mode=True
+    var promisedKeys = data.__promised_keys__ || [];
+    delete data.__promised_keys__;
+
+    for (var key in data) {
+        if (data[key] === '<<< MAKE ME A FUNCTION >>>') {
+            data[key] = function () { return 'hello'; };
+        } else if (promisedKeys.indexOf(key) !== -1) {
+            data[key] = promiseOf(data[key]);
+        }
+    }
+
+    return data;
+};
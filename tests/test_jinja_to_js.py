@@ -18,7 +18,17 @@ from jinja2.loaders import FileSystemLoader
 
 import pytest
 
-from jinja_to_js import JinjaToJS, is_method_call
+from benchmarks.render_worker import RenderWorker
+from jinja_to_js import JinjaToJS, TemplateCache, escape_html, is_method_call
+from jinja_to_js.batch import compile_tree, find_templates
+from jinja_to_js.bundle import BundleFunctionNames, compile_bundle
+from jinja_to_js.cache import CompileCache
+from jinja_to_js.ir import Append, Block, FlushStream, Loop, Write, optimize
+from jinja_to_js.minify import collapse_whitespace, minify_code
+from jinja_to_js.profile import FILTER, NODE
+from jinja_to_js.sourcemap import (MARKER_END, MARKER_START, decode_mappings, decode_vlqs,
+                                   encode_vlq, make_source_map, split_inline_source_map)
+from jinja_to_js.watch import DependencyGraph, Watcher
 
 if "check_output" not in dir(subprocess):
     def check_output(*popenargs, **kwargs):
@@ -52,7 +62,16 @@ class Tests(unittest.TestCase):
 
     ROOT = abspath(join(dirname(__file__)))
     TEMPLATE_PATH = os.path.join(ROOT, 'templates')
-    NODE_SCRIPT_PATH = os.path.join(ROOT, 'render_template.js')
+    RENDER_SETUP_PATH = os.path.join(ROOT, 'render_setup.js')
+
+    @classmethod
+    def setUpClass(cls):
+        # a single Node process renders the templates for every test
+        cls.render_worker = RenderWorker(setup_path=cls.RENDER_SETUP_PATH, json_encoder=Encoder)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.render_worker.close()
 
     def setUp(self):
         self.loader = FileSystemLoader(self.TEMPLATE_PATH)
@@ -61,6 +80,12 @@ class Tests(unittest.TestCase):
                                extensions=['jinja2.ext.with_', 'jinja2.ext.autoescape'])
         self.temp_dir = tempfile.mkdtemp()
 
+        # additional options passed to JinjaToJS by `_compile_js_template`
+        self.compile_options = {}
+
+        # keys of the data given to the JavaScript template as promises by `_run_test`
+        self.promised_keys = []
+
     def tearDown(self):
         shutil.rmtree(self.temp_dir)
 
@@ -120,6 +145,35 @@ class Tests(unittest.TestCase):
                       template_name='super_called_outside_of_block.jinja')
         assert str(e.value) == 'super() called outside of a block with a parent.'
 
+    def test_subclass_handlers(self):
+
+        class ReversingJinjaToJS(JinjaToJS):
+
+            def _process_filter_reverse(self, node, **kwargs):
+                with self._interpolation():
+                    with self._python_bool_wrapper(**kwargs) as new_kwargs:
+                        self.output.write('(')
+                        self._process_node(node.node, **new_kwargs)
+                        self.output.write(' + "").split("").reverse().join("")')
+
+            def _process_test_empty(self, node, **kwargs):
+                self.output.write('!__runtime.boolean(')
+                self._process_node(node.node, **kwargs)
+                self.output.write(')')
+
+        with open(os.path.join(self.temp_dir, 'reverse.jinja'), 'w') as f:
+            f.write('{% if foo is empty %}{{ foo|reverse }}{% endif %}')
+
+        output = ReversingJinjaToJS(template_root=self.temp_dir,
+                                    template_name='reverse.jinja').get_output()
+        assert '!__runtime.boolean(context.foo)' in output
+        assert '(context.foo + "").split("").reverse().join("")' in output
+
+        # the handlers are only available to the subclass
+        with pytest.raises(Exception) as e:
+            JinjaToJS(template_root=self.temp_dir, template_name='reverse.jinja')
+        assert str(e.value) == 'Unsupported test: empty'
+
     def test_if(self):
         for foo in [True, False]:
             for bar in [True, False]:
@@ -294,6 +348,607 @@ class Tests(unittest.TestCase):
         self._run_test('escape.jinja',
                        some_user_input='<script>alert("hello");</script><p class="foo"></p>')
 
+    def test_constant_folding(self):
+        self._run_test('constant_folding.jinja')
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                           template_name='constant_folding.jinja').get_output()
+
+        # constants are folded and escaped at compile time and all the output before the first
+        # if statement is appended in one go
+        assert '__runtime.' not in output
+        assert output.count('__result += ') == 4
+        assert '&lt;b&gt;Tom &amp; Jerry&lt;/b&gt;' in output
+        assert '3.5 3 -3 9 ab 2' in output
+        assert 'if(true && true)' in output
+
+    def test_output_strategies(self):
+        for output_strategy in ('concat', 'array', 'template-literal'):
+            self.compile_options = dict(output_strategy=output_strategy)
+            self._run_test('special_characters.jinja', value='${value} \\ `')
+            self._run_test('escape.jinja', some_user_input='<script>alert("hello");</script>')
+            self._run_test('filters/abs.jinja', some_number=5, some_float=5.5)
+            self._run_test('loop_helpers.jinja', things=[1, 2, 3])
+            self._run_test('extends.jinja')
+            self._run_test('unicode.jinja', snowman=u'☃')
+            self._run_test('include.jinja',
+                           additional=['includes/name.jinja',
+                                       'includes/quiet_name.jinja',
+                                       'includes/nested/loud_name.jinja'],
+                           the_beatles=['John', 'Paul'])
+
+    def test_unknown_output_strategy(self):
+        with pytest.raises(ValueError):
+            JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='if.jinja',
+                      output_strategy='unknown')
+
+    def test_escape_elimination(self):
+        self._run_test('escape_elimination.jinja', items=[
+            dict(count=3, label='<i>'),
+            dict(count=10, label='"42"'),
+        ])
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                           template_name='escape_elimination.jinja',
+                           native_loops=True).get_output()
+
+        # only the last three interpolations might not be numbers
+        assert output.count('__runtime.escape(') == 3
+        assert output.count('== null') == 3
+
+        # in loops compiled to callbacks the loop helpers come from the callback's arguments,
+        # which aren't necessarily numbers, so they are escaped
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                           template_name='escape_elimination.jinja').get_output()
+        assert output.count('__runtime.escape(') == 6
+
+    def test_loop_helpers_over_items(self):
+        things = {'<script>x</script>': 1}
+
+        self.compile_options = dict(native_loops=True)
+        self._run_test('loop_helpers_items.jinja', things=things)
+
+        # when iterating over an object the callback's index argument is the key
+        self.compile_options = {}
+        path = self._compile_js_template('loop_helpers_items.jinja')
+        output = self.render_worker.render(path, dict(things=things))['output']
+        assert '<script>' not in output
+        assert '&lt;script&gt;' in output
+
+    def test_native_loops(self):
+        self.compile_options = dict(native_loops=True)
+        self._run_test('loop_helpers.jinja', things=[1, 2, 3, 4, 5, 6])
+        self._run_test('iteration_list.jinja', values=[1, 2, 3, 4, 5, 6])
+        self._run_test('iteration_items.jinja', thing=dict(one='one', two='two'))
+        self._run_test('iteration_values.jinja', thing=dict(one='one', two='two'))
+        self._run_test('iteration_keys.jinja', thing=dict(key='value'))
+        self._run_test('nested_loops.jinja',
+                       rows=[['a', 'b'], ['<c>'], []],
+                       totals=dict(first=[1, 0, 2], second=[0, 3]))
+        self._run_test('include.jinja',
+                       additional=['includes/name.jinja',
+                                   'includes/quiet_name.jinja',
+                                   'includes/nested/loud_name.jinja'],
+                       the_beatles=['John', 'Paul'])
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='nested_loops.jinja',
+                           native_loops=True).get_output()
+
+        assert '__runtime.each(' not in output
+        assert 'arguments' not in output
+
+    def test_stream_output_mode(self):
+        self.compile_options = dict(output_mode='stream')
+        self._run_test('extends.jinja')
+        self._run_test('scoping.jinja', additional=['partials/greeting.jinja'],
+                       names=['john', 'paul'])
+        self._run_test('include.jinja',
+                       additional=['includes/name.jinja',
+                                   'includes/quiet_name.jinja',
+                                   'includes/nested/loud_name.jinja'],
+                       the_beatles=['John', 'Paul'])
+        self._run_test('recursive_include.jinja',
+                       data=dict(value=1, child=dict(value=2, child=dict(value=3))))
+
+        for output_strategy in ('array', 'template-literal'):
+            self.compile_options['output_strategy'] = output_strategy
+            self._run_test('extends.jinja')
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='extends.jinja',
+                           output_mode='stream').get_output()
+
+        # the output is written at the start and end of each block and at the end of the template
+        assert output.count('__write(') == 9
+        assert 'return ' not in output
+
+    def test_async_mode(self):
+        self.promised_keys = ['user', 'items']
+
+        for output_mode in ('string', 'stream'):
+            self.compile_options = dict(async_mode=True, output_mode=output_mode)
+            self._run_test('async.jinja',
+                           additional=['includes/name.jinja',
+                                       'includes/quiet_name.jinja',
+                                       'includes/nested/loud_name.jinja',
+                                       'partials/greeting.jinja'],
+                           user=dict(name='paul & co', admin=True),
+                           items=[dict(label='a'), dict(label='b')],
+                           guest='john',
+                           greeting='hello')
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='async.jinja',
+                           async_mode=True).get_output()
+
+        assert 'async function' in output
+        # every include starts rendering where it is, with the variables set at that point, and
+        # they are all awaited together at the end
+        assert output.count('__runtime.defer(') == 3
+        assert output.count('Promise.all(') == 1
+
+    def test_minify(self):
+        self.compile_options = dict(minify=True)
+        self._run_test('minify.jinja', items=['a', 'b'], title='Title', count=2)
+        self._run_test('scoping.jinja', additional=['partials/greeting.jinja'],
+                       names=['john', 'paul'])
+        self._run_test('extends.jinja')
+        self._run_test('loop_helpers.jinja')
+        self._run_test('include.jinja',
+                       additional=['includes/name.jinja',
+                                   'includes/quiet_name.jinja',
+                                   'includes/nested/loud_name.jinja'],
+                       the_beatles=['John', 'Paul'])
+
+        for output_strategy in ('array', 'template-literal'):
+            self.compile_options['output_strategy'] = output_strategy
+            self._run_test('minify.jinja', items=['a', 'b'], title='Title', count=2)
+
+        self.compile_options = dict(minify=True, output_mode='stream', native_loops=True)
+        self._run_test('extends.jinja')
+        self._run_test('nested_loops.jinja',
+                       rows=[['a', 'b'], ['<c>'], []],
+                       totals=dict(first=[1, 0, 2], second=[0, 3]))
+
+        self.compile_options = dict(minify=True, async_mode=True)
+        self.promised_keys = ['user', 'items']
+        self._run_test('async.jinja',
+                       additional=['includes/name.jinja',
+                                   'includes/quiet_name.jinja',
+                                   'includes/nested/loud_name.jinja',
+                                   'partials/greeting.jinja'],
+                       user=dict(name='paul & co', admin=True),
+                       items=[dict(label='a'), dict(label='b')],
+                       guest='john',
+                       greeting='hello')
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='minify.jinja',
+                           minify=True).get_output()
+        assert '__' not in output
+        assert '<div class=\\"outer\\">\\n<ul>\\n' in output
+        # whitespace in <pre> elements and Jinja strings is left alone
+        assert '<pre>\\n  keep\\n      "' in output
+        assert 'string   \\n   constant' in output
+
+        # whether text is inside a <pre> element can depend on which branch of an if is output
+        for short in (True, False):
+            path = self._compile_js_template('minify_preformatted.jinja')
+            assert self.render_worker.render(path, dict(short=short))['output'] == \
+                self.env.get_template('minify_preformatted.jinja').render(short=short)
+
+    def test_collapse_whitespace(self):
+        assert collapse_whitespace('<p>\n  <b>a</b>  \n  b  c\n\n</p>') == \
+            ('<p>\n<b>a</b>\nb  c\n</p>', False)
+        # whitespace between inline elements is rendered, so it is never removed
+        assert collapse_whitespace('<b>a</b>\n  <i>b</i>') == ('<b>a</b>\n<i>b</i>', False)
+        assert collapse_whitespace('<pre>\n  a') == ('<pre>\n  a', True)
+        assert collapse_whitespace('\n  a</pre>\n  <p>', True) == ('\n  a</pre>\n<p>', False)
+        assert collapse_whitespace('<PRE>a</PRE>\n b') == ('<PRE>a</PRE>\nb', False)
+
+    def test_minify_code(self):
+        assert minify_code('var __result = "  __result  ";\n  return __result;') == \
+            'var $r="  __result  ";return $r;'
+        assert minify_code('x - -y + +z') == 'x- -y+ +z'
+        assert minify_code('__runtime.context(context, {context:context$1, a:__$12})') == \
+            '$R.context($c,{context:context$1,a:$12})'
+        assert minify_code('__tmp ? __tmp : `a ${ {a: __tmp}.a } ${__tmp} b`') == \
+            '$t?$t:`a ${{a:$t}.a} ${$t} b`'
+
+    def test_bundle(self):
+        tests = [
+            ('include.jinja', dict(the_beatles=['John', 'Paul'])),
+            ('include_deduping.jinja', {}),
+            ('scoping.jinja', dict(names=['john', 'paul'])),
+            ('recursive_include.jinja', dict(data=dict(value=1, child=dict(value=2)))),
+            ('extends.jinja', {}),
+        ]
+
+        for native_loops in (False, True):
+            output = compile_bundle(self.TEMPLATE_PATH, [name for name, _ in tests],
+                                    js_module_format='commonjs',
+                                    runtime_path=abspath('jinja-to-js-runtime.js'),
+                                    native_loops=native_loops)
+            bundle_path = self._write_to_temp_file(output)
+
+            # the runtime is imported once and each included template is compiled once, even
+            # though they are included by several templates
+            assert output.count('require(') == 1
+            assert output.count('function $templateIncludesName(') == 1
+            assert output.count('function $templatePartialsGreeting(') == 1
+            assert 'jinjaToJS.include' not in output
+
+            for name, data in tests:
+                jinja_result = self.env.get_template(name).render(**data).strip()
+                js_result = self.render_worker.render(bundle_path, data, export=name)['output']
+                assert jinja_result == js_result.strip()
+
+    def test_bundle_function_names(self):
+        names = BundleFunctionNames()
+        assert names['a_b.jinja'] == '$templateAB'
+        assert names['a/b.jinja'] == '$templateAB2'
+        assert names['a_b.jinja'] == '$templateAB'
+
+    def test_inline_includes(self):
+        nodes = [dict(value='a', children=[dict(value='b', children=[dict(value='c')])]),
+                 dict(value='d')]
+
+        for native_loops in (False, True):
+            self.compile_options = dict(inline_includes=100, native_loops=native_loops)
+            self._run_test('include.jinja', the_beatles=['John', 'Paul'])
+            self._run_test('scoping.jinja', names=['john', 'paul'])
+            self._run_test('tree.jinja', additional=['partials/node.jinja'], nodes=nodes)
+
+        # an inlined template sees the loop helpers of the loop including it, which Jinja's
+        # includes don't
+        for output_mode in ('string', 'stream'):
+            self.compile_options = dict(inline_includes=100, native_loops=True,
+                                        output_mode=output_mode)
+            path = self._compile_js_template('inlined_loop_helpers.jinja')
+            assert self.render_worker.render(path, dict(items=['a', 'b']),
+                                             stream=output_mode == 'stream')['output'] == '1;2;'
+
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                           template_name='inlined_loop_helpers.jinja', inline_includes=100,
+                           native_loops=True).get_output()
+        assert 'arguments' not in output
+
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='include.jinja',
+                             js_module_format='commonjs', inline_includes=100)
+        assert compiler.inlined_includes == [('includes/name.jinja', 6),
+                                             ('includes/nested/loud_name.jinja', 6),
+                                             ('includes/quiet_name.jinja', 4)]
+        assert 'require("./includes' not in compiler.get_output()
+
+        # only templates at or under the threshold are inlined
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='include.jinja',
+                             js_module_format='commonjs', inline_includes=5)
+        assert compiler.inlined_includes == []
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                             template_name='includes/nested/loud_name.jinja',
+                             js_module_format='commonjs', inline_includes=5)
+        assert compiler.inlined_includes == [('includes/quiet_name.jinja', 4)]
+
+        # a recursive include is inlined once and then calls the included template
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='tree.jinja',
+                             js_module_format='commonjs', inline_includes=100)
+        assert [name for name, _ in compiler.inlined_includes] == ['partials/node.jinja']
+        assert compiler.get_output().count('require("./partials/node")') == 1
+
+    def test_source_map(self):
+        expected_lines = dict(alpha=1, beta=2, gamma=3, delta=5, epsilon=6)
+
+        for options in (dict(), dict(minify=True), dict(native_loops=True)):
+            compiler = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                                 template_name='source_map.jinja', js_module_format='commonjs',
+                                 source_map=True, **options)
+            output = compiler.get_output()
+            source_map = compiler.get_source_map()
+
+            assert MARKER_START not in output and MARKER_END not in output
+            assert source_map['sources'] == ['source_map.jinja']
+            with open(os.path.join(self.TEMPLATE_PATH, 'source_map.jinja')) as f:
+                assert source_map['sourcesContent'] == [f.read()]
+
+            # the code reading each variable maps back to the line of the template using it
+            context = '$c.' if options.get('minify') else 'context.'
+            for name, template_line in expected_lines.items():
+                assert self._get_source_location(output, source_map, context + name) == \
+                    ('source_map.jinja', template_line)
+
+        # as does the code closing an if block or a loop
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='source_map.jinja',
+                             source_map=True)
+        output = compiler.get_output()
+        source_map = compiler.get_source_map()
+        assert self._get_source_location(output, source_map, '}__result') == \
+            ('source_map.jinja', 2)
+        assert self._get_source_location(output, source_map, '});') == ('source_map.jinja', 5)
+
+        # the markers the source map is made from can be kept in the code, e.g. for bundling
+        marked = compiler.get_output(markers=True)
+        assert MARKER_START in marked and MARKER_END in marked
+        assert make_source_map(marked, lambda name: '')[0] == output
+
+        # blocks map to the template defining them, and inlined includes to the included template
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                             template_name='source_map_child.jinja', source_map=True)
+        output = compiler.get_output()
+        source_map = compiler.get_source_map()
+        assert self._get_source_location(output, source_map, 'context.layout_value') == \
+            ('source_map_layout.jinja', 1)
+        assert self._get_source_location(output, source_map, 'context.child_value') == \
+            ('source_map_child.jinja', 4)
+
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='include.jinja',
+                             source_map=True, inline_includes=100)
+        compiler.get_output()
+        assert 'includes/quiet_name.jinja' in compiler.get_source_map()['sources']
+
+        # without the option the output is unchanged
+        inline = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='source_map.jinja',
+                           source_map='inline').get_output()
+        assert inline.rsplit('\n//# sourceMappingURL=', 1)[0] == JinjaToJS(
+            template_root=self.TEMPLATE_PATH, template_name='source_map.jinja').get_output()
+
+        self.compile_options = dict(source_map='inline')
+        self._run_test('source_map.jinja', alpha='a', beta=True, gamma='<g>', delta=[1, 2],
+                       epsilon='e', explode=False)
+
+    def test_source_map_vlq(self):
+        values = list(range(-100, 101)) + [1000, -1000, 123456789]
+        assert decode_vlqs(''.join(encode_vlq(value) for value in values)) == values
+        assert encode_vlq(0) == 'A'
+        assert encode_vlq(-1) == 'D'
+        assert encode_vlq(16) == 'gB'
+
+    def test_source_map_files(self):
+        out_dir = os.path.join(self.temp_dir, 'out')
+        results = compile_tree(self.TEMPLATE_PATH, pattern='source_map.jinja', out_dir=out_dir,
+                               js_module_format='commonjs', source_map='file')
+
+        with open(os.path.join(out_dir, 'source_map.js')) as f:
+            code = f.read()
+        with open(os.path.join(out_dir, 'source_map.js.map')) as f:
+            source_map = json.load(f)
+
+        assert code == split_inline_source_map(results[0][1], 'source_map.js.map')[0]
+        assert code.endswith('\n//# sourceMappingURL=source_map.js.map')
+        assert source_map['sources'] == ['source_map.jinja']
+
+        inline = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='source_map.jinja',
+                           js_module_format='commonjs', source_map='inline').get_output()
+        split_code, split_map = split_inline_source_map(inline, 'source_map.js.map')
+        assert split_code == code
+        assert json.loads(split_map) == source_map
+        assert split_inline_source_map(split_code, 'other.map') == (split_code, None)
+
+    def test_runtime_types(self):
+        # the fast paths in the runtime give the same results as `Object.prototype.toString`
+        script = """
+            var runtime = require(%s).runtime;
+            var tagged = {};
+            tagged[Symbol.toStringTag] = 'Tagged';
+            function Point() { this.x = 1; }
+            var values = ['', 'a', 0, 1, NaN, true, false, null, undefined, [], [0], {}, {a: 1},
+                          Object.create(null), tagged, new Point(), new Date(0), /a/,
+                          new String('a'), new Number(1), new Map(), Symbol('a'), BigInt(1),
+                          function () {}, async function () {}, Math, JSON];
+            process.stdout.write(JSON.stringify(values.map(function (value) {
+                return [
+                    runtime.type(value),
+                    Object.prototype.toString.call(value).slice(8, -1),
+                    runtime.boolean(value),
+                    runtime.isEqual(value, value),
+                    runtime.isEqual(value, []),
+                    runtime.isEqual(value, {})
+                ];
+            })));
+        """ % json.dumps(abspath('jinja-to-js-runtime.js'))
+        results = json.loads(check_output(['node', '-e', script]).decode('utf8'))
+
+        for i, (runtime_type, expected_type, boolean, equal, equal_array,
+                equal_object) in enumerate(results):
+            assert runtime_type == expected_type
+            # every value is equal to itself apart from NaN
+            assert equal is (i != 4)
+            assert equal_array is (expected_type == 'Array' and not boolean)
+            assert equal_object is (expected_type == 'Object' and not boolean)
+
+        assert [boolean for _, _, boolean, _, _, _ in results] == [
+            False, True, False, True, False, True, False, False, False, False, True, False, True,
+            False, True, True, True, True, True, True, True, True, True, True, True, True, True,
+        ]
+
+    def test_runtime_escape(self):
+        strings = ['', 'plain', '&', '<>', '&&&', 'a & b', '<b>"bold"</b>', "it's `code`",
+                   'ends with <', '> starts', '☃ & ☃', '\U0001f600<\U0001f600', '&amp;',
+                   'x' * 1000 + '<' + 'y' * 1000]
+        values = [42, 1.5, -0.0, True, False, None, [1, '<'], {'a': 1}]
+        script = """
+            var runtime = require(%s).runtime;
+            var values = JSON.parse(process.argv[1]);
+            values.push(undefined);
+            process.stdout.write(JSON.stringify(values.map(runtime.escape)));
+        """ % json.dumps(abspath('jinja-to-js-runtime.js'))
+        results = json.loads(check_output(
+            ['node', '-e', script, json.dumps(strings + values)]
+        ).decode('utf8'))
+
+        assert results[:len(strings)] == [escape_html(value) for value in strings]
+        assert results[len(strings):] == ['42', '1.5', '0', 'true', 'false', '', '1,&lt;',
+                                          '[object Object]', '']
+
+        # apart from apostrophes and backticks, which it escapes differently, the runtime escapes
+        # strings exactly like Jinja
+        for value, result in zip(strings, results):
+            if "'" not in value and '`' not in value:
+                assert result == self.env.from_string('{{ value }}').render(value=value)
+
+    def test_profile(self):
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='source_map.jinja',
+                             profile=True)
+        output = compiler.get_output()
+        stats = compiler.stats
+
+        assert output == JinjaToJS(template_root=self.TEMPLATE_PATH,
+                                   template_name='source_map.jinja').get_output()
+        assert JinjaToJS(template_root=self.TEMPLATE_PATH,
+                         template_name='source_map.jinja').stats is None
+
+        assert stats.get(NODE, 'For').visits == 1
+        assert stats.get(NODE, 'If').visits == 2
+        assert stats.get(FILTER, 'upper').visits == 1
+        assert stats.get(NODE, 'Output').time >= stats.get(NODE, 'Output').own_time > 0
+
+        # the code written for each node is counted once, apart from the code written after the
+        # last node
+        template_code = compiler._get_template_code()
+        assert 0 < stats.total_bytes <= len(template_code)
+        assert stats.get(FILTER, 'upper').bytes >= len('context.gamma.toUpperCase()')
+
+        # every test in a template is profiled
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='tests.jinja',
+                             profile=True)
+        test_count = len(list(compiler.ast.find_all(nodes.Test)))
+        assert sum(entry['visits'] for entry in compiler.stats.as_dict()['test'].values()) == \
+            test_count
+
+        # the statistics for parent templates are included
+        compiler = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                             template_name='source_map_child.jinja', profile=True)
+        extends = compiler.stats.get(NODE, 'Extends')
+        assert extends.visits == 1
+        # every other node is processed while compiling the parent, which is only counted once
+        assert compiler.stats.total_time <= extends.time + 1e-9
+        assert compiler.stats.get(NODE, 'Block').visits == 1
+        assert compiler.stats.get(NODE, 'Name').visits == 2
+        assert 'Block' in compiler.stats.format_report()
+
+        # compile_tree collects the statistics of every template
+        stats = {}
+        results = compile_tree(self.TEMPLATE_PATH, pattern='source_map*.jinja', stats=stats)
+        assert sorted(stats) == [name for name, _ in results]
+        single = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='source_map.jinja',
+                           profile=True).stats
+        assert [(key, entry.visits, entry.bytes)
+                for key, entry in sorted(stats['source_map.jinja'].entries.items())] == \
+            [(key, entry.visits, entry.bytes) for key, entry in sorted(single.entries.items())]
+
+    def test_instrument(self):
+        beatles = ['John', 'Paul']
+        includes = ['includes/name.jinja', 'includes/quiet_name.jinja',
+                    'includes/nested/loud_name.jinja']
+        for options in ({}, dict(native_loops=True), dict(output_mode='stream'),
+                        dict(minify=True), dict(inline_includes=10)):
+            self.compile_options = dict(options, instrument=True)
+            self._run_test('include.jinja', additional=includes, the_beatles=beatles)
+            self._run_test('extends.jinja')
+            self._run_test('source_map_child.jinja', additional=['source_map_layout.jinja'],
+                           layout_value='a', child_value='b')
+
+        self.promised_keys = ['user', 'items']
+        self.compile_options = dict(instrument=True, async_mode=True)
+        self._run_test('async.jinja', additional=includes + ['partials/greeting.jinja'],
+                       user=dict(name='paul', admin=True), items=[dict(label='a')],
+                       guest='john', greeting='hello')
+
+        # without the option the output has no probes
+        output = JinjaToJS(template_root=self.TEMPLATE_PATH,
+                           template_name='include.jinja').get_output()
+        assert 'probe' not in output
+        assert output != JinjaToJS(template_root=self.TEMPLATE_PATH,
+                                   template_name='include.jinja', instrument=True).get_output()
+
+        # the time taken is reported to onProfile, by template and line
+        self.promised_keys = []
+        self.compile_options = dict(instrument=True)
+        names = ['include.jinja', 'source_map_child.jinja', 'source_map_layout.jinja']
+        paths = [self._compile_js_template(name) for name in names + includes]
+        script = """
+            var jinjaToJS = require(%s);
+            var profiler = jinjaToJS.onProfile = jinjaToJS.createProfiler();
+            require(%s)({the_beatles: %s});
+            require(%s)({layout_value: 'a', child_value: 'b'});
+            process.stdout.write(JSON.stringify(profiler.results));
+        """ % (json.dumps(abspath('jinja-to-js-runtime.js')), json.dumps(abspath(paths[0])),
+               json.dumps(beatles), json.dumps(abspath(paths[1])))
+        results = json.loads(check_output(['node', '-e', script]).decode('utf8'))
+
+        assert sorted(results) == [
+            'include.jinja:2 for',
+            'include.jinja:3 include includes/name.jinja',
+            'includes/name.jinja:3 include includes/nested/loud_name.jinja',
+            'includes/nested/loud_name.jinja:3 include includes/quiet_name.jinja',
+            'source_map_child.jinja:3 block content',
+        ]
+        assert results['include.jinja:2 for']['calls'] == 1
+        include = results['include.jinja:3 include includes/name.jinja']
+        assert include['template'] == 'include.jinja'
+        assert include['line'] == 3
+        assert include['calls'] == 2
+        assert include['maxMs'] <= include['totalMs']
+        assert results['source_map_child.jinja:3 block content']['calls'] == 1
+
+    def test_ir(self):
+        for name, source in (('appends.jinja', '{{ a }}b{{ c }}{% if d %}e{% elif f %}g'
+                                               '{% else %}h{% endif %}'),
+                             ('partial.jinja', 'p'),
+                             ('stream.jinja', 'a{% include "partial.jinja" %}{% for x in xs %}'
+                                              '{{ x }}{% include "partial.jinja" %}{% endfor %}')):
+            with open(os.path.join(self.temp_dir, name), 'w') as f:
+                f.write(source)
+
+        # consecutive appends are merged into one statement, and elifs are part of the if
+        output = JinjaToJS(template_root=self.temp_dir, template_name='appends.jinja').get_output()
+        assert output.count('__result +=') == 4
+        assert '} else if(__runtime.boolean(context.f)){' in output
+        assert '} else {__result += "h";}' in output
+
+        # in the stream output mode, text before an include is written straight to the stream,
+        # and the result is only written where there may be something to write
+        output = JinjaToJS(template_root=self.temp_dir, template_name='stream.jinja',
+                           output_mode='stream').get_output()
+        assert '__write("a");jinjaToJS.include("partial")' in output
+        assert output.count('if (__result.length)') == 2
+
+        # consecutive appends are merged, and in the stream output mode appends that are flushed
+        # straight away are written directly and flushes with nothing to write are dropped
+        loop_body = Block()
+        loop_body.add(FlushStream())
+        loop_body.add(Append([(True, 'b')]))
+        loop_body.add(FlushStream())
+        block = Block([FlushStream(), Append([(True, 'a')]), Append([(False, 'x')]),
+                       FlushStream(), FlushStream(), Loop(Block(), loop_body, '}'),
+                       FlushStream()])
+        optimized = optimize(block, stream=True)
+        assert [type(n) for n in optimized.nodes] == [Write, Loop, FlushStream]
+        assert optimized.nodes[0].parts == [(True, 'a'), (False, 'x')]
+        assert [type(n) for n in optimized.nodes[1].body.nodes] == [FlushStream, Write]
+        assert len(block.nodes) == 7
+
+        # in other output modes flushes are left alone
+        assert [type(n) for n in optimize(block).nodes] == \
+            [FlushStream, Append, FlushStream, FlushStream, Loop, FlushStream]
+
+    def test_unknown_output_mode(self):
+        with pytest.raises(ValueError):
+            JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='if.jinja',
+                      output_mode='unknown')
+
+    def test_scoping(self):
+        for native_loops in (False, True):
+            self.compile_options = dict(native_loops=native_loops)
+            self._run_test('scoping.jinja', additional=['partials/greeting.jinja'],
+                           names=['john', 'paul'])
+            self._run_test('nested_loops.jinja',
+                           rows=[['a', 'b'], ['<c>'], []],
+                           totals=dict(first=[1, 0, 2], second=[0, 3]))
+
+            output = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='scoping.jinja',
+                               native_loops=native_loops).get_output()
+
+            # scoped variables are JavaScript variables, rather than being added to the context
+            assert 'context.name =' not in output
+            assert 'function ()' not in output
+
     def test_function_calls(self):
         self._run_test('function_calls.jinja', foo=lambda: 'hello')
 
@@ -351,6 +1006,212 @@ class Tests(unittest.TestCase):
         import_count = len(re.findall('import', output))
         assert import_count == 1
 
+    def test_compile_cache_hits_and_misses(self):
+        cache = CompileCache(os.path.join(self.temp_dir, 'cache'))
+
+        output = cache.get_output(self.TEMPLATE_PATH, 'include.jinja', js_module_format='es6')
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        assert cache.get_output(self.TEMPLATE_PATH, 'include.jinja',
+                                js_module_format='es6') == output
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # different options are cached separately
+        cache.get_output(self.TEMPLATE_PATH, 'include.jinja', js_module_format='commonjs')
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        # options are only left out of the key when they have their default value
+        cache.get_output(self.TEMPLATE_PATH, 'include.jinja', js_module_format='commonjs',
+                         runtime_path='jinja-to-js')
+        assert (cache.hits, cache.misses) == (2, 2)
+        assert 'require("")' in cache.get_output(self.TEMPLATE_PATH, 'include.jinja',
+                                                 js_module_format='commonjs', runtime_path='')
+        assert (cache.hits, cache.misses) == (2, 3)
+
+        # a new cache pointed at the same directory picks up the existing entries
+        other_cache = CompileCache(os.path.join(self.temp_dir, 'cache'))
+        assert other_cache.get_output(self.TEMPLATE_PATH, 'include.jinja',
+                                      js_module_format='es6') == output
+        assert (other_cache.hits, other_cache.misses) == (1, 0)
+        assert other_cache.stats()['entries'] == 3
+
+        expected = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name='include.jinja',
+                             js_module_format='es6').get_output()
+        assert output == expected
+
+    def test_compile_cache_invalidated_by_dependencies(self):
+        template_root = os.path.join(self.temp_dir, 'templates')
+        shutil.copytree(self.TEMPLATE_PATH, template_root)
+        cache = CompileCache(os.path.join(self.temp_dir, 'cache'))
+
+        cache.get_output(template_root, 'include.jinja')
+        cache.get_output(template_root, 'extends.jinja')
+        assert cache.misses == 2
+
+        # 'includes/nested/loud_name.jinja' is only included indirectly by 'include.jinja'
+        with open(os.path.join(template_root, 'includes/nested/loud_name.jinja'), 'a') as f:
+            f.write('changed')
+
+        cache.get_output(template_root, 'include.jinja')
+        cache.get_output(template_root, 'extends.jinja')
+        assert (cache.hits, cache.misses) == (1, 3)
+
+        with open(os.path.join(template_root, 'extends_grandparent.jinja'), 'a') as f:
+            f.write('changed')
+
+        assert 'changed' in cache.get_output(template_root, 'extends.jinja')
+        assert (cache.hits, cache.misses) == (1, 4)
+
+    def test_compile_cache_eviction(self):
+        cache = CompileCache(os.path.join(self.temp_dir, 'cache'))
+        first = cache.get_output(self.TEMPLATE_PATH, 'if.jinja')
+        cache.max_size = len(first.encode('utf-8'))
+
+        cache.get_output(self.TEMPLATE_PATH, 'set.jinja')
+        assert cache.evictions == 1
+        assert cache.stats()['entries'] == 1
+
+        # manifests are counted and evicted along with the entries
+        assert cache.stats()['size'] == sum(
+            os.path.getsize(os.path.join(cache.cache_dir, name))
+            for name in os.listdir(cache.cache_dir)
+        )
+        assert cache.stats()['size'] <= cache.max_size
+
+        cache.get_output(self.TEMPLATE_PATH, 'if.jinja')
+        assert (cache.hits, cache.misses) == (0, 3)
+
+    def test_template_cache_parses_parents_once(self):
+        template_cache = TemplateCache(self.TEMPLATE_PATH)
+        parse = template_cache.environment.parse
+        parsed = []
+
+        def counting_parse(source, *args, **kwargs):
+            parsed.append(source)
+            return parse(source, *args, **kwargs)
+
+        template_cache.environment.parse = counting_parse
+
+        names = ['extends.jinja', 'extends_parent.jinja', 'extends_grandparent.jinja'] * 2
+        outputs = [
+            JinjaToJS(template_root=self.TEMPLATE_PATH, template_name=name,
+                      template_cache=template_cache).get_output()
+            for name in names
+        ]
+
+        # every template in the chain is parsed exactly once
+        assert len(parsed) == 3
+
+        # and reusing the parsed templates doesn't change the output
+        for name, output in zip(names, outputs):
+            assert output == JinjaToJS(template_root=self.TEMPLATE_PATH,
+                                       template_name=name).get_output()
+
+    def test_find_templates(self):
+        assert find_templates(self.TEMPLATE_PATH, 'includes/*.jinja') == [
+            'includes/name.jinja',
+            'includes/nested/loud_name.jinja',
+            'includes/quiet_name.jinja',
+        ]
+
+    def test_compile_tree(self):
+        out_dir = os.path.join(self.temp_dir, 'out')
+        results = compile_tree(self.TEMPLATE_PATH, pattern='*extends*.jinja', out_dir=out_dir,
+                               js_module_format='commonjs')
+
+        assert [name for name, _ in results] == [
+            'extends.jinja',
+            'extends_grandparent.jinja',
+            'extends_parent.jinja',
+        ]
+
+        for name, output in results:
+            expected = JinjaToJS(template_root=self.TEMPLATE_PATH, template_name=name,
+                                 js_module_format='commonjs').get_output()
+            assert output == expected
+            with open(os.path.join(out_dir, os.path.splitext(name)[0] + '.js')) as f:
+                assert f.read() == expected
+
+    def test_compile_tree_parallel(self):
+        serial = compile_tree(self.TEMPLATE_PATH, pattern='filters/*.jinja',
+                              js_module_format='es6')
+        parallel = compile_tree(self.TEMPLATE_PATH, pattern='filters/*.jinja',
+                                js_module_format='es6', jobs=3)
+        assert len(serial) == 16
+        assert parallel == serial
+
+        cache = CompileCache(os.path.join(self.temp_dir, 'cache'))
+        assert compile_tree(self.TEMPLATE_PATH, pattern='filters/*.jinja', jobs=3,
+                            cache=cache, js_module_format='es6') == serial
+        assert (cache.hits, cache.misses) == (0, 16)
+        assert cache.stats()['entries'] == 16
+
+    def test_dependency_graph(self):
+        graph = DependencyGraph()
+        graph.set_dependencies('page.jinja', ['layout.jinja', 'base.jinja', 'partial.jinja'])
+        graph.set_dependencies('layout.jinja', ['base.jinja'])
+        graph.set_dependencies('other.jinja', ['partial.jinja'])
+
+        assert graph.get_affected(['base.jinja']) == {'base.jinja', 'layout.jinja', 'page.jinja'}
+        assert graph.get_affected(['partial.jinja']) == {
+            'partial.jinja', 'page.jinja', 'other.jinja'
+        }
+
+        graph.set_dependencies('page.jinja', ['layout.jinja'])
+        assert graph.get_affected(['partial.jinja']) == {'partial.jinja', 'other.jinja'}
+
+    def test_watcher(self):
+        template_root = os.path.join(self.temp_dir, 'templates')
+        out_dir = os.path.join(self.temp_dir, 'out')
+        shutil.copytree(self.TEMPLATE_PATH, template_root)
+
+        watcher = Watcher(template_root, out_dir, pattern='*include*.jinja')
+        result = watcher.build()
+        assert result['rebuilt'] == [
+            'include.jinja',
+            'include_deduping.jinja',
+            'includes/name.jinja',
+            'includes/nested/loud_name.jinja',
+            'includes/quiet_name.jinja',
+            'recursive_include.jinja',
+        ]
+        assert watcher.poll() is None
+
+        with open(os.path.join(template_root, 'includes/nested/loud_name.jinja'), 'a') as f:
+            f.write('changed')
+
+        result = watcher.poll()
+        assert result['changed'] == ['includes/nested/loud_name.jinja']
+        assert result['rebuilt'] == [
+            'include.jinja',
+            'include_deduping.jinja',
+            'includes/name.jinja',
+            'includes/nested/loud_name.jinja',
+        ]
+        with open(os.path.join(out_dir, 'includes/nested/loud_name.js')) as f:
+            assert 'changed' in f.read()
+
+        # a broken template is reported and retried after the next change
+        with open(os.path.join(template_root, 'includes/quiet_name.jinja'), 'a') as f:
+            f.write('{{ broken|somefilter }}')
+
+        result = watcher.poll()
+        assert list(result['errors']) == ['includes/quiet_name.jinja']
+
+        with open(os.path.join(template_root, 'includes/quiet_name.jinja'), 'w') as f:
+            f.write('fixed')
+
+        result = watcher.poll()
+        assert result['errors'] == {}
+        assert 'includes/quiet_name.jinja' in result['rebuilt']
+
+        # removing a template removes its output too
+        os.remove(os.path.join(template_root, 'recursive_include.jinja'))
+        result = watcher.poll()
+        assert result['changed'] == ['recursive_include.jinja']
+        assert not os.path.exists(os.path.join(out_dir, 'recursive_include.js'))
+        assert os.path.exists(os.path.join(out_dir, 'include.js'))
+
     def _run_test(self, name, additional=None, **kwargs):
 
         # first we'll render the jinja template
@@ -358,32 +1219,29 @@ class Tests(unittest.TestCase):
 
         # create the main template
         path = self._compile_js_template(name)
-        template_args = [path]
-
-        # create a temp file containing the data
-        data_file_path = self._write_to_temp_file(json.dumps(kwargs, cls=Encoder))
 
         # if additional template are required e.g. for includes then create those too
         if additional:
             for n in additional:
                 self._compile_js_template(n)
 
+        data = dict(kwargs)
+        if self.promised_keys:
+            data['__promised_keys__'] = self.promised_keys
+
         # get the result of rendering the javascript template
-        try:
-            js_result = check_output(
-                ['node',
-                 self.NODE_SCRIPT_PATH]
-                + template_args +
-                [data_file_path]
-            )
-        except Exception as e:
-            raise e
+        js_result = self.render_worker.render(
+            path, data, stream=self.compile_options.get('output_mode') == 'stream'
+        )['output']
 
         jinja_result = jinja_result.strip()
         js_result = js_result.strip()
 
-        if isinstance(js_result, bytes):
-            js_result = js_result.decode('utf8')
+        if self.compile_options.get('minify'):
+            # the whitespace in the JavaScript result has been collapsed one piece of the
+            # template at a time, so collapse what's left of it and the Jinja result's the same way
+            jinja_result = collapse_whitespace(jinja_result)[0]
+            js_result = collapse_whitespace(js_result)[0]
 
         if jinja_result != js_result:
             print("Generated Javascript Template:")
@@ -392,13 +1250,25 @@ class Tests(unittest.TestCase):
         # check the jinja result and the javascript result are the same
         assert jinja_result == js_result
 
+    def _get_source_location(self, output, source_map, code):
+        """
+        Returns the template name and line that the first occurrence of `code` in `output` is
+        mapped to by `source_map`.
+        """
+        line, column = next((i, text.index(code))
+                            for i, text in enumerate(output.split('\n')) if code in text)
+        segment = [m for m in decode_mappings(source_map['mappings'])
+                   if m[0] == line and m[1] <= column][-1]
+        return source_map['sources'][segment[2]], segment[3] + 1
+
     def _compile_js_template(self, name):
         js_module = JinjaToJS(
             template_root=self.TEMPLATE_PATH,
             template_name=name,
             js_module_format='commonjs',
             runtime_path=abspath('jinja-to-js-runtime.js'),
-            custom_filters=['unicode_snowmen']
+            custom_filters=['unicode_snowmen'],
+            **self.compile_options
         ).get_output()
 
         target = self.temp_dir + '/' + os.path.splitext(name)[0] + '.js'